@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Generators for synthetic papers, template trees, and a stub TeX toolchain used in benchmarks."""
+
+import os
+import random
+import stat
+import textwrap
+
+_WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed',
+          'do', 'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna']
+
+def _write(fname, text):
+    """Writes text to fname, creating parent directories as needed."""
+    dname = os.path.dirname(fname)
+    if dname and not os.path.exists(dname):
+        os.makedirs(dname)
+    with open(fname, 'w') as out_fp:
+        out_fp.write(text)
+
+def make_template_tree(dest, repos=4, templates=25, depth=2):
+    """Creates repos template repositories of templates each in dest.
+
+    Each template sits depth directories below its repository and carries a figures directory, to
+    mimic the trees found walking real template collections.
+    Returns names of the created templates.
+    """
+    names = []
+    for repo in range(repos):
+        for idx in range(templates):
+            name = 'tpl{0}x{1}'.format(repo, idx)
+            parents = ['group{0}'.format(ii) for ii in range(depth - 1)]
+            tdir = os.path.join(dest, 'repo{0}'.format(repo), *(parents + [name]))
+            _write(os.path.join(tdir, 'setup.tex'), '\\documentclass{article}\n\\begin{document}\n')
+            _write(os.path.join(tdir, 'footer.tex'), '\\bibliography{refs}\n\\end{document}\n')
+            _write(os.path.join(tdir, 'frontmatter.mmd'), textwrap.dedent("""\
+                Base Header Level: 2
+                Title: $TITLE
+                latex author: $AUTHOR
+                bibtex: refs
+                latex input: $TEMPLATE/setup.tex
+                latex footer: $TEMPLATE/footer.tex
+                """))
+            _write(os.path.join(tdir, 'metadata.tex'), '\\def\\myinstitution{$INSTITUTION}\n')
+            _write(os.path.join(tdir, 'default_config.yml'), 'institution: Nowhere\n')
+            _write(os.path.join(tdir, 'figures', 'logo.txt'), 'logo\n')
+            names.append(name)
+    return names
+
+def _paragraph(rng, words, citations):
+    """Builds a paragraph of random words with randomly placed citations."""
+    text = [rng.choice(_WORDS) for _ in range(words)]
+    for _ in range(min(citations, words)):
+        text.insert(rng.randrange(len(text)), '[#ref{0}]'.format(rng.randrange(max(citations, 1))))
+    return ' '.join(text)
+
+def make_paper(dest, template, files=10, sections=5, words=400, citations=20, seed=0):
+    """Creates a synthetic paper in dest using the named template.
+
+    The paper has a root document which transcludes files chapter documents, each containing
+    sections of words words, with citations citations spread over them, and a matching
+    bibliography database. Returns the root document filename.
+    """
+    rng = random.Random(seed)
+    chapters = []
+    for idx in range(files):
+        body = []
+        for sec in range(sections):
+            body.append('## Section {0}.{1}\n\n{2}\n'.format(idx, sec,
+                                                            _paragraph(rng, words, citations)))
+        chapter = 'chapter{0:03d}.mmd'.format(idx)
+        _write(os.path.join(dest, chapter), '# Chapter {0}\n\n{1}'.format(idx, '\n'.join(body)))
+        chapters.append(chapter)
+
+    root = os.path.join(dest, 'paper.mmd')
+    _write(root, textwrap.dedent("""\
+        Base Header Level: 2
+        Title: Synthetic Paper
+        latex author: Benchmark
+        bibtex: refs
+        latex input: {0}/setup.tex
+        latex footer: {0}/footer.tex
+
+        """).format(template) + '\n\n'.join(['{{{{{0}}}}}'.format(ii) for ii in chapters]) + '\n')
+
+    entries = ['@article{{ref{0},\n  title={{Entry {0}}},\n  author={{Doe, J.}},\n  year={{2000}}\n}}\n'
+               .format(ii) for ii in range(max(citations, 1))]
+    _write(os.path.join(dest, 'refs.bib'), '\n'.join(entries))
+    return root
+
+_LATEX_STUB = r"""#!@PYTHON@
+# Stub LaTeX engine which simulates cost and writes plausible outputs
+import os, re, sys, time
+tname = [ii for ii in sys.argv[1:] if not ii.startswith('-')][-1]
+tname = (re.findall(r'\\input\{([^}]*)\}', tname) or [tname])[-1]
+bname = os.path.splitext(os.path.basename(tname))[0]
+bname = ([ii.split('=', 1)[1] for ii in sys.argv if ii.startswith('-jobname=')] or [bname])[-1]
+with open(tname) as tex_fp:
+    tex = tex_fp.read()
+end = time.time() + float(os.environ.get('STUB_LATEX_SECONDS', '@COST@'))
+while time.time() < end:
+    pass
+if '-ini' in sys.argv:
+    # A dumped format holds the preamble it was made from
+    outdir = ([ii.split('=', 1)[1] for ii in sys.argv if ii.startswith('-output-directory=')] or
+              ['.'])[-1]
+    with open(os.path.join(outdir, bname + '.fmt'), 'w') as fmt_fp:
+        fmt_fp.write(tex)
+    sys.exit(0)
+for fmt in [ii.split('=', 1)[1] for ii in sys.argv if ii.startswith('-fmt=')]:
+    with open(fmt + '.fmt') as fmt_fp:
+        tex = fmt_fp.read() + tex
+cites = sorted(set(sum([ii.split(',') for ii in re.findall(r'\\cite[tp]?\{([^}]*)\}', tex)], [])))
+with open(bname + '.aux', 'w') as aux_fp:
+    aux_fp.write('\\relax\n')
+    aux_fp.writelines(['\\citation{%s}\n' % ii for ii in cites])
+    aux_fp.write('\\bibstyle{plain}\n\\bibdata{refs}\n')
+with open(bname + '.log', 'w') as log_fp:
+    log_fp.write('This is a stub LaTeX engine\n')
+with open(bname + '.pdf', 'wb') as pdf_fp:
+    pdf_fp.write(b'%PDF-1.4\n' + tex.encode('utf-8'))
+"""
+
+_BIB_STUB = r"""#!@PYTHON@
+# Stub bibliography processor which simulates cost and writes a .bbl file
+import os, sys, time
+bname = os.path.splitext(sys.argv[-1])[0]
+end = time.time() + float(os.environ.get('STUB_BIB_SECONDS', '@COST@'))
+while time.time() < end:
+    pass
+with open(bname + '.bbl', 'w') as bbl_fp:
+    bbl_fp.write('\\begin{thebibliography}{1}\n\\end{thebibliography}\n')
+"""
+
+def make_stubs(dest, python, latex_cost=0.05, bib_cost=0.02):
+    """Writes stub xelatex, bibtex, and biber executables into dest, run with the given python.
+
+    Costs are the seconds of CPU time each invocation burns, and can be overridden at run time
+    with the STUB_LATEX_SECONDS and STUB_BIB_SECONDS environment variables.
+    """
+    stubs = {
+        'xelatex': _LATEX_STUB.replace('@PYTHON@', python).replace('@COST@', str(latex_cost)),
+        'bibtex': _BIB_STUB.replace('@PYTHON@', python).replace('@COST@', str(bib_cost)),
+        'biber': _BIB_STUB.replace('@PYTHON@', python).replace('@COST@', str(bib_cost))
+    }
+    for name, text in stubs.items():
+        fname = os.path.join(dest, name)
+        _write(fname, text)
+        os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return dest
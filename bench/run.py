@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Offline benchmarks of scriptorium operations, using synthetic papers and a stub TeX toolchain.
+
+Run from the repository root with e.g. `python bench/run.py --files 60 --templates 100`.
+Everything is generated in a scratch directory, with HOME pointed there so the user's
+configuration and templates are untouched.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generate
+
+def _reset(path):
+    """Removes a file or directory if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def _bench(name, func, setup=None, repeat=5):
+    """Times func over repeat runs, calling setup before each, and prints the results."""
+    times = []
+    try:
+        for _ in range(repeat):
+            if setup:
+                setup()
+            start = timeit.default_timer()
+            func()
+            times.append(timeit.default_timer() - start)
+    except Exception as exc:
+        print('{0:<32} failed: {1}'.format(name, str(exc).strip().split('\n')[-1]))
+        return None
+    print('{0:<32} {1:>10.2f} {2:>10.2f}'.format(name, min(times) * 1e3,
+                                                 sum(times) / len(times) * 1e3))
+    return min(times)
+
+def main():
+    """Generates the benchmark workspace and runs each benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=20, help='Chapter files per paper')
+    parser.add_argument('--sections', type=int, default=5, help='Sections per chapter')
+    parser.add_argument('--words', type=int, default=400, help='Words per section')
+    parser.add_argument('--citations', type=int, default=50, help='Citations per section')
+    parser.add_argument('--repos', type=int, default=4, help='Template repositories')
+    parser.add_argument('--templates', type=int, default=25, help='Templates per repository')
+    parser.add_argument('--depth', type=int, default=2, help='Depth of templates in repositories')
+    parser.add_argument('--latex-cost', type=float, default=0.05,
+                        help='Seconds each stub LaTeX pass spends')
+    parser.add_argument('--bib-cost', type=float, default=0.02,
+                        help='Seconds each stub bibliography run spends')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each benchmark')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated workspace')
+    args = parser.parse_args()
+
+    workspace = tempfile.mkdtemp(prefix='scriptorium-bench-')
+    os.environ['HOME'] = workspace
+    stubs = generate.make_stubs(os.path.join(workspace, 'bin'), sys.executable,
+                                args.latex_cost, args.bib_cost)
+    os.environ['PATH'] = os.pathsep.join([stubs, os.environ.get('PATH', '')])
+
+    import scriptorium
+    from scriptorium import artifacts, papers, templates
+
+    template_dir = os.path.join(workspace, 'templates')
+    names = generate.make_template_tree(template_dir, args.repos, args.templates, args.depth)
+    scriptorium.CONFIG['TEMPLATE_DIR'] = template_dir
+    scriptorium.CONFIG['LATEX_CMD'] = 'xelatex'
+    template = names[-1]
+
+    paper_dir = os.path.join(workspace, 'paper')
+    generate.make_paper(paper_dir, template, args.files, args.sections, args.words,
+                        args.citations)
+    state_dir = os.path.join(paper_dir, '.scriptorium')
+    index_dir = os.path.join(template_dir, '.scriptorium')
+
+    def cold_index():
+        """Drops the on-disk and in-memory template indexes."""
+        _reset(index_dir)
+        templates._INDEXES.clear()
+
+    def cold_paper():
+        """Drops cached paper state, generated files, and stored PDFs."""
+        _reset(state_dir)
+        _reset(artifacts.artifact_dir())
+        for fname in os.listdir(paper_dir):
+            if not fname.endswith(('.mmd', '.bib')):
+                os.remove(os.path.join(paper_dir, fname))
+
+    config = {'TITLE': 'Benchmark', 'AUTHOR': 'Benchmark'}
+
+    created = [0]
+    def create():
+        """Creates a fresh paper from the template."""
+        created[0] += 1
+        scriptorium.create(os.path.join(workspace, 'new', str(created[0])), template,
+                           config=dict(config))
+
+    print('{0:<32} {1:>10} {2:>10}'.format('Benchmark', 'Best (ms)', 'Mean (ms)'))
+    _bench('paper_root (cold)', lambda: scriptorium.paper_root(paper_dir), papers._ROOTS.clear,
+           args.repeat)
+    _bench('paper_root (cached)', lambda: scriptorium.paper_root(paper_dir), None, args.repeat)
+    _bench('find_template (cold)', lambda: scriptorium.find_template(template), cold_index,
+           args.repeat)
+    _bench('find_template (cached)', lambda: scriptorium.find_template(template), None,
+           args.repeat)
+    _bench('create', create, None, args.repeat)
+    compiled = scriptorium.compile_template(template)
+    _bench('CompiledTemplate.expand', lambda: compiled.expand(dict(config)), None, args.repeat)
+    def create_compiled():
+        """Creates a fresh paper from the precompiled template."""
+        created[0] += 1
+        compiled.create(os.path.join(workspace, 'new', str(created[0])), config=dict(config))
+    _bench('create (compiled)', create_compiled, None, args.repeat)
+    _bench('to_pdf (cold)', lambda: scriptorium.to_pdf(paper_dir), cold_paper, args.repeat)
+    #The store would serve every unchanged build, so this times the incremental build itself
+    _bench('to_pdf (unchanged)', lambda: scriptorium.to_pdf(paper_dir, use_cache=False), None,
+           args.repeat)
+    _bench('to_pdf (stored)', lambda: scriptorium.to_pdf(paper_dir), None, args.repeat)
+
+    if args.keep:
+        print('Workspace kept in {0}'.format(workspace))
+    else:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
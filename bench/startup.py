@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Startup time benchmark for the scriptorium command line, guarding against regressions.
+
+Times `scriptorium --version` and a shell completion request, each in a fresh interpreter, and
+exits with a non-zero status if either exceeds the budget over the bare interpreter startup. The
+default budget keeps both under 50ms on machines where the interpreter itself starts in 10ms.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _best(cmd, env, repeat):
+    """Returns the fastest of repeat runs of cmd, in milliseconds."""
+    times = []
+    with open(os.devnull, 'w') as null_fp:
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            subprocess.call(cmd, env=env, stdout=null_fp, stderr=null_fp)
+            times.append(timeit.default_timer() - start)
+    return min(times) * 1e3
+
+def main():
+    """Runs the startup benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=20, help='Runs of each command')
+    parser.add_argument('--budget', type=float, default=40.0,
+                        help='Allowed milliseconds over bare interpreter startup')
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='scriptorium-startup-')
+    env = dict(os.environ, HOME=home)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, env.get('PYTHONPATH', '')])
+    complete_env = dict(env, _ARGCOMPLETE='1', COMP_LINE='scriptorium bu', COMP_POINT='14',
+                        _ARGCOMPLETE_STDOUT_FILENAME=os.devnull)
+
+    try:
+        bare = _best([sys.executable, '-c', 'pass'], env, args.repeat)
+        results = [
+            ('--version', _best([sys.executable, '-m', 'scriptorium', '--version'], env,
+                                args.repeat)),
+            ('completion', _best([sys.executable, '-m', 'scriptorium'], complete_env,
+                                 args.repeat))
+        ]
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    print('{0:<16} {1:>10} {2:>10}'.format('Command', 'Best (ms)', 'Over (ms)'))
+    print('{0:<16} {1:>10.1f} {2:>10}'.format('interpreter', bare, '-'))
+    failed = False
+    for name, elapsed in results:
+        over = elapsed - bare
+        failed |= over > args.budget
+        print('{0:<16} {1:>10.1f} {2:>10.1f}{3}'.format(name, elapsed, over,
+                                                      '  OVER BUDGET' if over > args.budget else ''))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,48 @@
 #!/usr/bin/env python
-"""Initialization of scriptorium package."""
+"""Initialization of scriptorium package.
+
+Importing the package has no side effects: configuration is read on first access to CONFIG, and
+the modules providing the public functions are only imported when those functions are first used.
+"""
+
+import importlib
+import sys
 
 from ._version import __version__
 
-from .config import _DEFAULT_CFG
-CONFIG = _DEFAULT_CFG.copy()
+from .config import _DEFAULT_CFG, LazyConfig
+CONFIG = LazyConfig(_DEFAULT_CFG)
 
 from .config import read_config, save_config
 
-read_config()
+_EXPORTS = {
+    'papers': ['paper_root', 'get_template', 'read_frontmatter', 'to_pdf', 'build_papers',
+               'create', 'compile_template', 'create_batch', 'clean',
+               'clean_papers'],
+    'templates': ['all_templates', 'find_template', 'install_template', 'update_template',
+                  'list_variables', 'get_manifest', 'get_default_config', 'template_revision',
+                  'update_all_templates', 'install_templates'],
+    'install': ['find_missing_binaries', 'find_missing_packages']
+}
+_LAZY = {name: module for module, names in _EXPORTS.items() for name in names}
+
+def __getattr__(name):
+    """Imports the module providing a public function on first use."""
+    if name not in _LAZY:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+    value = getattr(importlib.import_module('.' + _LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+if sys.version_info < (3, 7):
+    #Module level __getattr__ is unsupported, so import everything up front
+    for _name in _LAZY:
+        __getattr__(_name)
 
-from .papers import paper_root, get_template, to_pdf, create, clean
-from .templates import all_templates, find_template, install_template, update_template
-from .templates import list_variables, get_manifest, get_default_config
-from .install import find_missing_binaries, find_missing_packages
-from .__main__ import main
\ No newline at end of file
+def main():
+    """Main function for executing scriptorium as a standalone script."""
+    from .__main__ import main as _main
+    return _main()
@@ -2,22 +2,118 @@
 #Script to build a scriptorium paper in a cross-platform friendly fashion
 
 import argparse
-import argcomplete
+import glob
 import shutil
 import sys
 import os
 import os.path
-import yaml
 
 import scriptorium
 
 def build_cmd(args):
     """Creates PDF from paper in the requested location."""
-    pdf = scriptorium.to_pdf(args.paper, use_shell_escape=args.shell_escape, flatten=args.flatten,
-                                            keep_comments=args.keep_comments)
-
-    if args.output and pdf != args.output:
+    profiler = None
+    if args.profile:
+        from scriptorium.profiling import Profiler
+        profiler = Profiler()
+
+    paper_dir = args.paper if os.path.isdir(args.paper) else os.path.dirname(args.paper)
+    options = dict(use_shell_escape=args.shell_escape, flatten=args.flatten,
+                   keep_comments=args.keep_comments, jobs=args.jobs, profiler=profiler,
+                   precompile=args.precompile, build_dir=args.build_dir, use_cache=args.cache,
+                   only=args.only, draft=args.draft)
+    formats = [ii.strip() for ii in args.formats.split(',') if ii.strip()]
+    if formats == ['pdf']:
+        outputs = {'pdf': scriptorium.to_pdf(args.paper, **options)}
+    else:
+        from scriptorium.export import export
+        outputs = export(paper_dir or '.', formats, **options)
+
+    if profiler:
+        profiler.save(args.profile)
+        print(profiler.summary())
+
+    pdf = outputs.get('pdf')
+    if pdf and args.build_dir:
+        #Only the final PDF leaves the build directory
+        outputs['pdf'] = args.output or os.path.join(paper_dir, os.path.basename(pdf))
+        shutil.copyfile(pdf, outputs['pdf'])
+    elif pdf and args.output and pdf != args.output:
         shutil.move(pdf, args.output)
+        outputs['pdf'] = args.output
+    if pdf and args.output:
+        from scriptorium.papers import _record_published
+        _record_published(os.path.dirname(pdf), [outputs['pdf']])
+
+    for fmt in formats:
+        if fmt != 'pdf':
+            print('{0}: {1}'.format(fmt, outputs[fmt]))
+
+    if args.depfile:
+        from scriptorium.deps import paper_dependencies, write_depfile
+        write_depfile(args.depfile, outputs.get('pdf') or outputs[formats[0]],
+                      paper_dependencies(paper_dir or '.', build_dir=args.build_dir))
+
+def build_all_cmd(args):
+    """Builds every paper matching the given directories or globs, summarizing the results."""
+    papers = []
+    unmatched = []
+    for pattern in args.papers:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        matches = [ii for ii in matches if os.path.isdir(ii)]
+        if not matches:
+            unmatched.append(pattern)
+            print('[FAILED] {0}: no paper directories match'.format(pattern))
+        papers += [ii for ii in matches if ii not in papers]
+
+    failed = []
+    for paper, pdf, err in scriptorium.build_papers(papers, jobs=args.jobs,
+                                                    use_shell_escape=args.shell_escape):
+        if err:
+            failed.append(paper)
+            print('[FAILED] {0}: {1}'.format(paper, err.strip().split('\n')[-1]))
+        else:
+            print('[OK] {0} -> {1}'.format(paper, pdf))
+
+    print('{0} built, {1} failed'.format(len(papers) - len(failed), len(failed) + len(unmatched)))
+    if failed or unmatched:
+        sys.exit(1)
+
+def watch_cmd(args):
+    """Rebuilds the paper in the requested location whenever its inputs change."""
+    from scriptorium.watch import watch
+
+    def on_build(pdf, err):
+        """Reports the outcome of each rebuild."""
+        if err:
+            print('Build failed:\n{0}'.format(err))
+        else:
+            print('Built {0}'.format(pdf))
+
+    try:
+        watch(args.paper, debounce=args.debounce, on_build=on_build,
+              use_shell_escape=args.shell_escape, jobs=args.jobs)
+    except KeyboardInterrupt:
+        pass
+
+def serve_cmd(args):
+    """Runs the build daemon until interrupted."""
+    if sys.version_info < (3, 7):
+        print('The build daemon needs Python 3.7 or newer.')
+        sys.exit(1)
+
+    from scriptorium.server import serve, SOCKET_PATH
+    socket_path = args.socket or SOCKET_PATH
+
+    def ready():
+        """Reports that the daemon is accepting requests."""
+        print('Listening on {0}'.format(socket_path))
+        sys.stdout.flush()
+
+    try:
+        serve(socket_path, jobs=args.jobs, ready=ready)
+    except KeyboardInterrupt:
+        pass
 
 def info(args):
     """Function to attempt to extract useful information from a specified paper."""
@@ -34,14 +130,42 @@ def info(args):
             sys.exit(2)
         print(template)
 
+def _report_all(results):
+    """Prints the outcome of each of a batch of template operations, exiting if any failed."""
+    failed = 0
+    for name, err in results:
+        if err:
+            failed += 1
+            print('[FAILED] {0}:\n    {1}'.format(name, '\n    '.join(err.strip().split('\n'))))
+        else:
+            print('[OK] {0}'.format(name))
+    if failed:
+        print('{0} failed'.format(failed))
+        sys.exit(1)
+
+def _read_urls(fname):
+    """Reads the repositories to install from a file, skipping blank lines and # comments."""
+    with open(fname, 'r') as list_fp:
+        return [ii.strip() for ii in list_fp if ii.strip() and not ii.strip().startswith('#')]
+
 def template_cmd(args):
     """Prints out all installed templates."""
     if args.update:
         rev = args.update[1] if len(args.update) > 1 else None
-        scriptorium.update_template(args.update[0], args.template_dir, rev)
+        scriptorium.update_template(args.update[0], args.template_dir, rev, depth=args.depth,
+                                    mirror=args.mirror)
+
+    if args.update_all:
+        _report_all(scriptorium.update_all_templates(args.template_dir, jobs=args.jobs,
+                                                     depth=args.depth, mirror=args.mirror))
+
+    if args.install_from:
+        _report_all(scriptorium.install_templates(_read_urls(args.install_from), args.template_dir,
+                                                  jobs=args.jobs, depth=args.depth,
+                                                  mirror=args.mirror))
 
     if args.list:
-        templates = scriptorium.all_templates(args.template_dir)
+        templates = scriptorium.all_templates(args.template_dir, args.rescan)
         print('\n'.join(templates))
 
     if args.readme:
@@ -52,7 +176,8 @@ def template_cmd(args):
                 print(readme.read())
 
     if args.install:
-        scriptorium.install_template(args.install, args.template_dir)
+        scriptorium.install_template(args.install, args.template_dir, depth=args.depth,
+                                     mirror=args.mirror)
 
     if args.variables:
         variables = scriptorium.list_variables(args.variables, args.template_dir)
@@ -64,8 +189,69 @@ def template_cmd(args):
         for kk, vv in manifest.items():
             print("{0} -> {1}".format(vv, kk))
 
+def _read_roster(fname):
+    """Reads the papers to create from a YAML list of mappings, or a CSV file with a header row."""
+    if fname.endswith('.csv'):
+        import csv
+        with open(fname, 'r') as roster_fp:
+            papers = [{kk: vv for kk, vv in row.items() if kk and vv}
+                      for row in csv.DictReader(roster_fp)]
+    else:
+        import yaml
+        with open(fname, 'r') as roster_fp:
+            papers = yaml.safe_load(roster_fp) or []
+    if not isinstance(papers, list) or not all(isinstance(ii, dict) for ii in papers):
+        raise ValueError('{0} must list one mapping of variables per paper'.format(fname))
+    return papers
+
+def _paper_vars(variables):
+    """Normalizes the keys of a roster entry or command line configuration, keeping output and
+    template lower case and making variable names upper case, as templates use them.
+    """
+    normalized = {}
+    for kk, vv in variables:
+        kk = '{0}'.format(kk)
+        normalized[kk.lower() if kk.lower() in ('output', 'template') else kk.upper()] = vv
+    return normalized
+
+def create_batch_cmd(args):
+    """Creates every paper listed in a roster, reporting unset variables for each."""
+    config = _paper_vars(args.config)
+    papers = []
+    for paper in _read_roster(args.batch):
+        papers.append(dict(config))
+        papers[-1].update(_paper_vars(paper.items()))
+
+    failed = []
+    unset = []
+    for output, unset_vars, err in scriptorium.create_batch(papers, args.template,
+                                                            force=args.force, jobs=args.jobs):
+        if err:
+            failed.append(output)
+            print('[FAILED] {0}: {1}'.format(output, err))
+        elif unset_vars:
+            unset.append(output)
+            if not args.quiet:
+                print('[UNSET] {0}: {1}'.format(output, ' '.join('${0}'.format(ii.upper())
+                                                               for ii in sorted(unset_vars))))
+        else:
+            print('[OK] {0}'.format(output))
+
+    print('{0} created, {1} with unset variables, {2} failed'.format(len(papers) - len(failed),
+                                                                     len(unset), len(failed)))
+    if failed:
+        sys.exit(1)
+    if unset:
+        sys.exit(3)
+
 def create_cmd(args):
     """Creates a new paper given flags."""
+    if args.batch:
+        return create_batch_cmd(args)
+    if not args.output:
+        print('A directory to create the paper in is required, unless using --batch.')
+        sys.exit(2)
+
     config = {kk:vv for kk, vv in args.config}
     unset_vars = scriptorium.create(args.output, args.template, force=args.force, config=config)
     if unset_vars:
@@ -84,17 +270,64 @@ def doctor_cmd(_):
 
 def config_cmd(args):
     """Command to access configuration values."""
+    import yaml
     if args.list:
-        print(yaml.dump(scriptorium.CONFIG, default_flow_style=False))
+        print(yaml.dump(scriptorium.CONFIG.copy(), default_flow_style=False))
     elif len(args.value) == 1:
         print(yaml.dump({args.value[0] : scriptorium.CONFIG[args.value[0]]}))
     elif len(args.value) == 2:
         scriptorium.CONFIG[args.value[0].upper()] = args.value[1]
         scriptorium.save_config()
 
+def cache_cmd(args):
+    """Command to inspect and trim the store of built PDFs."""
+    from scriptorium import artifacts
+    if args.action == 'prune':
+        max_bytes = int(args.max_size * 1048576) if args.max_size is not None else None
+        removed, freed = artifacts.prune(max_bytes)
+        print('Removed {0} PDFs, freeing {1:.1f}MB'.format(removed, freed / 1048576.0))
+    else:
+        stats = artifacts.stats()
+        print('Directory: {0}'.format(stats['dir']))
+        print('PDFs: {0}'.format(stats['count']))
+        print('Size: {0:.1f}MB of {1:.1f}MB'.format(stats['bytes'] / 1048576.0,
+                                                   stats['limit'] / 1048576.0))
+
+def deps_cmd(args):
+    """Lists the files the paper in the requested location is built from, as a depfile."""
+    from scriptorium.deps import paper_dependencies, format_depfile
+    paper_dir = os.path.abspath(args.paper)
+    deps = paper_dependencies(paper_dir, build_dir=args.build_dir)
+    target = args.target
+    if not target:
+        bname = os.path.basename(scriptorium.paper_root(paper_dir)).split('.')[0]
+        target = os.path.join(paper_dir, '{0}.pdf'.format(bname))
+    if args.output:
+        with open(args.output, 'w') as dep_fp:
+            dep_fp.write(format_depfile(target, deps))
+    else:
+        sys.stdout.write(format_depfile(target, deps))
+
 def clean_cmd(args):
     """Command to clean cruft from current directory."""
-    scriptorium.clean(args.paper)
+    if not args.recursive:
+        scriptorium.clean(args.paper)
+        return
+
+    cleaned, reclaimed, failed = 0, 0, 0
+    for paper, size, err in scriptorium.clean_papers(args.paper, jobs=args.jobs):
+        if err:
+            failed += 1
+            print('[FAILED] {0}: {1}'.format(paper, err))
+        else:
+            cleaned += 1
+            reclaimed += size
+            print('[OK] {0}: {1:.1f}KB'.format(paper, size / 1024.0))
+    print('{0} papers cleaned, {1:.1f}MB reclaimed, {2} failed'.format(cleaned,
+                                                                      reclaimed / 1048576.0,
+                                                                      failed))
+    if failed:
+        sys.exit(1)
 
 def main():
     """Main function for executing scriptorium as a standalone script."""
@@ -115,8 +348,68 @@ def main():
                               help='Flatten root LaTeX file output')
     build_parser.add_argument('-k', '--keep-comments', action='store_true', default=False,
                               help='Keep comments when flattening the resulting LaTeX file')
+    build_parser.add_argument('-j', '--jobs', type=int, default=1,
+                              help='Number of processes used to convert MultiMarkdown files')
+    build_parser.add_argument('--precompile', action='store_true', default=False,
+                              help='Load the template preamble from a cached precompiled format')
+    build_parser.add_argument('-b', '--build-dir',
+                              help='Directory to write intermediate files to, kept between builds')
+    build_parser.add_argument('--no-cache', dest='cache', action='store_false', default=True,
+                              help='Always build, rather than reusing a PDF built from identical inputs')
+    build_parser.add_argument('-p', '--profile',
+                              help='Write a Chrome trace of the build stages to the given file')
+    build_parser.add_argument('-d', '--draft', action='store_true', default=False,
+                              help='Run a single LaTeX pass with draft graphics, reusing the '
+                                   'bibliography and references of the last full build')
+    build_parser.add_argument('--only', action='append',
+                              help='Compile only the chapter with this title, or from this file')
+    build_parser.add_argument('--formats', default='pdf',
+                              help='Comma separated formats to publish, from pdf, html, and tex. '
+                                   'HTML covers the root document and its transclusions, but not '
+                                   'files its LaTeX pulls in with \\input')
+    build_parser.add_argument('--depfile',
+                              help='Write the files the paper is built from to the given depfile')
     build_parser.set_defaults(func=build_cmd)
 
+    # Build All Command
+    build_all_parser = subparsers.add_parser('build-all')
+    build_all_parser.add_argument('papers', nargs='+',
+                                  help='Directories or glob patterns of papers to build')
+    build_all_parser.add_argument('-j', '--jobs', type=int, default=1,
+                                  help='Number of papers to build concurrently')
+    build_all_parser.add_argument('-s', '--shell-escape', action='store_true', default=False,
+                                  help='Flag indicating shell-escape should be used')
+    build_all_parser.set_defaults(func=build_all_cmd)
+
+    # Watch Command
+    watch_parser = subparsers.add_parser('watch')
+    watch_parser.add_argument('paper', default='.', nargs='?',
+                              help='Directory containing paper to watch')
+    watch_parser.add_argument('-s', '--shell-escape', action='store_true', default=False,
+                              help='Flag indicating shell-escape should be used')
+    watch_parser.add_argument('-j', '--jobs', type=int, default=1,
+                              help='Number of processes used to convert MultiMarkdown files')
+    watch_parser.add_argument('-d', '--debounce', type=float, default=0.5,
+                              help='Seconds without changes to wait before rebuilding')
+    watch_parser.set_defaults(func=watch_cmd)
+
+    # Deps Command
+    deps_parser = subparsers.add_parser('deps')
+    deps_parser.add_argument('paper', default='.', nargs='?',
+                             help='Directory containing paper to list dependencies of')
+    deps_parser.add_argument('-o', '--output', help='Depfile to write, instead of printing it')
+    deps_parser.add_argument('-t', '--target', help='Target named in the depfile, defaulting to the PDF')
+    deps_parser.add_argument('-b', '--build-dir',
+                             help='Directory intermediate files are written to when building')
+    deps_parser.set_defaults(func=deps_cmd)
+
+    # Serve Command
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--socket', help='UNIX socket to listen on')
+    serve_parser.add_argument('-j', '--jobs', type=int, default=1,
+                              help='Number of papers to build concurrently')
+    serve_parser.set_defaults(func=serve_cmd)
+
     # Info Command
     info_parser = subparsers.add_parser('info')
     info_parser.add_argument('paper', default='.', nargs='?',
@@ -127,7 +420,7 @@ def main():
 
     # New Command
     new_parser = subparsers.add_parser("new")
-    new_parser.add_argument("output", help="Directory to create paper in.")
+    new_parser.add_argument("output", nargs='?', help="Directory to create paper in.")
     new_parser.add_argument("-f", "--force", action="store_true",
                             help="Overwrite files in paper creation.")
     new_parser.add_argument("-t", "--template", help="Template to use in paper.")
@@ -135,12 +428,20 @@ def main():
                             help='Provide "key" "value" to replace in default paper.')
     new_parser.add_argument('-q', '--quiet', action='store_true', default=False,
                             help='Squelch warnings about unset variables')
+    new_parser.add_argument('-b', '--batch',
+                            help='YAML or CSV roster of papers to create, one per row, naming its '
+                                 'directory as output and setting variables')
+    new_parser.add_argument('-j', '--jobs', type=int, default=4,
+                            help='Number of papers to create concurrently with --batch')
     new_parser.set_defaults(func=create_cmd)
 
     # Template Command
     template_parser = subparsers.add_parser("template")
     template_parser.add_argument('-l', '--list', action='store_true', default=False,
                                  help='List available templates')
+    template_parser.add_argument('--rescan', action='store_true', default=False,
+                                 help='Scan the template directory again when listing, finding '
+                                      'templates added deep inside a repository')
     template_parser.add_argument('-u', '--update', nargs='+',
                                  help='Update the given template to the latest version')
     template_parser.add_argument('-r', '--readme', help='Print README for the specified template')
@@ -148,6 +449,17 @@ def main():
                                  help='Overrides template directory used for listing templates')
     template_parser.add_argument('-i', '--install',
                                  help='Install repository at given URL in template directory')
+    template_parser.add_argument('--update-all', action='store_true', default=False,
+                                 help='Update every template repository')
+    template_parser.add_argument('--install-from',
+                                 help='Install every repository listed in a file, one URL and '
+                                      'optional revision per line')
+    template_parser.add_argument('-j', '--jobs', type=int, default=4,
+                                 help='Number of repositories to clone or update concurrently')
+    template_parser.add_argument('--depth', type=int,
+                                 help='Clone and fetch only this many commits of history')
+    template_parser.add_argument('--mirror',
+                                 help='Directory of bare mirrors to clone and fetch through')
     template_parser.add_argument('-v', '--variables',
                                  help='List variables available when using the new command')
     template_parser.add_argument('-m', '--manifest',
@@ -165,12 +477,27 @@ def main():
     config_parser.add_argument('value', nargs='*', help='Access configuration value')
     config_parser.set_defaults(func=config_cmd)
 
+    # Cache Command
+    cache_parser = subparsers.add_parser('cache')
+    cache_parser.add_argument('action', choices=['stats', 'prune'], default='stats', nargs='?',
+                              help='Summarize the store of built PDFs, or evict old PDFs from it')
+    cache_parser.add_argument('--max-size', type=float,
+                              help='Size in MB to prune the store to, instead of the configured cap')
+    cache_parser.set_defaults(func=cache_cmd)
+
     #Clean Command
     clean_parser = subparsers.add_parser('clean')
     clean_parser.add_argument('paper', default='.', nargs='?', help='Directory containing paper to clean')
+    clean_parser.add_argument('-r', '--recursive', action='store_true', default=False,
+                              help='Clean every paper in the directory tree')
+    clean_parser.add_argument('-j', '--jobs', type=int, default=4,
+                              help='Number of papers to clean concurrently with --recursive')
     clean_parser.set_defaults(func=clean_cmd)
 
-    argcomplete.autocomplete(parser)
+    #Only pay for importing argcomplete when the shell is asking for completions
+    if '_ARGCOMPLETE' in os.environ:
+        import argcomplete
+        argcomplete.autocomplete(parser)
     args = parser.parse_args()
 
     if args.version:
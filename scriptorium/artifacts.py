@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""Content-addressed store of built PDFs, shared between papers and builds.
+
+PDFs are stored by a digest of everything which affects them, so rebuilding byte-identical inputs
+anywhere on the machine reuses the earlier result. The store is capped in size, evicting the least
+recently used PDFs first.
+"""
+
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+
+import scriptorium
+from scriptorium.state import STATE_DIR, hash_bytes, hash_file, load_state
+
+#LaTeX byproducts, which are outputs of a build rather than inputs to it
+_GENERATED_EXTS = ('.aux', '.log', '.bbl', '.blg', '.bcf', '.run.xml', '.toc', '.lof', '.lot',
+                   '.out', '.gls', '.glo', '.glg', '.acn', '.acr', '.alg', '.ist', '.xdy', '.slo',
+                   '.sls', '.slg', '.glsdefs', '.fls', '.fdb_latexmk', '.synctex.gz', '.fmt',
+                   '.xdv', '.nav', '.snm', '.vrb', '.pyg')
+#Directories of byproducts, such as those of minted
+_GENERATED_DIRS = ('_minted-',)
+_SOURCE_EXTS = ('.mmd', '.md', '.txt')
+
+_VERSIONS = {}
+
+def _latex_version(latex_cmd):
+    """Reads the version banner of the LaTeX command, once per process."""
+    if latex_cmd not in _VERSIONS:
+        try:
+            output = subprocess.check_output([latex_cmd, '--version'], stderr=subprocess.STDOUT,
+                                             universal_newlines=True)
+            _VERSIONS[latex_cmd] = output.strip().split('\n')[0]
+        except (subprocess.CalledProcessError, EnvironmentError):
+            _VERSIONS[latex_cmd] = None
+    return _VERSIONS[latex_cmd]
+
+def _generated(path, outputs):
+    """Tells whether a file is a byproduct of building, by its name or the outputs manifest."""
+    return path in outputs or path.endswith(_GENERATED_EXTS) or \
+           any(ii.startswith(_GENERATED_DIRS) for ii in path.split(os.sep))
+
+def _paper_inputs(paper_dir, bname, skip_dirs, outputs):
+    """Lists files in a paper directory which are not generated by building it."""
+    inputs = []
+    for dirpath, dirnames, filenames in os.walk(paper_dir):
+        dirnames[:] = sorted(ii for ii in dirnames if ii not in ('.git', STATE_DIR) and
+                             not ii.startswith(_GENERATED_DIRS) and
+                             os.path.join(dirpath, ii) not in skip_dirs)
+        sources = set(os.path.splitext(ii)[0] for ii in filenames if ii.endswith(_SOURCE_EXTS))
+        for fname in sorted(filenames):
+            base, ext = os.path.splitext(fname)
+            path = os.path.join(dirpath, fname)
+            if _generated(path, outputs) or (ext == '.tex' and base in sources) or \
+               (dirpath == paper_dir and fname == bname + '.pdf'):
+                continue
+            inputs.append(path)
+    return inputs
+
+def _template_state(template, template_dir):
+    """Identifies the revision of a template, along with any uncommitted changes to it."""
+    state = [scriptorium.template_revision(template, template_dir)]
+    template_loc = scriptorium.find_template(template, template_dir)
+    try:
+        top = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], cwd=template_loc,
+                                      stderr=subprocess.STDOUT, universal_newlines=True).strip()
+        changed = subprocess.check_output(['git', 'ls-files', '--modified', '--others',
+                                           '--exclude-standard'], cwd=top,
+                                          stderr=subprocess.STDOUT, universal_newlines=True)
+    except (subprocess.CalledProcessError, EnvironmentError):
+        return state
+    for fname in sorted(set(changed.split('\n')) - set([''])):
+        #Scriptorium's own state is not part of the template
+        if STATE_DIR in fname.split('/'):
+            continue
+        state.append('{0}:{1}'.format(fname, hash_file(os.path.join(top, fname))))
+    return state
+
+def build_digest(fname, template_dir, flags, build_dir=None):
+    """Builds a digest of everything affecting the PDF built from the given root document.
+
+    This covers the paper's own files, everything the build reads as found by
+    deps.paper_dependencies, including transclusions and LaTeX inputs outside the paper, the
+    template revision and any uncommitted changes to it, the converter and LaTeX versions, and the
+    build flags. Byproducts of earlier builds are left out. The paper should already have been
+    converted into its output directory, as sources whose conversions are not current are converted
+    again in memory.
+    """
+    import pymmd
+    from scriptorium.deps import paper_dependencies
+    paper_dir = os.path.dirname(fname)
+    bname = os.path.basename(fname).split('.')[0]
+    skip_dirs = [os.path.abspath(build_dir)] if build_dir else []
+    out_dir = os.path.abspath(build_dir) if build_dir else paper_dir
+    outputs = set(os.path.join(out_dir, ii)
+                  for ii in load_state(out_dir, 'outputs').get('files', []))
+
+    parts = ['scriptorium:{0}'.format(scriptorium.__version__),
+             'pymmd:{0}'.format(pymmd.version())]
+    latex_cmd = scriptorium.CONFIG['LATEX_CMD']
+    parts.append('latex:{0}:{1}'.format(latex_cmd, _latex_version(latex_cmd)))
+    parts += ['{0}={1}'.format(kk, flags[kk]) for kk in sorted(flags)]
+    parts += ['{0}={1}'.format(var, os.environ.get(var))
+              for var in ['TEXINPUTS', 'BIBINPUTS', 'BSTINPUTS']]
+
+    inputs = set(_paper_inputs(paper_dir, bname, skip_dirs, outputs))
+    inputs.update(ii for ii in paper_dependencies(paper_dir, template_dir, build_dir)
+                  if not _generated(ii, outputs))
+    for path in sorted(inputs):
+        #Paths within the paper are relative, so copies of a paper share their PDFs
+        name = os.path.relpath(path, paper_dir)
+        name = path if name.startswith(os.pardir) else name
+        parts.append('{0}:{1}'.format(name, hash_file(path)))
+
+    template = scriptorium.get_template(fname)
+    if template:
+        parts += _template_state(template, template_dir)
+    return hash_bytes('\n'.join(parts))
+
+def artifact_dir():
+    """Returns the directory holding the artifact store."""
+    return os.path.expanduser(scriptorium.CONFIG['ARTIFACT_DIR'])
+
+def artifact_path(digest):
+    """Returns the path a PDF with the given digest is stored at."""
+    return os.path.join(artifact_dir(), digest[:2], '{0}.pdf'.format(digest))
+
+def _copy(src, dest):
+    """Copies a file so that dest is never seen partially written."""
+    dname = os.path.dirname(dest)
+    if not os.path.exists(dname):
+        os.makedirs(dname)
+    fdesc, tmp_name = tempfile.mkstemp(dir=dname, suffix='.tmp')
+    os.close(fdesc)
+    try:
+        shutil.copyfile(src, tmp_name)
+        if os.name == 'nt' and os.path.exists(dest):
+            os.remove(dest)
+        os.rename(tmp_name, dest)
+    except EnvironmentError:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+def fetch(digest, dest):
+    """Copies the stored PDF with the given digest to dest, returning whether it was found."""
+    path = artifact_path(digest)
+    try:
+        _copy(path, dest)
+        #Mark the PDF as recently used
+        os.utime(path, None)
+    except EnvironmentError:
+        return False
+    return True
+
+def store(digest, pdf):
+    """Adds a built PDF to the store, then evicts old PDFs if the store is over its size cap."""
+    try:
+        _copy(pdf, artifact_path(digest))
+    except EnvironmentError:
+        return
+    prune()
+
+def _artifacts():
+    """Lists stored PDFs as tuples of last use time, size, and path."""
+    artifacts = []
+    for dirpath, _, filenames in os.walk(artifact_dir()):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            artifacts.append((stat.st_mtime, stat.st_size, path))
+    return artifacts
+
+def _limit():
+    """Returns the configured size cap of the store in bytes."""
+    return int(float(scriptorium.CONFIG['ARTIFACT_CACHE_MB']) * 1048576)
+
+def stats():
+    """Summarizes the contents of the store."""
+    artifacts = _artifacts()
+    return {
+        'dir': artifact_dir(),
+        'count': len(artifacts),
+        'bytes': sum(ii[1] for ii in artifacts),
+        'limit': _limit()
+    }
+
+def prune(max_bytes=None):
+    """Evicts least recently used PDFs until the store fits in max_bytes, defaulting to the
+    configured size cap. Returns the number of PDFs evicted and the bytes they freed.
+    """
+    if max_bytes is None:
+        max_bytes = _limit()
+    artifacts = sorted(_artifacts())
+    total = sum(ii[1] for ii in artifacts)
+    removed, freed = 0, 0
+    for _, size, path in artifacts:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+        freed += size
+    return removed, freed
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Building papers from an asyncio event loop, on Python 3.5 or newer."""
+
+import asyncio
+import functools
+import os
+import subprocess
+
+from scriptorium import papers
+from scriptorium.profiling import NullProfiler, wait_child
+
+async def _start(step):
+    """Starts a subprocess step, returning the process, a stream of its output, and the transport
+    reading that output through the event loop, if any.
+
+    Where the platform reports the resource usage of reaped children, the process is started with
+    subprocess and its output read through the event loop, so that it can be reaped by wait_child
+    rather than by asyncio, which discards the usage.
+    """
+    if not hasattr(os, 'wait4'):
+        proc = await asyncio.create_subprocess_exec(*step.cmd, stdout=asyncio.subprocess.PIPE,
+                                                    env=step.env, cwd=step.cwd)
+        return proc, proc.stdout, None
+    loop = asyncio.get_event_loop()
+    proc = subprocess.Popen(step.cmd, stdout=subprocess.PIPE, env=step.env, cwd=step.cwd)
+    stdout = asyncio.StreamReader()
+    try:
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdout),
+                                                    proc.stdout)
+    except BaseException:
+        proc.kill()
+        wait_child(proc)
+        raise
+    return proc, stdout, transport
+
+async def _wait(proc, transport):
+    """Waits for a process started by _start to exit, returning its resource usage if known."""
+    if transport is None:
+        await proc.wait()
+        return None
+    transport.close()
+    #Output has ended or the process was killed by now, so the wait is short
+    return await asyncio.get_event_loop().run_in_executor(None, wait_child, proc)
+
+async def _run(step, profiler):
+    """Runs a subprocess step, killing the child if the build is cancelled or its log shows a
+    fatal error, and reporting its resource usage to the profiler.
+    """
+    proc, stdout, transport = await _start(step)
+    try:
+        if step.log is None:
+            output = await stdout.read()
+        else:
+            output = None
+            while True:
+                line = await stdout.readline()
+                if not line:
+                    break
+                if step.log.feed(line):
+                    proc.kill()
+                    break
+            step.log.close()
+        profiler.child(await _wait(proc, transport))
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await _wait(proc, transport)
+        raise
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, step.cmd, output=output)
+    return output
+
+class Builder(object):
+    """Builds a single paper without blocking the event loop.
+
+    Each build runs its LaTeX passes and other tools as asyncio subprocesses in the output
+    directory, without changing the working directory of the process, so one event loop can drive
+    many builds concurrently. Blocking work such as conversion runs in executor, or the loop's
+    default executor if None, with MultiMarkdown files converted in pool if a process pool is
+    given. If timeout is given, builds taking longer than that many seconds are cancelled and
+    raise asyncio.TimeoutError. Cancelling a build kills its running subprocess.
+    Remaining keyword arguments are those of to_pdf.
+    """
+    def __init__(self, paper_dir, template_dir=None, executor=None, timeout=None, pool=None,
+                 **kwargs):
+        self.paper_dir = paper_dir
+        self.template_dir = template_dir
+        self.executor = executor
+        self.pool = pool
+        self.timeout = timeout
+        self.kwargs = kwargs
+
+    async def build(self):
+        """Builds the paper, returning the PDF filename if successful."""
+        if self.timeout is None:
+            return await self._build()
+        return await asyncio.wait_for(self._build(), self.timeout)
+
+    async def _build(self):
+        """Drives the build steps of the paper to completion."""
+        loop = asyncio.get_event_loop()
+        profiler = self.kwargs.get('profiler') or NullProfiler()
+        kwargs = dict(self.kwargs, profiler=profiler, pool=self.pool)
+        steps = papers._build_steps(self.paper_dir, self.template_dir, **kwargs)
+        result, error = None, None
+        try:
+            while True:
+                step = steps.throw(error) if error else steps.send(result)
+                result, error = None, None
+                try:
+                    if isinstance(step, papers._Run):
+                        result = await _run(step, profiler)
+                    elif isinstance(step, papers._Call):
+                        result = await loop.run_in_executor(self.executor,
+                                                            functools.partial(step.func, *step.args))
+                    else:
+                        return step
+                except Exception as exc:
+                    error = exc
+        finally:
+            steps.close()
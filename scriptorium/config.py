@@ -2,7 +2,6 @@
 """Configuration related functionality for scriptorium."""
 
 import os
-import yaml
 
 import scriptorium
 
@@ -11,18 +10,92 @@ _CFG_FILE = os.path.join(_DEFAULT_DIR, 'config')
 
 _DEFAULT_CFG = {
     'TEMPLATE_DIR': os.path.join(_DEFAULT_DIR, 'templates'),
-    'LATEX_CMD': 'xelatex'
+    'LATEX_CMD': 'xelatex',
+    'MAX_PASSES': 5,
+    'ARTIFACT_DIR': os.path.join(_DEFAULT_DIR, 'artifacts'),
+    'ARTIFACT_CACHE_MB': 1024
 }
 
+class LazyConfig(dict):
+    """Configuration dictionary which reads the configuration file on first use."""
+    def __init__(self, defaults):
+        dict.__init__(self, defaults)
+        self._loaded = False
+
+    def _load(self):
+        """Reads configuration file the first time it is needed."""
+        if not self._loaded:
+            self._loaded = True
+            read_config()
+
+    def __getitem__(self, key):
+        self._load()
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._load()
+        dict.__setitem__(self, key, value)
+
+    def __contains__(self, key):
+        self._load()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self._load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+
+    def __eq__(self, other):
+        self._load()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._load()
+        return dict.__repr__(self)
+
+    def get(self, key, default=None):
+        self._load()
+        return dict.get(self, key, default)
+
+    def keys(self):
+        self._load()
+        return dict.keys(self)
+
+    def values(self):
+        self._load()
+        return dict.values(self)
+
+    def items(self):
+        self._load()
+        return dict.items(self)
+
+    def update(self, *args, **kwargs):
+        self._load()
+        dict.update(self, *args, **kwargs)
+
+    def copy(self):
+        """Returns a plain dictionary of the loaded configuration."""
+        self._load()
+        return dict(dict.items(self))
+
 def _sanitize_paths(cfg):
     """Ensure that paths in configuration options have ~ symbols expanded."""
     cfg['TEMPLATE_DIR'] = os.path.expanduser(cfg['TEMPLATE_DIR'])
 
 def read_config():
     """Read configuration values for scriptorium."""
+    import yaml
+    if isinstance(scriptorium.CONFIG, LazyConfig):
+        scriptorium.CONFIG._loaded = True
     try:
         with open(_CFG_FILE, 'r') as cfg_fp:
-            cfg = yaml.load(cfg_fp)
+            cfg = yaml.safe_load(cfg_fp) or {}
             scriptorium.CONFIG.update(cfg)
             _sanitize_paths(scriptorium.CONFIG)
     except EnvironmentError:
@@ -37,6 +110,7 @@ def read_config():
 
 def save_config():
     """Save configuration values for scriptorium."""
+    import yaml
     _sanitize_paths(scriptorium.CONFIG)
     with open(_CFG_FILE, 'w') as cfg_fp:
-        yaml.dump(scriptorium.CONFIG, cfg_fp)
+        yaml.dump(scriptorium.CONFIG.copy(), cfg_fp)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Finding every file a paper's build reads, for external build systems."""
+
+import io
+import os
+import os.path
+import re
+
+import scriptorium
+from scriptorium.flatten import _split_comment
+from scriptorium.papers import _bib_files, _bib_resources, _build_latex_cmd, _conversion_key, \
+                               _convert_source, _find_input, _list_files, paper_root
+from scriptorium.state import hash_file, load_state
+
+_COMMAND_RE = re.compile(r'\\(?P<cmd>input|include|includegraphics|documentclass|LoadClass|'
+                         r'usepackage|RequirePackage|bibliography|bibliographystyle|'
+                         r'addbibresource)(?![A-Za-z@])\*?\s*(?:\[[^\]]*\]\s*)?'
+                         r'(?:\{(?P<braced>[^}]*)\}|(?P<bare>[^\s\\{}%]+))')
+_GRAPHICSPATH_RE = re.compile(r'\\graphicspath\s*\{(?P<dirs>(?:\s*\{[^}]*\})*)\s*\}')
+_GRAPHICS_DIR_RE = re.compile(r'\{(?P<path>[^}]*)\}')
+
+#Extensions tried, in order, for files named without one
+_EXTENSIONS = {
+    'input': ['.tex', ''],
+    'include': ['.tex'],
+    'includegraphics': ['', '.pdf', '.png', '.jpg', '.jpeg', '.eps', '.mps'],
+    'documentclass': ['.cls'],
+    'LoadClass': ['.cls'],
+    'usepackage': ['.sty'],
+    'RequirePackage': ['.sty'],
+    'bibliography': ['.bib'],
+    'addbibresource': [''],
+    'bibliographystyle': ['.bst']
+}
+_VARS = {'bibliography': 'BIBINPUTS', 'addbibresource': 'BIBINPUTS',
+         'bibliographystyle': 'BSTINPUTS'}
+
+def _latex_sources(paper_dir, out_dir):
+    """Reads the LaTeX converted from each MultiMarkdown file, along with the files it transcludes.
+
+    Conversions are taken from the output directory when they are current, and otherwise converted
+    in memory, so the paper need not have been built.
+    """
+    import pymmd
+    cache = load_state(out_dir, 'convert')
+    texts = {}
+    transcluded = []
+    for mmd in sorted(_list_files(paper_dir)):
+        with open(mmd, 'r') as mmd_fp:
+            text = mmd_fp.read()
+        tex_name = os.path.join(out_dir, '{0}.tex'.format(os.path.basename(mmd).split('.')[0]))
+        entry = cache.get(mmd)
+        if entry and entry['key'] == _conversion_key(text, pymmd.SMART) and \
+           entry['tex'] == hash_file(tex_name) and \
+           all(hash_file(dep) == digest for dep, digest in entry['deps'].items()):
+            with io.open(tex_name, 'r', encoding='utf-8', errors='replace') as tex_fp:
+                texts[tex_name] = tex_fp.read()
+            transcluded += list(entry['deps'])
+        else:
+            texts[tex_name], deps = _convert_source(mmd, text, pymmd.SMART)
+            transcluded += deps
+    return texts, transcluded
+
+def _references(text):
+    """Lists the files a LaTeX file refers to, as tuples of command and name, along with any
+    directories it adds to the graphics search path.
+    """
+    refs = []
+    graphics_dirs = []
+    for line in text.splitlines():
+        code, _ = _split_comment(line)
+        for match in _GRAPHICSPATH_RE.finditer(code):
+            graphics_dirs += [ii.group('path') for ii in
+                              _GRAPHICS_DIR_RE.finditer(match.group('dirs'))]
+        for match in _COMMAND_RE.finditer(code):
+            cmd = match.group('cmd')
+            arg = match.group('braced') if match.group('braced') is not None else \
+                  match.group('bare')
+            if cmd in ('input', 'include', 'includegraphics', 'addbibresource'):
+                refs.append((cmd, arg.strip()))
+            else:
+                refs += [(cmd, ii.strip()) for ii in arg.split(',') if ii.strip()]
+    return refs, graphics_dirs
+
+def _resolve(cmd, name, env, cwd, graphics_dirs):
+    """Finds the file a command refers to the way TeX would, or None if it is not found."""
+    var = _VARS.get(cmd, 'TEXINPUTS')
+    prefixes = [''] + graphics_dirs if cmd == 'includegraphics' else ['']
+    for prefix in prefixes:
+        for ext in _EXTENSIONS[cmd]:
+            candidate = prefix + name + ext
+            if cmd == 'includegraphics' and not ext and not os.path.splitext(name)[1]:
+                continue
+            path = _find_input(candidate, var, env, cwd)
+            if path and os.path.isfile(path):
+                return os.path.abspath(path)
+    return None
+
+def paper_dependencies(paper_dir, template_dir=None, build_dir=None):
+    """Lists every file read when building the paper in paper_dir.
+
+    This covers the MultiMarkdown sources and their transclusions, and everything reachable from
+    the converted LaTeX through \\input, \\include, \\includegraphics, classes, packages, and
+    bibliography databases and styles, searched for along the paths used by the build. Files
+    outside those paths, such as those in the TeX distribution, are left out.
+    """
+    template_dir = template_dir or scriptorium.CONFIG['TEMPLATE_DIR']
+    paper_dir = os.path.abspath(paper_dir)
+    root = paper_root(paper_dir)
+    if not root:
+        raise IOError('{0} has no obvious root.'.format(paper_dir))
+    root = os.path.join(paper_dir, root)
+    out_dir = os.path.abspath(build_dir) if build_dir else paper_dir
+    bname = os.path.basename(root).split('.')[0]
+
+    _, env = _build_latex_cmd(root, template_dir,
+                              source_dir=paper_dir if out_dir != paper_dir else None)
+    texts, transcluded = _latex_sources(paper_dir, out_dir)
+    deps = set(os.path.abspath(ii) for ii in _list_files(paper_dir) + transcluded)
+    deps.update(_bib_files(root))
+    _, resources = _bib_resources(bname, out_dir)
+    for name, var in resources:
+        path = _find_input(name, var, env, out_dir)
+        if path:
+            deps.add(os.path.abspath(path))
+
+    pending = [os.path.join(out_dir, '{0}.tex'.format(bname))]
+    seen = set(pending)
+    graphics_dirs = []
+    while pending:
+        fname = pending.pop()
+        text = texts.get(fname)
+        if text is None:
+            try:
+                with io.open(fname, 'r', encoding='utf-8', errors='replace') as tex_fp:
+                    text = tex_fp.read()
+            except EnvironmentError:
+                continue
+        refs, dirs = _references(text)
+        graphics_dirs += [ii for ii in dirs if ii not in graphics_dirs]
+        for cmd, name in refs:
+            path = _resolve(cmd, name, env, out_dir, graphics_dirs)
+            if path is None or path in seen:
+                continue
+            seen.add(path)
+            if path not in texts:
+                deps.add(path)
+            if path.endswith(('.tex', '.sty', '.cls')):
+                pending.append(path)
+    return sorted(deps)
+
+def _escape(path):
+    """Escapes a path for use in a Make or Ninja depfile."""
+    path = path.replace('\\', '/') if os.name == 'nt' else path
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+def _display(path, start):
+    """Shortens paths below start to be relative to it."""
+    rel = os.path.relpath(path, start)
+    return path if rel.startswith(os.pardir) else rel
+
+def format_depfile(target, deps, start=None):
+    """Formats a depfile rule making target depend on deps, with paths below start made relative."""
+    start = start or os.getcwd()
+    lines = ['{0}:'.format(_escape(_display(os.path.abspath(target), start)))]
+    lines += [' ' + _escape(_display(ii, start)) for ii in deps]
+    return ' \\\n'.join(lines) + '\n'
+
+def write_depfile(depfile, target, deps):
+    """Writes a depfile rule making target depend on deps."""
+    with open(depfile, 'w') as dep_fp:
+        dep_fp.write(format_depfile(target, deps))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Publishing a paper in several formats at once."""
+
+import io
+import os
+import os.path
+import zipfile
+
+import scriptorium
+from scriptorium.papers import _MMD_LOCK, _build_products, _convert_paper, _list_files, \
+                               _record_outputs, _record_published, get_template, paper_root, to_pdf
+
+FORMATS = ('pdf', 'html', 'tex')
+
+#Files folded into the converted LaTeX, which a source bundle has no use for
+_SOURCE_EXTS = ('.mmd', '.md', '.txt')
+
+def _to_html(root, dest):
+    """Converts the paper rooted at root to a standalone HTML document, transcluding its files.
+
+    Only the root and the files it transcludes are covered. Files the LaTeX of the root pulls in
+    with \\input, as converted separately for the PDF, have no HTML counterpart to refer to.
+    """
+    import pymmd
+    with io.open(root, 'r', encoding='utf-8') as mmd_fp:
+        text = mmd_fp.read()
+    #Conversions for the PDF may be running in other threads
+    with _MMD_LOCK:
+        html = pymmd.convert(text, ext=pymmd.SMART | pymmd.COMPLETE, fmt=pymmd.HTML, dname=root)
+    with io.open(dest, 'w', encoding='utf-8') as html_fp:
+        html_fp.write(html)
+    return dest
+
+def _bundle_names(paper_dir, out_dir, root, template_dir, build_dir):
+    """Maps the files needed to rebuild the paper with LaTeX alone to their names in a bundle."""
+    from scriptorium.deps import paper_dependencies
+    bname = os.path.basename(root).split('.')[0]
+    names = {}
+    for source in _list_files(paper_dir):
+        tex_name = '{0}.tex'.format(os.path.basename(source).split('.')[0])
+        names[os.path.join(out_dir, tex_name)] = tex_name
+    bbl = os.path.join(out_dir, '{0}.bbl'.format(bname))
+    if os.path.exists(bbl):
+        names[bbl] = os.path.basename(bbl)
+
+    template = get_template(root)
+    template_loc = scriptorium.find_template(template, template_dir) if template else None
+    template_loc = os.path.abspath(os.path.join(template_loc, '..')) if template_loc else None
+    for path in paper_dependencies(paper_dir, template_dir, build_dir):
+        if path.endswith(_SOURCE_EXTS):
+            continue
+        for base in [paper_dir, template_loc]:
+            if base and not os.path.relpath(path, base).startswith(os.pardir):
+                names[path] = os.path.relpath(path, base)
+                break
+        else:
+            names[path] = os.path.basename(path)
+    return names
+
+def _to_bundle(paper_dir, out_dir, root, template_dir, build_dir, dest, jobs, convert=True):
+    """Zips the converted LaTeX of a paper together with everything LaTeX reads to build it,
+    converting the paper first if convert is set.
+    """
+    if convert:
+        _convert_paper(paper_dir, out_dir, jobs)
+    names = _bundle_names(paper_dir, out_dir, root, template_dir, build_dir)
+    with zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for path in sorted(names, key=names.get):
+            bundle.write(path, names[path].replace(os.sep, '/'))
+    return dest
+
+def export(paper_dir, formats=FORMATS, template_dir=None, dest_dir=None, **kwargs):
+    """Publishes the paper in paper_dir in each of the given formats concurrently.
+
+    The PDF is built with to_pdf, taking the remaining keyword arguments. The HTML document and the
+    zipped LaTeX source bundle are written to dest_dir, defaulting to the paper directory. The
+    bundle reuses the LaTeX written by the PDF build, flattened if asked for, and its bibliography
+    rather than producing them again. Like the PDF, exported files written within the output
+    directory are recorded as published outputs, which clean keeps. Returns dictionary of the
+    output filename of each format.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if not formats:
+        raise ValueError('No formats to export')
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError('Unknown formats {0}'.format(', '.join(sorted(unknown))))
+
+    template_dir = template_dir or scriptorium.CONFIG['TEMPLATE_DIR']
+    paper_dir = os.path.abspath(paper_dir)
+    root = paper_root(paper_dir)
+    if not root:
+        raise IOError('{0} has no obvious root.'.format(paper_dir))
+    root = os.path.join(paper_dir, root)
+    bname = os.path.basename(root).split('.')[0]
+    build_dir = kwargs.get('build_dir')
+    out_dir = os.path.abspath(build_dir) if build_dir else paper_dir
+    dest_dir = dest_dir or paper_dir
+    #Builds record their own outputs, but a bundle without one converts the paper itself
+    before = _build_products(out_dir, paper_dir, bname) \
+             if 'pdf' not in formats and os.path.isdir(out_dir) else set()
+
+    with ThreadPoolExecutor(max_workers=len(formats)) as pool:
+        futures = {}
+        if 'pdf' in formats:
+            futures['pdf'] = pool.submit(to_pdf, paper_dir, template_dir, **kwargs)
+        if 'html' in formats:
+            futures['html'] = pool.submit(_to_html, root,
+                                          os.path.join(dest_dir, '{0}.html'.format(bname)))
+        if 'tex' in formats:
+            def bundle():
+                """Waits for the PDF build to finish with the output directory, then bundles."""
+                if 'pdf' in futures:
+                    futures['pdf'].exception()
+                dest = os.path.join(dest_dir, '{0}-source.zip'.format(bname))
+                #Converting again after a build would undo flattening of the root LaTeX
+                return _to_bundle(paper_dir, out_dir, root, template_dir, build_dir, dest,
+                                  kwargs.get('jobs', 1), 'pdf' not in futures)
+            futures['tex'] = pool.submit(bundle)
+
+        outputs = {}
+        errors = {}
+        for fmt in FORMATS:
+            if fmt not in futures:
+                continue
+            try:
+                outputs[fmt] = futures[fmt].result()
+            except Exception as exc:
+                errors[fmt] = exc
+
+    if 'pdf' not in formats and os.path.isdir(out_dir):
+        _record_outputs(out_dir, paper_dir, bname, before)
+    _record_published(out_dir, [outputs[fmt] for fmt in FORMATS if fmt in outputs and fmt != 'pdf'])
+    if errors:
+        raise IOError('\n'.join(['Could not export {0}: {1}'.format(fmt, errors[fmt])
+                                 for fmt in FORMATS if fmt in errors]))
+    return outputs
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Expanding \\input and \\include into a single LaTeX document."""
+
+import io
+import os
+import os.path
+import re
+import tempfile
+
+from scriptorium.papers import _find_input
+from scriptorium.state import hash_bytes, load_state, save_state
+
+_INCLUDE_RE = re.compile(r'\\(?P<cmd>input|include)(?:\s*\{(?P<braced>[^}]*)\}|'
+                         r'\s+(?P<bare>[^\s\\{}%]+))')
+_BEGIN_VERBATIM_RE = re.compile(r'\\begin\{(?P<env>verbatim\*?|Verbatim|lstlisting|minted)\}')
+_ENDINPUT_RE = re.compile(r'\\endinput(?![A-Za-z@])')
+_COMMENT_RE = re.compile(r'(?<!\\)(?:\\\\)*%')
+
+def _split_comment(line):
+    """Splits a line into its code and the comment following it, if any."""
+    match = _COMMENT_RE.search(line)
+    if not match:
+        return line, None
+    return line[:match.end() - 1], line[match.end() - 1:]
+
+def _parse(text, keep_comments):
+    """Splits LaTeX text into segments of literal text and [command, name] inclusions.
+
+    Unless keep_comments is set, comments are removed, leaving the % so that line ends stay
+    insignificant, and lines holding only a comment are dropped. Verbatim environments are kept as
+    they are, and everything after \\endinput is skipped.
+    """
+    segments = []
+    literal = []
+    verbatim = None
+    for line in text.splitlines(True):
+        if verbatim:
+            literal.append(line)
+            if '\\end{{{0}}}'.format(verbatim) in line:
+                verbatim = None
+            continue
+
+        body = line.rstrip('\r\n')
+        newline = line[len(body):]
+        code, comment = _split_comment(body)
+        if comment is not None and not keep_comments:
+            if not code.strip():
+                continue
+            body = code + '%'
+
+        match = _BEGIN_VERBATIM_RE.search(code)
+        if match and '\\end{{{0}}}'.format(match.group('env')) not in code[match.end():]:
+            verbatim = match.group('env')
+
+        end = _ENDINPUT_RE.search(code)
+        if end:
+            code = code[:end.start()]
+            body = code
+
+        pos = 0
+        for match in _INCLUDE_RE.finditer(code):
+            literal.append(body[pos:match.start()])
+            if literal:
+                segments.append(''.join(literal))
+                literal = []
+            segments.append([match.group('cmd'),
+                             (match.group('braced') or match.group('bare')).strip()])
+            pos = match.end()
+        literal.append(body[pos:] + newline)
+        if end:
+            break
+
+    if literal:
+        segments.append(''.join(literal))
+    return [ii for ii in segments if ii != '']
+
+class _Flattener(object):
+    """Expands a document, reusing the parsed segments of files which have not changed."""
+    def __init__(self, cwd, env, keep_comments, state):
+        self.cwd = cwd
+        self.env = env
+        self.keep_comments = keep_comments
+        self.old_files = state.get('files', {})
+        self.old_parsed = state.get('parsed', {})
+        self.files = {}
+        self.parsed = {}
+        self.found = {}
+
+    def _resolve(self, cmd, name):
+        """Finds the file an inclusion refers to the way TeX would, or None if it cannot be found."""
+        if (cmd, name) not in self.found:
+            names = [name + '.tex'] if cmd == 'include' or not os.path.splitext(name)[1] else []
+            path = None
+            for candidate in names + [name]:
+                path = _find_input(candidate, 'TEXINPUTS', self.env, self.cwd)
+                if path:
+                    path = os.path.abspath(path)
+                    break
+            self.found[(cmd, name)] = path
+        return self.found[(cmd, name)]
+
+    def _segments(self, path):
+        """Parses a file, skipping files whose size and modification time are unchanged."""
+        stat = os.stat(path)
+        entry = self.old_files.get(path)
+        key = entry and '{0}:{1}'.format(entry['hash'], int(self.keep_comments))
+        if not entry or entry['stat'] != [stat.st_mtime, stat.st_size] or \
+           key not in self.old_parsed:
+            with io.open(path, 'r', encoding='utf-8', errors='surrogateescape') as tex_fp:
+                text = tex_fp.read()
+            entry = {'stat': [stat.st_mtime, stat.st_size], 'hash': hash_bytes(text.encode(
+                'utf-8', 'surrogateescape'))}
+            key = '{0}:{1}'.format(entry['hash'], int(self.keep_comments))
+            if key not in self.old_parsed:
+                self.old_parsed[key] = _parse(text, self.keep_comments)
+        self.files[path] = entry
+        self.parsed[key] = self.old_parsed[key]
+        return self.parsed[key]
+
+    def expand(self, path, stack=()):
+        """Generates the expanded text of a file in pieces."""
+        if path in stack:
+            raise IOError('{0} includes itself'.format(path))
+        stack = stack + (path,)
+        for segment in self._segments(path):
+            if not isinstance(segment, list):
+                yield segment
+                continue
+            cmd, name = segment
+            child = self._resolve(cmd, name)
+            if child is None:
+                #Leave anything TeX would find elsewhere, such as in the TeX distribution
+                yield '\\{0}{{{1}}}'.format(cmd, name)
+                continue
+            if cmd == 'include':
+                yield '\\clearpage{}'
+            for piece in self.expand(child, stack):
+                yield piece
+            if cmd == 'include':
+                yield '\\clearpage{}'
+
+def flatten_file(fname, env, keep_comments=False):
+    """Replaces a LaTeX file with a copy in which every \\input and \\include is expanded.
+
+    Included files are searched for from the directory of fname along TEXINPUTS in env, as TeX
+    does, and inclusions of files which cannot be found are left in place. The parsed contents of
+    each file are cached in the build state by content, so reflattening only reads files which
+    changed since the last time.
+    """
+    fname = os.path.abspath(fname)
+    out_dir = os.path.dirname(fname)
+    flattener = _Flattener(out_dir, env, keep_comments, load_state(out_dir, 'flatten'))
+
+    fdesc, tmp_name = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    try:
+        with io.open(fdesc, 'w', encoding='utf-8', errors='surrogateescape') as tex_fp:
+            for piece in flattener.expand(fname):
+                tex_fp.write(piece)
+        if os.name == 'nt':
+            os.remove(fname)
+        os.rename(tmp_name, fname)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    #The flattened output replaced the root document, so its entry no longer describes it
+    flattener.files.pop(fname, None)
+    try:
+        save_state(out_dir, 'flatten', {'files': flattener.files, 'parsed': flattener.parsed})
+    except EnvironmentError:
+        pass
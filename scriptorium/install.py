@@ -6,10 +6,12 @@ import platform
 from collections import defaultdict
 from scriptorium import CONFIG
 
-REQUIRED_PACKAGES = {
-    'git': ['git'],
-    'latex': [CONFIG['LATEX_CMD'], 'biber']
-}
+def required_packages():
+    """Maps packages to the binaries they provide, using the configured LaTeX command."""
+    return {
+        'git': ['git'],
+        'latex': [CONFIG['LATEX_CMD'], 'biber']
+    }
 
 SPLIT_TOKENS = {
     'Windows' : ';',
@@ -39,7 +41,7 @@ def find_missing_packages():
     returning dict of packages to binaries found missing.
     """
     missing_packages = {}
-    for package, binaries in REQUIRED_PACKAGES.items():
+    for package, binaries in required_packages().items():
         if not find_binaries(binaries):
             if package not in missing_packages:
                 missing_packages[package] = []
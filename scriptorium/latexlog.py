@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Incremental parsing of LaTeX output into errors and warnings."""
+
+import collections
+import re
+
+Event = collections.namedtuple('Event', ['kind', 'message', 'file', 'line', 'context'])
+
+_FILE_LINE_ERROR_RE = re.compile(r'^(?P<file>[^:\s][^:]*\.\w+):(?P<line>\d+): (?P<message>.*)$')
+_CONTEXT_RE = re.compile(r'^l\.(?P<line>\d+)')
+_REFERENCE_RE = re.compile(r"Reference `(?P<key>[^']*)' on page \S+ undefined"
+                           r"(?: on input line (?P<line>\d+))?")
+_CITATION_RE = re.compile(r"Citation `(?P<key>[^']*)'(?: on page \S+)? undefined"
+                          r"(?: on input line (?P<line>\d+))?")
+_OVERFULL_RE = re.compile(r'^Overfull \\[hv]box \([^)]*\)(?: in \w+ at lines? (?P<line>\d+))?')
+
+#Lines of output kept to explain failures which produce no recognizable error
+_TAIL_LINES = 20
+#Lines after an error searched for the l.NNN line showing where it occurred
+_CONTEXT_LINES = 20
+
+class LatexError(IOError):
+    """Failure of a LaTeX run, described by the errors and warnings parsed from its output."""
+    def __init__(self, events, tail):
+        self.events = events
+        self.errors = [ii for ii in events if ii.kind == 'error']
+        self.tail = tail
+        IOError.__init__(self, self._describe())
+
+    def _describe(self):
+        """Formats the first error, or the end of the output if no error was recognized."""
+        if not self.errors:
+            return '\n'.join(self.tail)
+        error = self.errors[0]
+        location = ':'.join(str(ii) for ii in [error.file, error.line] if ii is not None)
+        lines = ['{0}: {1}'.format(location, error.message) if location else error.message]
+        return '\n'.join(lines + list(error.context))
+
+class LatexLog(object):
+    """Parses LaTeX output line by line, collecting errors and warnings as they appear.
+
+    If listener is given, it is called with each event as soon as it is parsed. Only the events
+    and the last few lines of output are kept, rather than the whole log.
+    """
+    def __init__(self, listener=None):
+        self.listener = listener
+        self.events = []
+        self.tail = collections.deque(maxlen=_TAIL_LINES)
+        self.fatal = False
+        self._error = None
+
+    def _emit(self, event):
+        """Records an event and passes it on to the listener."""
+        self.events.append(event)
+        if event.kind == 'error':
+            self.fatal = True
+        if self.listener:
+            self.listener(event)
+
+    def _finish_error(self, line=None):
+        """Emits the error being collected."""
+        kind, message, fname, err_line, context, _ = self._error
+        self._error = None
+        self._emit(Event(kind, message, fname, line if err_line is None else err_line,
+                         tuple(context)))
+
+    def feed(self, line):
+        """Parses a line of output, returning whether a fatal error has been seen."""
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        line = line.rstrip('\r\n')
+        self.tail.append(line)
+
+        if self._error is not None:
+            match = _CONTEXT_RE.match(line)
+            self._error[5] += 1
+            if line.strip():
+                self._error[4].append(line)
+            if match:
+                self._finish_error(int(match.group('line')))
+            elif self._error[5] >= _CONTEXT_LINES:
+                self._finish_error()
+            return self.fatal
+
+        if line.startswith('! '):
+            self._error = ['error', line[2:].strip(), None, None, [], 0]
+            return self.fatal
+        match = _FILE_LINE_ERROR_RE.match(line)
+        if match:
+            self._error = ['error', match.group('message').strip(), match.group('file'),
+                           int(match.group('line')), [], 0]
+            return self.fatal
+
+        match = _REFERENCE_RE.search(line)
+        if match:
+            self._emit(Event('undefined reference', match.group('key'), None,
+                             int(match.group('line')) if match.group('line') else None, ()))
+            return self.fatal
+        match = _CITATION_RE.search(line)
+        if match:
+            self._emit(Event('undefined citation', match.group('key'), None,
+                             int(match.group('line')) if match.group('line') else None, ()))
+            return self.fatal
+        match = _OVERFULL_RE.match(line)
+        if match:
+            self._emit(Event('overfull box', line.strip(), None,
+                             int(match.group('line')) if match.group('line') else None, ()))
+        return self.fatal
+
+    def close(self):
+        """Finishes parsing once the output has ended."""
+        if self._error is not None:
+            self._finish_error()
+
+    def error(self):
+        """Builds the exception describing a failed run."""
+        self.close()
+        return LatexError(list(self.events), list(self.tail))
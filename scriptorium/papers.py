@@ -5,61 +5,216 @@ import glob
 import subprocess
 import re
 import locale
+import io
 import os
 import shutil
 import platform
-import tempfile
-import mmap
+import threading
 
-import sys
+import scriptorium
+from scriptorium.latexlog import LatexLog
+from scriptorium.profiling import NullProfiler, wait_child
+from scriptorium.state import STATE_DIR, load_state, save_state, hash_bytes, hash_file
 
-import pymmd
+_META_RE = re.compile(r'^(?P<key>[A-Za-z0-9][^:]*):(?P<value>.*)$')
 
-import scriptorium
+#Outputs which feed back into the next LaTeX pass, besides the .aux files
+_RERUN_EXTS = ['toc', 'lof', 'lot', 'out', 'bbl', 'gls', 'acr', 'glsdefs']
 
-_BLANK_LINE = bytes('\n\n', 'utf-8') if sys.version_info >= (3,0) else '\n\n'
+#Extensions of the files which could be converted via MultiMarkdown
+_SOURCE_EXTS = ('.mmd', '.md', '.txt')
 
 def _list_files(dname):
     """Builds list of all files which could be converted via MultiMarkdown."""
-    fexts = ['mmd', 'md', 'txt']
-    return [ii for jj in fexts for ii in glob.glob(os.path.join(dname, '*.' + jj))]
+    return [ii for jj in _SOURCE_EXTS for ii in glob.glob(os.path.join(dname, '*' + jj))]
+
+#Root documents found by paper_root, keyed by directory
+_ROOTS = {}
 
 def paper_root(dname):
-    """Given a directory, finds the root document for the paper."""
+    """Given a directory, finds the root document for the paper.
+
+    The result is cached in memory, and reused until files are added, removed, or modified. Nothing
+    is written to the directory, so looking up a paper never changes its source tree.
+    """
+    if not os.path.isdir(dname):
+        return None
+
+    candidates = _list_files(dname)
+    stamp = {os.path.basename(ii): os.stat(ii).st_mtime for ii in candidates}
+    stamp['.'] = os.stat(dname).st_mtime
+
+    key = os.path.abspath(dname)
+    cached = _ROOTS.get(key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
     root_doc = None
 
-    for fname in _list_files(dname):
+    for fname in candidates:
         #Template metadata only exists in root
         if get_template(fname):
             root_doc = fname
             break
 
-    return os.path.basename(root_doc) if root_doc else None
+    root = os.path.basename(root_doc) if root_doc else None
+    _ROOTS[key] = (stamp, root)
+    return root
+
+def _conversion_key(text, ext):
+    """Builds key identifying a MultiMarkdown to LaTeX conversion of the given text."""
+    import pymmd
+    return hash_bytes('\n'.join([pymmd.version(), str(ext), str(pymmd.LATEX), text]))
+
+#libMultiMarkdown is not known to be thread safe, so each process converts one file at a time
+_MMD_LOCK = threading.Lock()
+
+def _convert_source(mmd, text, ext):
+    """Converts MultiMarkdown text to LaTeX, returning the LaTeX and any transcluded files."""
+    import pymmd
+    dname = os.path.dirname(mmd)
+    with _MMD_LOCK:
+        tex = pymmd.convert(text, fmt=pymmd.LATEX, dname=mmd, ext=ext)
+        deps = [os.path.join(dname, ii) for ii in pymmd.manifest(text, dname)]
+    return tex, deps
+
+def _convert_sources(sources, out_dir, cache, jobs=1, ext=None, pool=None):
+    """Converts MultiMarkdown files to LaTeX files in out_dir, using up to jobs processes.
+
+    Conversions are skipped when cache shows the source, its transclusions, and the existing
+    LaTeX output are unchanged. If pool is given, conversions are submitted to that process pool
+    instead of starting one. Returns list of LaTeX files which were rewritten.
+    """
+    import pymmd
+    ext = pymmd.SMART if ext is None else ext
+    pending = {}
+    for mmd in sorted(sources):
+        with open(mmd, 'r') as mmd_fp:
+            text = mmd_fp.read()
+        key = _conversion_key(text, ext)
+        tex_name = os.path.join(out_dir, '{0}.tex'.format(os.path.basename(mmd).split('.')[0]))
+        entry = cache.get(mmd)
+        if entry and entry['key'] == key and entry['tex'] == hash_file(tex_name) and \
+           all(hash_file(dep) == digest for dep, digest in entry['deps'].items()):
+            continue
+        pending[mmd] = (tex_name, key, text)
+
+    results = {}
+    errors = {}
+    if pool is not None or (jobs > 1 and len(pending) > 1):
+        from concurrent.futures import ProcessPoolExecutor
+        owned = pool is None
+        pool = ProcessPoolExecutor(max_workers=jobs) if owned else pool
+        try:
+            futures = {mmd: pool.submit(_convert_source, mmd, text, ext)
+                       for mmd, (_, _, text) in pending.items()}
+            for mmd, future in futures.items():
+                try:
+                    results[mmd] = future.result()
+                except Exception as exc:
+                    errors[mmd] = exc
+        finally:
+            if owned:
+                pool.shutdown()
+    else:
+        for mmd, (_, _, text) in pending.items():
+            try:
+                results[mmd] = _convert_source(mmd, text, ext)
+            except Exception as exc:
+                errors[mmd] = exc
+
+    if errors:
+        raise IOError('\n'.join(['Could not convert {0}: {1}'.format(mmd, errors[mmd])
+                                 for mmd in sorted(errors)]))
 
-def _get_template(txt):
-    """Extract template name from string containing document text"""
-    template = pymmd.value(txt, 'latexfooter', pymmd.COMPLETE)
+    written = []
+    for mmd in sorted(results):
+        tex, deps = results[mmd]
+        tex_name, key, _ = pending[mmd]
+        with open(tex_name, 'w') as tex_fp:
+            tex_fp.write(tex)
+        cache[mmd] = {
+            'key': key,
+            'deps': {dep: hash_file(dep) for dep in deps},
+            'tex': hash_file(tex_name)
+        }
+        written.append(tex_name)
+    return written
+
+def _convert_paper(paper_dir, out_dir, jobs=1, pool=None):
+    """Brings the LaTeX converted from every MultiMarkdown file of a paper up to date in out_dir,
+    recording the conversions in the build state. Returns list of LaTeX files which were rewritten.
+    """
+    cache = load_state(out_dir, 'convert')
+    sources = _list_files(paper_dir)
+    written = _convert_sources(sources, out_dir, cache, jobs, None, pool)
+    if written or set(cache) != set(sources):
+        save_state(out_dir, 'convert', {kk:vv for kk, vv in cache.items() if kk in sources})
+    return written
+
+def _normalize_key(key):
+    """Normalizes a metadata key the way MultiMarkdown does."""
+    return re.sub(r'\s', '', key).lower()
+
+def read_frontmatter(fname, keys=None):
+    """Reads MultiMarkdown metadata from the start of a file without parsing the document.
+
+    Reading stops at the first blank line, or once all of the requested keys have been found.
+    Returns dictionary of normalized keys to values, limited to keys if given.
+    """
+    keys = set(_normalize_key(ii) for ii in keys) if keys is not None else None
+    metadata = {}
+    key = None
+    with io.open(fname, 'r', encoding='utf-8', errors='replace') as mmd_fp:
+        for lineno, line in enumerate(mmd_fp):
+            line = line.rstrip('\r\n')
+            if lineno == 0 and line.strip() == '---':
+                continue
+            if not line.strip() or line.strip() in ['---', '...']:
+                break
+            match = _META_RE.match(line)
+            if match:
+                if keys is not None and keys.issubset(metadata):
+                    break
+                key = _normalize_key(match.group('key'))
+                metadata[key] = match.group('value').strip()
+            elif key:
+                #Continuation of the previous value
+                metadata[key] = ' '.join([metadata[key], line.strip()]).strip()
+            else:
+                break
+    if keys is not None:
+        metadata = {kk:vv for kk, vv in metadata.items() if kk in keys}
+    return metadata
+
+def _bib_files(root):
+    """Finds bibliography files named in the paper frontmatter."""
+    bibs = read_frontmatter(root, ['bibtex']).get('bibtex', '')
+    dname = os.path.dirname(root)
+    files = []
+    for bib in [ii.strip() for ii in bibs.split(',') if ii.strip()]:
+        bib = os.path.join(dname, os.path.expanduser(bib))
+        files += [ii for ii in [bib, bib + '.bib'] if os.path.isfile(ii)]
+    return files
+
+def _get_template(footer):
+    """Extract template name from the LaTeX footer metadata value."""
     template_re = re.compile(r'(?P<template>[a-zA-Z0-9._]*)\/footer.tex')
 
-    match = template_re.search(template)
+    match = template_re.search(footer)
 
     return match.group('template') if match else None
 
 def get_template(fname):
     """Attempts to find the template of a paper in a given file."""
-    if os.stat(fname).st_size == 0:
-        return None
-    with open(fname, 'r') as mmd_fp:
-        mmf = mmap.mmap(mmd_fp.fileno(), 0, access=mmap.ACCESS_READ)
-        idx = mmf.find(_BLANK_LINE)
-        if idx == -1:
-            idx = mmf.size()
-        mmf.seek(0)
-        frontmatter = mmf.read(idx).decode('utf-8')
-        return _get_template(frontmatter)
-
-def _build_latex_cmd(fname, template_dir, use_shell_escape=False):
-    """Builds LaTeX command and environment to process a given paper."""
+    footer = read_frontmatter(fname, ['latexfooter']).get('latexfooter')
+    return _get_template(footer) if footer else None
+
+def _build_latex_cmd(fname, template_dir, use_shell_escape=False, source_dir=None):
+    """Builds LaTeX command and environment to process a given paper.
+
+    If source_dir is given, paper files are searched for there after the working directory.
+    """
     bname = os.path.basename(fname).split('.')[0]
     tname = '{0}.tex'.format(bname)
 
@@ -76,172 +231,837 @@ def _build_latex_cmd(fname, template_dir, use_shell_escape=False):
 
     #Need to set up environment here
     new_env = dict(os.environ)
+    #Keep messages on single lines, so the output can be parsed as it arrives
+    new_env['max_print_line'] = '10000'
 
     for ii in ['TEXINPUTS', 'BIBINPUTS', 'BSTINPUTS']:
         old_inputs = new_env.get(ii)
         old_inputs = old_inputs + ':' if old_inputs else ''
-        inputs = './:{0}:{1}'.format(template_loc + '/.//', old_inputs)
+        sources = source_dir + ':' if source_dir else ''
+        inputs = './:{0}{1}:{2}'.format(sources, template_loc + '/.//', old_inputs)
         new_env[ii] = inputs
 
-    pdf_cmd = [scriptorium.CONFIG['LATEX_CMD'], '-halt-on-error', '-interaction=nonstopmode', tname]
+    pdf_cmd = [scriptorium.CONFIG['LATEX_CMD'], '-halt-on-error', '-interaction=nonstopmode',
+               '-file-line-error', tname]
 
     if platform.system() == 'Windows':
         pdf_cmd.insert(-2, '-include-directory={0}'.format(template_loc))
+        if source_dir:
+            pdf_cmd.insert(-2, '-include-directory={0}'.format(source_dir))
 
     if use_shell_escape:
         pdf_cmd.insert(1, '-shell-escape')
     return pdf_cmd, new_env
 
-def _process_bib(fname, new_env = {}):
-    """Perform processing to generate bibliography data for the given LaTeX file."""
+class _Run(object):
+    """Subprocess to run as one step of a build.
+
+    If log is given, output is fed to it line by line instead of being collected, and the
+    subprocess is killed as soon as the log has seen a fatal error.
+    """
+    def __init__(self, cmd, env, cwd, log=None):
+        self.cmd = cmd
+        self.env = env
+        self.cwd = cwd
+        self.log = log
+
+class _Call(object):
+    """Blocking function call to make as one step of a build."""
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+#Regex finding where a document body starts, which ends any preamble that can be dumped
+_BEGIN_DOCUMENT_RE = re.compile(r'\\begin\s*\{document\}')
+
+def _preamble_format(fname, out_dir, template_dir, pdf_cmd):
+    """Locates the cached format of the paper's preamble, returning its path, the command to dump
+    it if it does not exist yet, and the body file to compile with it, or Nones if it cannot be.
+    """
     bname = os.path.basename(fname).split('.')[0]
+    template = get_template(fname)
+    with io.open(os.path.join(out_dir, '{0}.tex'.format(bname)), 'r', encoding='utf-8',
+                 errors='surrogateescape') as tex_fp:
+        lines = tex_fp.readlines()
+    setup = [idx for idx, line in enumerate(lines) if '{0}/setup.tex'.format(template) in line]
+    if not setup:
+        return None, None, None
+
+    #mylatexformat only dumps a preamble ended by \begin{document} in the main file, but templates
+    #begin the document in setup.tex. So the paper up to the setup, and the setup up to
+    #\begin{document}, make up the preamble, and the rest of both the body
+    template_loc = scriptorium.find_template(template, template_dir)
     try:
-        auxname = '{0}.aux'.format(bname)
-        #Check if bibtex is defined in the frontmatter
-        bibtex_re = re.compile(r'^bibtex:', re.MULTILINE)
-        with open(fname, 'r') as paper_fp:
-            if bibtex_re.search(paper_fp.read()):
-                biber_re = re.compile(r'\\bibdata', re.MULTILINE)
-                full = open(auxname, 'r').read()
-                if biber_re.search(full):
-                    subprocess.check_output(['bibtex', auxname], universal_newlines=True, env=new_env)
-                else:
-                    subprocess.check_output(['biber', bname], universal_newlines=True, env=new_env)
-    except subprocess.CalledProcessError as exc:
-        raise IOError(exc.output)
+        with io.open(os.path.join(template_loc, 'setup.tex'), 'r', encoding='utf-8',
+                     errors='surrogateescape') as setup_fp:
+            setup_lines = setup_fp.readlines()
+    except EnvironmentError:
+        return None, None, None
+    begin = [idx for idx, line in enumerate(setup_lines)
+             if _BEGIN_DOCUMENT_RE.search(line.split('%')[0])]
+    if not begin:
+        return None, None, None
+    start = _BEGIN_DOCUMENT_RE.search(setup_lines[begin[0]]).start()
+    preamble = lines[:setup[0]] + setup_lines[:begin[0]] + [setup_lines[begin[0]][:start] + '\n',
+                                                             '\\begin{document}\n']
+    body = [setup_lines[begin[0]][start:]] + setup_lines[begin[0] + 1:] + lines[setup[0] + 1:]
 
-def to_pdf(paper_dir, template_dir=None, use_shell_escape=False, flatten=False, keep_comments=False):
-    """Build paper in the given directory, returning the PDF filename if successful."""
-    template_dir = template_dir or scriptorium.CONFIG['TEMPLATE_DIR']
+    body_name = os.path.join(out_dir, '{0}-body.tex'.format(bname))
+    with io.open(body_name, 'w', encoding='utf-8', errors='surrogateescape') as body_fp:
+        body_fp.write(''.join(body))
+
+    #Formats are kept until the template revision, LaTeX command, or preamble changes
+    key = hash_bytes('\n'.join([scriptorium.template_revision(template, template_dir),
+                                ' '.join(pdf_cmd[:-1])] + preamble))
+    fmt_dir = os.path.join(out_dir, STATE_DIR, 'formats')
+    fmt_name = os.path.join(fmt_dir, key)
+    if os.path.exists(fmt_name + '.fmt'):
+        return fmt_name, None, body_name
+    if os.path.exists(fmt_name + '.failed'):
+        return None, None, None
+
+    try:
+        if not os.path.exists(fmt_dir):
+            os.makedirs(fmt_dir)
+        preamble_name = os.path.join(out_dir, '{0}-preamble.tex'.format(bname))
+        with io.open(preamble_name, 'w', encoding='utf-8', errors='surrogateescape') as pre_fp:
+            pre_fp.write(''.join(preamble))
+    except EnvironmentError:
+        return None, None, None
+
+    latex_cmd = scriptorium.CONFIG['LATEX_CMD']
+    dump_cmd = [latex_cmd, '-ini', '-interaction=nonstopmode', '-halt-on-error',
+                '-jobname={0}'.format(key), '-output-directory={0}'.format(fmt_dir),
+                '&{0}'.format(os.path.splitext(os.path.basename(latex_cmd))[0]),
+                'mylatexformat.ltx', os.path.basename(preamble_name)]
+    if '-shell-escape' in pdf_cmd:
+        dump_cmd.insert(1, '-shell-escape')
+    return fmt_name, dump_cmd, body_name
+
+def _discard_format(fmt_name):
+    """Marks a precompiled format as unusable, so later builds load the preamble normally."""
+    try:
+        open(fmt_name + '.failed', 'w').close()
+        if os.path.exists(fmt_name + '.fmt'):
+            os.remove(fmt_name + '.fmt')
+    except EnvironmentError:
+        pass
+
+def _check_format(fmt_name):
+    """Returns the name of a newly dumped format, or discards it and returns None if it failed."""
+    if os.path.exists(fmt_name + '.fmt'):
+        return fmt_name
+    _discard_format(fmt_name)
+    return None
+
+def _find_input(name, var, env, cwd):
+    """Locates a file the way TeX would, searching the paths listed in an environment variable.
+    Relative paths are taken relative to cwd, and paths ending in // are searched recursively.
+    """
+    if os.path.isabs(name):
+        return name if os.path.isfile(name) else None
+    for path in env.get(var, '').split(os.pathsep):
+        if not path:
+            continue
+        path = os.path.join(cwd, path)
+        if path.endswith('//'):
+            for dirpath, _, filenames in os.walk(path.rstrip('/') or '/'):
+                if name in filenames:
+                    return os.path.join(dirpath, name)
+                if os.path.dirname(name) and os.path.isfile(os.path.join(dirpath, name)):
+                    return os.path.join(dirpath, name)
+        elif os.path.isfile(os.path.join(path, name)):
+            return os.path.join(path, name)
+    return None
+
+def _bib_resources(bname, out_dir):
+    """Reads the citation data in the auxiliary files of a build, along with the bibliography
+    databases and styles it references, as tuples of file name and search path variable.
+    """
+    digest = []
+    resources = []
+    bcfname = os.path.join(out_dir, '{0}.bcf'.format(bname))
+    if os.path.exists(bcfname):
+        with open(bcfname, 'r') as bcf_fp:
+            bcf = bcf_fp.read()
+        digest.append(bcf)
+        datasource_re = re.compile(r'<bcf:datasource[^>]*>(?P<name>[^<]+)</bcf:datasource>')
+        resources += [(ii.group('name').strip(), 'BIBINPUTS') for ii in datasource_re.finditer(bcf)]
+
+    for auxname in sorted(glob.glob(os.path.join(out_dir, '*.aux'))):
+        with open(auxname, 'r') as aux_fp:
+            for line in aux_fp:
+                if line.startswith(('\\citation', '\\bibdata', '\\bibstyle')):
+                    digest.append(line)
+                if line.startswith('\\bibdata{'):
+                    resources += [(ii.strip() + '.bib', 'BIBINPUTS')
+                                  for ii in line.strip()[len('\\bibdata{'):-1].split(',')]
+                elif line.startswith('\\bibstyle{'):
+                    resources.append((line.strip()[len('\\bibstyle{'):-1] + '.bst', 'BSTINPUTS'))
+    return digest, resources
+
+def _bib_inputs(bname, out_dir, new_env):
+    """Builds digest of everything bibtex or biber reads: citation data in the auxiliary files, and
+    the bibliography databases and styles they reference.
+    """
+    digest, resources = _bib_resources(bname, out_dir)
+    for name, var in resources:
+        path = _find_input(name, var, new_env, out_dir)
+        digest.append('{0}:{1}'.format(name, hash_file(path) if path else None))
+    return hash_bytes('\n'.join(digest))
+
+def _bib_step(fname, out_dir, new_env):
+    """Decides whether bibliography data must be generated for the given paper.
+
+    Returns the bibtex or biber command to run along with the key identifying its inputs, or
+    Nones when the paper has no bibliography, or its citations and bibliography files are
+    unchanged since the bibliography was last generated.
+    """
+    bname = os.path.basename(fname).split('.')[0]
+    #Check if bibtex is defined in the frontmatter
+    if 'bibtex' not in read_frontmatter(fname, ['bibtex']):
+        return None, None
+
+    auxname = '{0}.aux'.format(bname)
+    key = _bib_inputs(bname, out_dir, new_env)
+    if load_state(out_dir, 'bib').get('bibliography') == key and \
+       os.path.exists(os.path.join(out_dir, '{0}.bbl'.format(bname))):
+        return None, None
+
+    with open(os.path.join(out_dir, auxname), 'r') as aux_fp:
+        use_bibtex = any(line.startswith('\\bibdata') for line in aux_fp)
+    return (['bibtex', auxname] if use_bibtex else ['biber', bname]), key
+
+def _glossary_step(bname, out_dir):
+    """Decides whether glossaries must be generated for the given LaTeX file, returning the
+    makeglossaries command along with the key identifying its inputs, or Nones if unchanged.
+    """
+    if not os.path.exists(os.path.join(out_dir, '{0}.xdy'.format(bname))):
+        return None, None
+
+    key = hash_bytes('\n'.join(['{0}:{1}'.format(ext, hash_file(os.path.join(out_dir,
+                                                                             bname + '.' + ext)))
+                                for ext in ['glo', 'acn', 'slo', 'ist', 'xdy']]))
+    if load_state(out_dir, 'bib').get('glossaries') == key and \
+       os.path.exists(os.path.join(out_dir, '{0}.gls'.format(bname))):
+        return None, None
+    return ['makeglossaries', bname], key
+
+def _record_key(out_dir, name, key):
+    """Records the inputs of a successfully generated bibliography or glossary."""
+    state = load_state(out_dir, 'bib')
+    state[name] = key
+    save_state(out_dir, 'bib', state)
+
+def _aux_files(bname, out_dir):
+    """Lists the auxiliary files LaTeX reads back in on the next pass."""
+    fnames = glob.glob(os.path.join(out_dir, '*.aux'))
+    return fnames + [os.path.join(out_dir, '{0}.{1}'.format(bname, ext)) for ext in _RERUN_EXTS]
+
+def _fingerprint(bname, out_dir):
+    """Digests the auxiliary files LaTeX reads back in on the next pass."""
+    return {fname: hash_file(fname) for fname in _aux_files(bname, out_dir)}
+
+def _backup_aux(bname, out_dir):
+    """Reads the auxiliary files of a build, so they can be put back if a LaTeX pass fails."""
+    backup = {}
+    for fname in _aux_files(bname, out_dir):
+        try:
+            with open(fname, 'rb') as aux_fp:
+                backup[fname] = aux_fp.read()
+        except EnvironmentError:
+            backup[fname] = None
+    return backup
+
+def _restore_aux(backup):
+    """Puts back auxiliary files read by _backup_aux, removing those which did not exist."""
+    for fname, data in backup.items():
+        try:
+            if data is None:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            else:
+                with open(fname, 'wb') as aux_fp:
+                    aux_fp.write(data)
+        except EnvironmentError:
+            pass
+
+#Extensions of the files LaTeX and the bibliography and glossary tools write for a document
+_OUTPUT_EXTS = ['acn', 'acr', 'alg', 'aux', 'bbl', 'bbl-SAVE-ERROR', 'bcf', 'blg', 'fls', 'glg',
+                'glo', 'gls', 'glsdefs', 'ist', 'lof', 'log', 'lot', 'maf', 'mtc', 'nav', 'out',
+                'pdf', 'run.xml', 'slg', 'slo', 'sls', 'snm', 'synctex', 'synctex.gz', 'toc', 'vrb',
+                'xdv', 'xdy']
 
+def _build_products(out_dir, paper_dir, bname):
+    """Lists the files in out_dir which build steps write, relative to out_dir.
+
+    These are the LaTeX converted from each paper source, the files written for the root document,
+    the chapter units and driver of partial builds, and the split preamble of precompiled builds.
+    Paper sources themselves are never included.
+    """
+    names = set('{0}.{1}'.format(bname, ext) for ext in _OUTPUT_EXTS)
+    names |= set('{0}-{1}.tex'.format(bname, ii) for ii in ['only', 'body', 'preamble'])
+    names |= set('{0}.tex'.format(os.path.basename(ii).split('.')[0])
+                 for ii in _list_files(paper_dir))
+    unit_re = re.compile(re.escape(bname) + r'-unit[0-9]{3}\.(?:tex|aux)$')
+    names |= set(ii for ii in os.listdir(out_dir) if unit_re.match(ii))
+    names -= set(os.path.relpath(ii, out_dir) for ii in _list_files(paper_dir))
+    return set(ii for ii in names if os.path.isfile(os.path.join(out_dir, ii)))
+
+def _save_outputs(out_dir, manifest):
+    """Saves the manifest of outputs, ignoring output directories which cannot be written."""
+    try:
+        save_state(out_dir, 'outputs', manifest)
+    except EnvironmentError:
+        pass
+
+def _record_outputs(out_dir, paper_dir, bname, before):
+    """Adds the files generated by a build to the manifest of outputs kept in out_dir.
+
+    Only build products, as listed by _build_products, are recorded, and only if they did not exist
+    before the build or were recorded by an earlier one. Files edited or added while the build ran
+    are thus never mistaken for outputs. The PDF is recorded as published, so clean keeps it.
+    """
+    manifest = load_state(out_dir, 'outputs')
+    old_files = set(manifest.get('files', []))
+    published = set(manifest.get('published', []))
+    products = _build_products(out_dir, paper_dir, bname)
+    files = set(ii for ii in old_files if os.path.exists(os.path.join(out_dir, ii)))
+    files |= set(ii for ii in products if ii not in before or ii in old_files)
+    pdf = '{0}.pdf'.format(bname)
+    if pdf in files:
+        published.add(pdf)
+    published &= files
+    if files != old_files or published != set(manifest.get('published', [])):
+        _save_outputs(out_dir, {'files': sorted(files), 'published': sorted(published)})
+
+def _record_published(out_dir, paths):
+    """Adds files published from a build, such as exported formats or a PDF copied elsewhere, to
+    the manifest of outputs kept in out_dir, as files clean keeps. Files outside out_dir, and paper
+    sources, are not recorded.
+    """
+    out_dir = os.path.abspath(out_dir)
+    manifest = load_state(out_dir, 'outputs')
+    files = set(manifest.get('files', []))
+    published = set(manifest.get('published', []))
+    for path in paths:
+        name = os.path.relpath(os.path.abspath(path), out_dir)
+        if not name.startswith(os.pardir) and not name.endswith(_SOURCE_EXTS):
+            files.add(name)
+            published.add(name)
+    _save_outputs(out_dir, {'files': sorted(files), 'published': sorted(published)})
+
+def _check_output(cmd, new_env, profiler=None, cwd=None, log=None):
+    """Runs a command, returning its output and reporting its resource usage to the profiler.
+
+    If log is given, output is parsed by it as it arrives rather than returned, and the command is
+    killed at the first fatal error.
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=new_env, cwd=cwd)
+    if log is None:
+        output = proc.stdout.read()
+    else:
+        output = None
+        for line in iter(proc.stdout.readline, b''):
+            if log.feed(line):
+                proc.kill()
+                break
+        log.close()
+    proc.stdout.close()
+    (profiler or NullProfiler()).child(wait_child(proc))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=output)
+    return output
+
+def _locate_paper(paper_dir, build_dir):
+    """Finds the root document of a paper, given its directory or the root itself, and creates its
+    output directory. Returns the paper directory, root filename, and output directory.
+    """
     paper_dir = os.path.abspath(paper_dir)
     if os.path.isdir(paper_dir):
         fname = paper_root(paper_dir)
+        fname = os.path.join(paper_dir, fname) if fname else None
     elif os.path.isfile(paper_dir):
         fname = paper_dir
         paper_dir = os.path.dirname(paper_dir)
     else:
         raise IOError("{0} is not a valid directory".format(paper_dir))
 
-    old_cwd = os.getcwd()
-    if old_cwd != paper_dir:
-        os.chdir(paper_dir)
-
     if not fname:
         raise IOError("{0} has no obvious root.".format(paper_dir))
 
-    #Convert all auxillary MMD files to LaTeX
-    for mmd in _list_files(paper_dir):
-        bname = os.path.basename(mmd).split('.')[0]
-        with open(mmd, 'r') as mmd_fp, open('{0}.tex'.format(bname), 'w') as tex_fp:
-            tex_fp.write(pymmd.convert(mmd_fp.read(), fmt=pymmd.LATEX, dname=mmd, ext=pymmd.SMART))
+    out_dir = os.path.abspath(build_dir) if build_dir else paper_dir
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    return paper_dir, fname, out_dir
+
+def _build_steps(paper_dir, template_dir=None, use_shell_escape=False, flatten=False,
+                 keep_comments=False, max_passes=None, jobs=1, profiler=None, precompile=False,
+                 build_dir=None, use_cache=True, pool=None, only=None, draft=False):
+    """Generates the _Run subprocess and _Call blocking steps which build a paper, with the result
+    of each sent back and its failure thrown back, finally yielding the PDF filename.
+    """
+    #Anything touching the file system or running git is a step, so drivers can keep it off their
+    #thread, and subprocesses are given their working directory rather than changing it
+    template_dir = template_dir or scriptorium.CONFIG['TEMPLATE_DIR']
+    if flatten and only:
+        raise ValueError('Partial builds cannot be flattened')
+
+    paper_dir, fname, out_dir = yield _Call(_locate_paper, paper_dir, build_dir)
 
-    pdf_cmd, new_env = _build_latex_cmd(fname, template_dir, use_shell_escape)
+    profiler = profiler or NullProfiler()
+    if profiler.dname is None:
+        profiler.dname = out_dir
 
     bname = os.path.basename(fname).split('.')[0]
-    if flatten:
-        tname = '{0}.tex'.format(bname)
-        fargs = '--keep-comments' if keep_comments else ''
-        with tempfile.NamedTemporaryFile() as tmp:
-            subprocess.check_call(['latexpand', '-o', tmp.name, tname, fargs], env=new_env)
-            shutil.copyfile(tmp.name, tname)
+    pdf_name = os.path.join(out_dir, '{0}.pdf'.format(bname))
 
+    #Record everything the build generates, whether or not it succeeds. Finished and failed builds
+    #record them as a step of their own, while cancelled ones record them as they unwind
+    before = yield _Call(_build_products, out_dir, paper_dir, bname)
+    recorded = False
     try:
-        subprocess.check_output(pdf_cmd, env=new_env)
-        if os.path.exists(os.path.join(paper_dir, '{0}.xdy'.format(bname))):
-            subprocess.check_output(['makeglossaries', bname], env=new_env)
-    except subprocess.CalledProcessError as exc:
-        raise IOError(decodeCPEError(exc.output))
+        #Convert all auxillary MMD files to LaTeX, reusing unchanged conversions. This comes first
+        #so the artifact digest scans the converted LaTeX rather than converting again
+        with profiler.stage('convert'):
+            yield _Call(_convert_paper, paper_dir, out_dir, jobs, pool)
+
+        #Flattening is asked for its LaTeX output, which the artifact store does not keep, and
+        #partial and draft builds leave out parts of the PDF
+        digest = None
+        if use_cache and not flatten and not only and not draft:
+            from scriptorium import artifacts
+            with profiler.stage('artifact lookup'):
+                flags = {'use_shell_escape': use_shell_escape, 'precompile': precompile,
+                         'max_passes': int(max_passes or scriptorium.CONFIG['MAX_PASSES'])}
+                digest = yield _Call(artifacts.build_digest, fname, template_dir, flags, build_dir)
+                found = yield _Call(artifacts.fetch, digest, pdf_name)
+            if found:
+                yield _Call(_record_outputs, out_dir, paper_dir, bname, before)
+                recorded = True
+                yield pdf_name
+                return
+
+        pdf_cmd, new_env = yield _Call(_build_latex_cmd, fname, template_dir, use_shell_escape,
+                                       paper_dir if out_dir != paper_dir else None)
+
+        if flatten:
+            from scriptorium.flatten import flatten_file
+            with profiler.stage('flatten'):
+                yield _Call(flatten_file, os.path.join(out_dir, '{0}.tex'.format(bname)), new_env,
+                            keep_comments)
+
+        if only:
+            from scriptorium.units import write_units
+            with profiler.stage('units'):
+                driver = yield _Call(write_units, fname, paper_dir, out_dir, only)
+            pdf_cmd = pdf_cmd[:-1] + ['-jobname={0}'.format(bname), os.path.basename(driver)]
+
+        if draft:
+            #Draft graphics are drawn as frames of the same size, so the page layout, and with it
+            #the auxiliary files a full build reads, stay the same
+            jobname = [] if only else ['-jobname={0}'.format(bname)]
+            pdf_cmd = pdf_cmd[:-1] + jobname + [
+                '\\PassOptionsToPackage{{draft}}{{graphicx}}\\input{{{0}}}'.format(pdf_cmd[-1])]
+
+        fmt_cmd = pdf_cmd
+        #Loading a precompiled format skips the preamble, which limits a partial build and would
+        #load graphics before a draft build could pass them its option
+        if precompile and not only and not draft:
+            with profiler.stage('precompile'):
+                fmt_name, dump_cmd, body_name = yield _Call(_preamble_format, fname, out_dir,
+                                                            template_dir, pdf_cmd)
+                if dump_cmd:
+                    try:
+                        yield _Run(dump_cmd, new_env, out_dir)
+                    except subprocess.CalledProcessError:
+                        pass
+                    fmt_name = yield _Call(_check_format, fmt_name)
+            if fmt_name:
+                fmt_cmd = pdf_cmd[:1] + ['-fmt={0}'.format(fmt_name)] + pdf_cmd[1:-1] + \
+                          ['-jobname={0}'.format(bname), os.path.basename(body_name)]
+
+        max_passes = int(max_passes or scriptorium.CONFIG['MAX_PASSES'])
+        inputs = yield _Call(_fingerprint, bname, out_dir)
+        #A failed draft pass must not leave the last full build's auxiliary files truncated
+        backup = (yield _Call(_backup_aux, bname, out_dir)) if draft else None
+        try:
+            with profiler.stage('latex pass 1'):
+                log = LatexLog(profiler.log_event)
+                try:
+                    yield _Run(fmt_cmd, new_env, out_dir, log)
+                except subprocess.CalledProcessError:
+                    if fmt_cmd is pdf_cmd:
+                        raise log.error()
+                    #Fall back to loading the preamble normally, and stop using the format if that
+                    #works
+                    log = LatexLog(profiler.log_event)
+                    try:
+                        yield _Run(pdf_cmd, new_env, out_dir, log)
+                    except subprocess.CalledProcessError:
+                        raise log.error()
+                    yield _Call(_discard_format, fmt_name)
+                    fmt_cmd = pdf_cmd
+        except Exception as exc:
+            if backup is not None:
+                yield _Call(_restore_aux, backup)
+            raise exc
+        except BaseException:
+            #Cancelled builds cannot run further steps
+            if backup is not None:
+                _restore_aux(backup)
+            raise
+        if draft:
+            yield _Call(_record_outputs, out_dir, paper_dir, bname, before)
+            recorded = True
+            yield pdf_name
+            return
+
+        pdf_cmd = fmt_cmd
+        passes = 1
 
-    _process_bib(fname, new_env)
+        with profiler.stage('makeglossaries'):
+            cmd, key = yield _Call(_glossary_step, bname, out_dir)
+            if cmd:
+                try:
+                    yield _Run(cmd, new_env, out_dir)
+                except subprocess.CalledProcessError as exc:
+                    raise IOError(decodeCPEError(exc.output))
+                yield _Call(_record_key, out_dir, 'glossaries', key)
 
+        with profiler.stage('bibliography'):
+            cmd, key = yield _Call(_bib_step, fname, out_dir, new_env)
+            if cmd:
+                try:
+                    yield _Run(cmd, new_env, out_dir)
+                except subprocess.CalledProcessError as exc:
+                    raise IOError(decodeCPEError(exc.output))
+                yield _Call(_record_key, out_dir, 'bibliography', key)
+
+        #Rerun LaTeX until the auxiliary files it reads stop changing
+        while passes < max_passes:
+            outputs = yield _Call(_fingerprint, bname, out_dir)
+            if outputs == inputs:
+                break
+            inputs = outputs
+            passes += 1
+            with profiler.stage('latex pass {0}'.format(passes)):
+                log = LatexLog(profiler.log_event)
+                try:
+                    yield _Run(pdf_cmd, new_env, out_dir, log)
+                except subprocess.CalledProcessError:
+                    raise log.error()
+
+        if digest:
+            with profiler.stage('artifact store'):
+                yield _Call(artifacts.store, digest, pdf_name)
+
+        yield _Call(_record_outputs, out_dir, paper_dir, bname, before)
+        recorded = True
+        yield pdf_name
+    except Exception as exc:
+        #Failing to record the outputs must not hide why the build failed
+        if not recorded:
+            try:
+                yield _Call(_record_outputs, out_dir, paper_dir, bname, before)
+            except Exception:
+                pass
+        raise exc
+    except BaseException:
+        #Cancelled builds cannot run further steps, so they record their outputs here
+        if not recorded:
+            try:
+                _record_outputs(out_dir, paper_dir, bname, before)
+            except Exception:
+                pass
+        raise
+
+def _run_steps(steps, profiler=None):
+    """Executes build steps in the calling thread, returning the final result."""
+    result, error = None, None
     try:
-        subprocess.check_output(pdf_cmd, env=new_env)
-    except subprocess.CalledProcessError as exc:
-        raise IOError(decodeCPEError(exc.output))
+        while True:
+            step = steps.throw(error) if error else steps.send(result)
+            result, error = None, None
+            try:
+                if isinstance(step, _Run):
+                    result = _check_output(step.cmd, step.env, profiler, step.cwd, step.log)
+                elif isinstance(step, _Call):
+                    result = step.func(*step.args)
+                else:
+                    return step
+            except Exception as exc:
+                error = exc
+    finally:
+        steps.close()
+
+def to_pdf(paper_dir, template_dir=None, use_shell_escape=False, flatten=False, keep_comments=False,
+           max_passes=None, jobs=1, profiler=None, precompile=False, build_dir=None,
+           use_cache=True, only=None, draft=False, pool=None):
+    """Build paper in the given directory, returning the PDF filename if successful.
+    Options are those of the build command, and pool is a process pool to convert files in.
+    """
+    profiler = profiler or NullProfiler()
+    steps = _build_steps(paper_dir, template_dir, use_shell_escape, flatten, keep_comments,
+                         max_passes, jobs, profiler, precompile, build_dir, use_cache, pool=pool,
+                         only=only, draft=draft)
+    return _run_steps(steps, profiler)
+
+def _build_paper(paper_dir, kwargs):
+    """Builds a single paper, returning the PDF filename and error message, if any."""
     try:
-        subprocess.check_output(pdf_cmd, env=new_env)
-    except subprocess.CalledProcessError as exc:
-        raise IOError(decodeCPEError(exc.output))
-
-    # Revert working directory
-    if os.getcwd() != old_cwd:
-        os.chdir(old_cwd)
-
-    return os.path.join(paper_dir, '{0}.pdf'.format(bname))
-
-def _expand_variables(template, texts, config):
-    # """Given a
-    #Inject template as macro argument
-    config['TEMPLATE'] = template
-    full_config = scriptorium.get_default_config(template)
-    full_config.update(config)
-
-    #One line regex thanks to http://stackoverflow.com/a/6117124/59184
-    for ofile, text in texts.items():
-        texts[ofile] = re.sub("|".join([r'\${0}'.format(ii) for ii in full_config]),
-                              lambda m: full_config[m.group(0)[1:]], text)
-
-    #Regex to find variable names
-    var_re = re.compile(r'\$[A-Z0-9_\.\-]+')
+        return to_pdf(paper_dir, **kwargs), None
+    except Exception as exc:
+        return None, str(exc) or exc.__class__.__name__
+
+def build_papers(paper_dirs, jobs=1, **kwargs):
+    """Builds many papers over up to jobs processes, yielding tuples of
+    (paper directory, PDF filename, error message) as each build finishes.
+
+    A failing paper is reported with a PDF filename of None and never stops the other builds.
+    Keyword arguments are passed on to to_pdf.
+    """
+    kwargs.setdefault('template_dir', scriptorium.CONFIG['TEMPLATE_DIR'])
+    if jobs <= 1:
+        for paper_dir in paper_dirs:
+            pdf, err = _build_paper(os.path.abspath(paper_dir), kwargs)
+            yield paper_dir, pdf, err
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(_build_paper, os.path.abspath(paper_dir), kwargs): paper_dir
+                   for paper_dir in paper_dirs}
+        for future in as_completed(futures):
+            try:
+                pdf, err = future.result()
+            except Exception as exc:
+                pdf, err = None, str(exc) or exc.__class__.__name__
+            yield futures[future], pdf, err
+
+#Regex to find variable names, capturing the name without its leading $
+_VAR_RE = re.compile(r'\$([A-Z0-9_\.\-]+)')
+
+def _segments(text):
+    """Splits text into alternating literal text and variable names, starting with literal text."""
+    return _VAR_RE.split(text)
+
+def _render(segments, config):
+    """Substitutes config values for the variables in segments.
+
+    Each variable is replaced by the value of the longest configuration key it starts with.
+    Returns the resulting text and the names of variables which could not be substituted.
+    """
+    parts = []
     unset_vars = set()
-    for ofile, text in texts.items():
-        unset_vars |= set([ii.group(0) for ii in var_re.finditer(text)])
+    for idx, segment in enumerate(segments):
+        if idx % 2 == 0:
+            parts.append(segment)
+            continue
+        for end in range(len(segment), 0, -1):
+            if segment[:end] in config:
+                value = config[segment[:end]]
+                value = value if isinstance(value, str) else '{0}'.format(value)
+                unset_vars |= set(ii.lower() for ii in _VAR_RE.findall(value))
+                parts.append(value + segment[end:])
+                break
+        else:
+            unset_vars.add(segment.lower())
+            parts.append('$' + segment)
+    return ''.join(parts), unset_vars
+
+class CompiledTemplate(object):
+    """Template prepared for creating papers, with its manifest files read and split at their
+    variables, and its default configuration loaded, so each paper only substitutes values.
+    """
+    def __init__(self, template, template_dir=None):
+        template_dir = template_dir or scriptorium.CONFIG['TEMPLATE_DIR']
+        self.template = template
+        self.location = scriptorium.find_template(template, template_dir)
+        if not self.location:
+            raise IOError('{0} template not installed in {1}'.format(template, template_dir))
+        self.defaults = scriptorium.get_default_config(template, template_dir)
+        self.files = {}
+        for ofile, ifile in scriptorium.get_manifest(template, template_dir).items():
+            try:
+                with open(os.path.join(self.location, ifile), 'r') as ifp:
+                    self.files[ofile] = _segments(ifp.read())
+            except IOError:
+                self.files[ofile] = ['']
 
-    unset_vars = set([ii[1:].lower() for ii in unset_vars])
-    return unset_vars
+    def expand(self, config):
+        """Builds the files of a new paper, returning the texts and names of unset variables."""
+        full_config = dict(self.defaults)
+        full_config.update({kk.upper(): vv for kk, vv in config.items()})
+        full_config['TEMPLATE'] = self.template
+
+        texts = {}
+        unset_vars = set()
+        for ofile, segments in self.files.items():
+            texts[ofile], missing = _render(segments, full_config)
+            unset_vars |= missing
+        return texts, unset_vars
+
+    def create(self, paper_dir, force=False, use_git=True, config=None):
+        """Creates folder with paper skeleton, returning the names of unset variables."""
+        if os.path.exists(paper_dir) and not force:
+            raise IOError('{0} exists'.format(paper_dir))
+
+        texts, unset_vars = self.expand(config or {})
+        if not os.path.exists(paper_dir):
+            os.makedirs(paper_dir)
+        if use_git and not os.path.exists(os.path.join(paper_dir, '.gitignore')):
+            shutil.copyfile(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data',
+                                         'gitignore'),
+                            os.path.join(paper_dir, '.gitignore'))
+
+        for ofile, text in texts.items():
+            with open(os.path.join(paper_dir, ofile), 'w') as ofp:
+                ofp.write(text)
+        return unset_vars
+
+def compile_template(template, template_dir=None):
+    """Prepares a template for creating papers quickly and repeatedly."""
+    return CompiledTemplate(template, template_dir)
 
 def create(paper_dir, template, force=False, use_git=True, config=None):
     """Create folder with paper skeleton.
     Returns a list of unpopulated variables if successfully created.
     """
+    return compile_template(template).create(paper_dir, force, use_git, config)
 
-    config = {kk.upper():vv for kk, vv in config.items()}
+def _create_paper(compiled, paper, force, use_git):
+    """Creates a single paper, returning the unset variables and error message, if any."""
+    config = {kk: vv for kk, vv in paper.items() if kk not in ('output', 'template')}
+    try:
+        return compiled.create(paper['output'], force, use_git, config), None
+    except Exception as exc:
+        return None, str(exc) or exc.__class__.__name__
 
-    if os.path.exists(paper_dir) and not force:
-        raise IOError('{0} exists'.format(paper_dir))
+def create_batch(papers, template=None, force=False, use_git=True, jobs=1):
+    """Creates many papers, using up to jobs threads.
 
-    template_dir = scriptorium.find_template(template, scriptorium.CONFIG['TEMPLATE_DIR'])
+    Each paper is a dictionary of variables, naming the directory to create under 'output', and
+    optionally the template to use under 'template' instead of the given default. Each template
+    is compiled once and shared by all its papers. Yields tuples of output directory, unset
+    variables, and error message, if any, as each paper is created.
+    """
+    #Papers are gone through twice, so any iterable will do
+    papers = list(papers)
+    compiled = {}
+    for paper in papers:
+        name = paper.get('template', template)
+        if name not in compiled:
+            try:
+                compiled[name] = compile_template(name) if name else None
+            except Exception as exc:
+                compiled[name] = str(exc) or exc.__class__.__name__
 
-    os.makedirs(paper_dir)
-    if use_git and not os.path.exists(os.path.join(paper_dir, '.gitignore')):
-        shutil.copyfile(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data',
-                                     'gitignore'),
-                        os.path.join(paper_dir, '.gitignore'))
+    def submit(pool, paper):
+        """Starts creating a paper, or reports why it cannot be created."""
+        name = paper.get('template', template)
+        if not paper.get('output'):
+            return 'Paper is missing an output directory'
+        if compiled[name] is None:
+            return 'No template given for {0}'.format(paper['output'])
+        if not isinstance(compiled[name], CompiledTemplate):
+            return compiled[name]
+        return pool.submit(_create_paper, compiled[name], paper, force, use_git)
 
-    files = scriptorium.get_manifest(template)
-    texts = {}
-    for ofile, ifile in files.items():
-        ifile = os.path.join(template_dir, ifile)
-        try:
-            with open(ifile, 'r') as ifp:
-                texts[ofile] = ifp.read()
-        except IOError:
-            texts[ofile] = ''
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {}
+        for paper in papers:
+            future = submit(pool, paper)
+            if isinstance(future, str):
+                yield paper.get('output'), None, future
+            else:
+                futures[future] = paper['output']
+        for future in as_completed(futures):
+            unset_vars, err = future.result()
+            yield futures[future], unset_vars, err
 
-    unset_vars = _expand_variables(template, texts, config)
-    for ofile, text in texts.items():
-        with open(os.path.join(paper_dir, ofile), 'w') as ofp:
-            ofp.write(text)
+def _guess_outputs(paper_dir):
+    """Guesses which files in a paper directory built without an output manifest were generated."""
+    root = paper_root(paper_dir)
+    if not root:
+        return None
+
+    bname = os.path.splitext(os.path.basename(root))[0]
+    return sorted(_build_products(paper_dir, paper_dir, bname))
+
+def _clean_paper(paper_dir):
+    """Removes files generated by building the paper in paper_dir, keeping its PDF and any other
+    published files, such as exported formats.
+
+    Uses the manifest of outputs recorded by builds, falling back to guessing from file names for
+    papers built without one. Returns the bytes reclaimed, or None if paper_dir is not a paper.
+    """
+    manifest = load_state(paper_dir, 'outputs')
+    published = set(manifest.get('published', []))
+    if manifest:
+        files = manifest.get('files', [])
+    else:
+        files = _guess_outputs(paper_dir)
+        if files is None:
+            return None
+
+    reclaimed = 0
+    remaining = []
+    for fname in files:
+        path = os.path.join(paper_dir, fname)
+        if fname in published or (fname.endswith('.pdf') and os.path.dirname(fname) == ''):
+            remaining.append(fname)
+            continue
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            reclaimed += size
+        except OSError:
+            if os.path.exists(path):
+                remaining.append(fname)
 
-    return unset_vars
+    if manifest:
+        save_state(paper_dir, 'outputs', {'files': remaining,
+                                          'published': sorted(published & set(remaining))})
+    return reclaimed
 
 def clean(paper_dir):
     """Removes temporary files generated by LaTeX."""
-    root = paper_root(paper_dir)
+    return _clean_paper(paper_dir) is not None
 
-    if not root:
-        return False
+def _find_papers(dname):
+    """Finds directories under dname which have been built, or contain MultiMarkdown files.
+    Templates, which have a setup.tex, are left out, as their frontmatter looks like a paper root.
+    """
+    papers = []
+    for dirpath, dirnames, filenames in os.walk(dname):
+        if 'setup.tex' not in filenames and \
+           (STATE_DIR in dirnames or any(ii.endswith(_SOURCE_EXTS) for ii in filenames)):
+            papers.append(dirpath)
+        dirnames[:] = sorted(ii for ii in dirnames if ii not in ('.git', STATE_DIR))
+    return papers
 
-    bname = os.path.splitext(os.path.basename(root))[0]
-    latex_exts = ['acn', 'acn', 'acr', 'alg', 'aux', 'bbl', 'bcf', 'blg',
-                  'glo', 'gls', 'glsdefs', 'ist', 'log', 'lot', 'maf',
-                  'mtc', 'out', 'run.xml', 'synctex', 'toc', 'xdy']
-
-    for fname in [os.path.join(paper_dir, '{0}.{1}').format(bname, ext) for ext in latex_exts]:
-        if os.path.exists(fname):
-            os.remove(fname)
-    return True
+def clean_papers(dname, jobs=1):
+    """Cleans every paper in the tree under dname, using up to jobs threads.
+
+    Yields tuples of paper directory, bytes reclaimed, and error message, if any, as each paper
+    is cleaned.
+    """
+    def run(paper_dir):
+        """Cleans a single paper, capturing its error message."""
+        try:
+            return _clean_paper(paper_dir), None
+        except Exception as exc:
+            return None, str(exc) or exc.__class__.__name__
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {pool.submit(run, paper_dir): paper_dir for paper_dir in _find_papers(dname)}
+        for future in as_completed(futures):
+            reclaimed, err = future.result()
+            if reclaimed is not None or err:
+                yield futures[future], reclaimed, err
 
 def decodeCPEError(output):
     """Attempts to decode a string with a variety of common encodings."""
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Timing and resource accounting for the stages of a build."""
+
+import contextlib
+import json
+import os
+import platform
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def _rss_bytes(maxrss):
+    """Converts ru_maxrss to bytes, which Linux reports in kilobytes."""
+    return maxrss if platform.system() == 'Darwin' else maxrss * 1024
+
+def _dir_snapshot(dname):
+    """Records modification time and size of the files directly inside dname."""
+    snapshot = {}
+    for fname in os.listdir(dname):
+        path = os.path.join(dname, fname)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            snapshot[fname] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+class NullProfiler(object):
+    """Profiler which records nothing."""
+    dname = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Does nothing around a stage."""
+        yield
+
+    def child(self, rusage):
+        """Ignores child resource usage."""
+        pass
+
+    def log_event(self, event):
+        """Ignores errors and warnings parsed from LaTeX output."""
+        pass
+
+class Profiler(NullProfiler):
+    """Records wall time, CPU time, peak child memory, and bytes written for each build stage."""
+    def __init__(self, dname=None):
+        self.dname = dname
+        self.stages = []
+        self.start = time.time()
+        self._current = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measures the enclosed stage of a build."""
+        record = {'name': name, 'peak_rss': 0}
+        parent = self._current
+        self._current = record
+        before = _dir_snapshot(self.dname) if self.dname else {}
+        times = os.times()
+        record['start'] = time.time()
+        try:
+            yield
+        finally:
+            record['wall'] = time.time() - record['start']
+            end = os.times()
+            record['cpu'] = sum(end[:4]) - sum(times[:4])
+            after = _dir_snapshot(self.dname) if self.dname else {}
+            record['written'] = sum(size for fname, (mtime, size) in after.items()
+                                    if before.get(fname) != (mtime, size))
+            self._current = parent
+            if parent is not None:
+                parent['peak_rss'] = max(parent['peak_rss'], record['peak_rss'])
+            self.stages.append(record)
+
+    def child(self, rusage):
+        """Attributes resource usage of a finished child process to the current stage."""
+        if self._current is not None and rusage is not None:
+            self._current['peak_rss'] = max(self._current['peak_rss'], _rss_bytes(rusage.ru_maxrss))
+
+    def trace(self):
+        """Builds Chrome trace event representation of the recorded stages."""
+        events = []
+        for record in sorted(self.stages, key=lambda ii: ii['start']):
+            events.append({
+                'name': record['name'],
+                'ph': 'X',
+                'ts': int((record['start'] - self.start) * 1e6),
+                'dur': int(record['wall'] * 1e6),
+                'pid': os.getpid(),
+                'tid': 0,
+                'args': {
+                    'cpu_seconds': record['cpu'],
+                    'peak_rss_bytes': record['peak_rss'],
+                    'bytes_written': record['written']
+                }
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, fname):
+        """Writes the recorded stages as a Chrome trace event file."""
+        with open(fname, 'w') as trace_fp:
+            json.dump(self.trace(), trace_fp, indent=1)
+
+    def summary(self):
+        """Formats a table summarizing the recorded stages."""
+        lines = ['{0:<24} {1:>9} {2:>9} {3:>10} {4:>11}'.format('Stage', 'Wall (s)', 'CPU (s)',
+                                                              'Peak RSS', 'Written')]
+        for record in sorted(self.stages, key=lambda ii: ii['start']):
+            lines.append('{0:<24} {1:>9.3f} {2:>9.3f} {3:>8.1f}MB {4:>9.1f}KB'.format(
+                record['name'], record['wall'], record['cpu'], record['peak_rss'] / 1048576.0,
+                record['written'] / 1024.0))
+        return '\n'.join(lines)
+
+def wait_child(proc):
+    """Waits for a subprocess, returning its resource usage where the platform provides it."""
+    if resource is None or not hasattr(os, 'wait4'):
+        proc.wait()
+        return None
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
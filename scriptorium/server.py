@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""Local build daemon answering requests over a UNIX socket, on Python 3.7 or newer.
+
+Clients send one JSON object per line, and receive one JSON object per line in reply. Requests
+carry an id, which is echoed in every reply to them, and a cmd:
+
+    {"id": 1, "cmd": "build", "paper": "/abs/paper", "options": {"precompile": true}}
+    {"id": 2, "cmd": "info", "paper": "/abs/paper"}
+    {"id": 3, "cmd": "new", "output": "/abs/paper", "template": "report", "config": {}}
+
+Build options are the keyword arguments of to_pdf. While a build runs, its stages are reported
+as {"id": 1, "event": "stage", "stage": "latex pass 1", "status": "start"} and status "done"
+with the wall time taken. Every request ends with either {"id": .., "event": "result", ...}
+or {"id": .., "event": "error", "error": "message"}. Paths are used as given, so clients should
+send absolute paths.
+"""
+
+import asyncio
+import contextlib
+import json
+import os
+import os.path
+import socket
+import time
+
+import scriptorium
+from scriptorium.builder import Builder
+from scriptorium.config import _DEFAULT_DIR
+from scriptorium.profiling import NullProfiler
+
+SOCKET_PATH = os.path.join(_DEFAULT_DIR, 'serve.sock')
+
+_BUILD_OPTIONS = set(['use_shell_escape', 'flatten', 'keep_comments', 'max_passes', 'precompile',
+                      'build_dir', 'use_cache', 'only', 'draft'])
+
+def _send(writer, message):
+    """Writes a message to a client, ignoring clients which have gone away."""
+    if writer.is_closing():
+        return
+    writer.write(json.dumps(message).encode('utf-8') + b'\n')
+
+class _Job(object):
+    """Build of a paper with particular options, shared by every client requesting it."""
+    def __init__(self):
+        self.clients = []
+        self.task = None
+
+    def emit(self, message):
+        """Sends a message to every client waiting on this build."""
+        for writer, req_id in self.clients:
+            _send(writer, dict(message, id=req_id))
+
+class _Progress(NullProfiler):
+    """Profiler which reports the stages of a build to the clients waiting on it."""
+    def __init__(self, job):
+        self.job = job
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Reports the start and end of a stage."""
+        self.job.emit({'event': 'stage', 'stage': name, 'status': 'start'})
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.job.emit({'event': 'stage', 'stage': name, 'status': 'done',
+                           'wall': time.time() - start})
+
+    def log_event(self, event):
+        """Reports an error or warning from LaTeX output."""
+        self.job.emit({'event': 'log', 'kind': event.kind, 'message': event.message,
+                       'file': event.file, 'line': event.line})
+
+def _path(request, name):
+    """Reads a path from a request, which must be given."""
+    if not request.get(name):
+        raise ValueError('Request is missing {0}'.format(name))
+    return os.path.abspath(request[name])
+
+def _info(paper):
+    """Finds the root document and template of a paper."""
+    root = scriptorium.paper_root(paper)
+    if not root:
+        raise IOError('{0} does not contain a valid root document.'.format(paper))
+    return {'root': root, 'template': scriptorium.get_template(os.path.join(paper, root))}
+
+def _new(output, template, force, config):
+    """Creates a paper, listing any variables left unset."""
+    return {'unset': scriptorium.create(output, template, force=force, config=config)}
+
+class Server(object):
+    """Build daemon keeping the template index, imports, and worker pools warm between requests.
+
+    Up to jobs builds run at once, and builds of the same paper run one at a time. A build request
+    joins any queued build of the same paper with the same options instead of starting another, so
+    bursts of requests from editors collapse into a single build.
+    """
+    def __init__(self, jobs=1, template_dir=None):
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        import multiprocessing
+        self.template_dir = template_dir or scriptorium.CONFIG['TEMPLATE_DIR']
+        self.executor = ThreadPoolExecutor(max_workers=jobs + 1)
+        #Forking workers while other threads hold locks can deadlock them, so use a fork server
+        self.pool = ProcessPoolExecutor(max_workers=jobs,
+                                        mp_context=multiprocessing.get_context('forkserver'))
+        self.jobs = jobs
+        self.slots = None
+        self.queued = {}
+        self.locks = {}
+
+    def close(self):
+        """Shuts down the worker pools."""
+        self.executor.shutdown()
+        self.pool.shutdown()
+
+    async def _run_build(self, key, job, paper, options):
+        """Runs a build once the paper and a build slot are free."""
+        lock = self.locks.setdefault(paper, asyncio.Lock())
+        async with lock, self.slots:
+            #Requests arriving from now on see changes this build may have missed
+            if self.queued.get(key) is job:
+                del self.queued[key]
+            builder = Builder(paper, self.template_dir, self.executor, pool=self.pool,
+                              profiler=_Progress(job), **options)
+            return await builder.build()
+
+    async def build(self, writer, req_id, paper, options):
+        """Builds a paper for a client, returning the PDF filename."""
+        unknown = set(options) - _BUILD_OPTIONS
+        if unknown:
+            raise ValueError('Unknown build options {0}'.format(', '.join(sorted(unknown))))
+        key = (paper, json.dumps(options, sort_keys=True))
+        job = self.queued.get(key)
+        if job is None:
+            job = _Job()
+            self.queued[key] = job
+            job.task = asyncio.ensure_future(self._run_build(key, job, paper, options))
+        job.clients.append((writer, req_id))
+        return {'pdf': await asyncio.shield(job.task)}
+
+    async def dispatch(self, writer, request):
+        """Answers a single request."""
+        loop = asyncio.get_event_loop()
+        req_id = request.get('id')
+        try:
+            cmd = request.get('cmd')
+            if cmd == 'build':
+                result = await self.build(writer, req_id, _path(request, 'paper'),
+                                          request.get('options', {}))
+            elif cmd == 'info':
+                result = await loop.run_in_executor(self.executor, _info,
+                                                    _path(request, 'paper'))
+            elif cmd == 'new':
+                result = await loop.run_in_executor(self.executor, _new,
+                                                    _path(request, 'output'),
+                                                    request.get('template'),
+                                                    request.get('force', False),
+                                                    request.get('config', {}))
+            else:
+                raise ValueError('Unknown command {0}'.format(cmd))
+        except Exception as exc:
+            _send(writer, {'id': req_id, 'event': 'error',
+                           'error': str(exc) or exc.__class__.__name__})
+        else:
+            _send(writer, dict(result, id=req_id, event='result'))
+
+    async def handle(self, reader, writer):
+        """Answers requests from a client until it disconnects."""
+        pending = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('Request must be an object')
+            except ValueError as exc:
+                _send(writer, {'id': None, 'event': 'error', 'error': str(exc)})
+                continue
+            pending.append(asyncio.ensure_future(self.dispatch(writer, request)))
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        writer.close()
+
+    async def serve(self, socket_path, ready=None):
+        """Listens on socket_path until cancelled, calling ready once accepting connections."""
+        loop = asyncio.get_event_loop()
+        self.slots = asyncio.Semaphore(self.jobs)
+        #Build the template index before the first request needs it
+        await loop.run_in_executor(self.executor, scriptorium.all_templates, self.template_dir)
+        #Other users must never be able to connect, so the socket is created without their access
+        #rather than restricted once it is listening
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            sock.bind(socket_path)
+        except BaseException:
+            sock.close()
+            raise
+        finally:
+            os.umask(old_umask)
+        server = await asyncio.start_unix_server(self.handle, sock=sock)
+        if ready:
+            ready()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+def _check_stale(socket_path):
+    """Removes a socket left behind by a daemon which has exited."""
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        os.remove(socket_path)
+    else:
+        raise IOError('A daemon is already listening on {0}'.format(socket_path))
+    finally:
+        sock.close()
+
+def serve(socket_path=None, jobs=1, template_dir=None, ready=None):
+    """Runs the build daemon on the UNIX socket at socket_path until interrupted."""
+    socket_path = socket_path or SOCKET_PATH
+    dname = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.exists(dname):
+        os.makedirs(dname, 0o700)
+    _check_stale(socket_path)
+
+    server = Server(jobs, template_dir)
+    try:
+        asyncio.run(server.serve(socket_path, ready))
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
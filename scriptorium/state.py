@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Persistent build state kept alongside a paper between builds."""
+
+import hashlib
+import json
+import os
+import tempfile
+
+STATE_DIR = '.scriptorium'
+
+def state_path(dname, name):
+    """Returns the path of the named state file for the given directory."""
+    return os.path.join(dname, STATE_DIR, '{0}.json'.format(name))
+
+def load_state(dname, name):
+    """Reads the named state dictionary, returning an empty one if it is missing or unreadable."""
+    try:
+        with open(state_path(dname, name), 'r') as state_fp:
+            state = json.load(state_fp)
+    except (EnvironmentError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+def save_state(dname, name, state):
+    """Atomically writes the named state dictionary for the given directory."""
+    fname = state_path(dname, name)
+    sdir = os.path.dirname(fname)
+    if not os.path.exists(sdir):
+        os.makedirs(sdir)
+    fdesc, tmp_name = tempfile.mkstemp(dir=sdir, suffix='.tmp')
+    try:
+        with os.fdopen(fdesc, 'w') as state_fp:
+            json.dump(state, state_fp, indent=1, sort_keys=True, default=str)
+        if os.name == 'nt' and os.path.exists(fname):
+            os.remove(fname)
+        os.rename(tmp_name, fname)
+    except EnvironmentError:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+def hash_bytes(data):
+    """Returns a hex digest for the given bytes or text."""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+def hash_file(fname):
+    """Returns a hex digest of a file's contents, or None if it cannot be read."""
+    digest = hashlib.sha1()
+    try:
+        with open(fname, 'rb') as hash_fp:
+            for chunk in iter(lambda: hash_fp.read(1 << 16), b''):
+                digest.update(chunk)
+    except EnvironmentError:
+        return None
+    return digest.hexdigest()
@@ -5,85 +5,292 @@ import subprocess
 import re
 import os
 import os.path
-import yaml
+import threading
 
 import scriptorium
+from scriptorium.state import STATE_DIR, load_state, save_state, hash_bytes
 
-def all_templates(dname=None):
-    """Builds list of installed templates."""
+_INDEXES = {}
+
+#Files whose contents are summarized in the template index
+_META_FILES = ['manifest.yml', 'default_config.yml', 'frontmatter.mmd', 'metadata.tex']
+
+def _mtime(path):
+    """Returns modification time of a path, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _walk(dname):
+    """Walks a directory tree, skipping version control and scriptorium state."""
+    for dirpath, dirnames, filenames in os.walk(dname):
+        dirnames[:] = [ii for ii in dirnames if ii not in ['.git', STATE_DIR]]
+        yield dirpath, dirnames, filenames
+
+def _index_stamp(template_dir):
+    """Summarizes template directory state, changing whenever template repositories are added,
+    removed, or checked out to a different revision, or their top two levels of directories change.
+
+    Only those levels are looked at, so the stamp stays cheap for large trees. Templates added
+    further down are found once the index is rescanned, as all_templates can be asked to.
+    """
+    #The directory's own modification time is left out, as saving the index changes it
+    stamp = {}
+    for entry in sorted(os.listdir(template_dir)):
+        path = os.path.join(template_dir, entry)
+        if entry == STATE_DIR or not os.path.isdir(path):
+            continue
+        children = sorted(os.path.join(path, ii) for ii in os.listdir(path)
+                          if ii not in ['.git', STATE_DIR])
+        paths = [path] + [ii for ii in children if os.path.isdir(ii)]
+        git_dir = os.path.join(path, '.git')
+        if os.path.isdir(git_dir):
+            paths += [os.path.join(git_dir, 'HEAD'), os.path.join(git_dir, 'index')]
+        stamp[entry] = [_mtime(ii) for ii in paths]
+    return stamp
+
+def _save_index(template_dir, index):
+    """Saves template index, ignoring template directories which cannot be written."""
+    try:
+        save_state(template_dir, 'templates', index)
+    except EnvironmentError:
+        pass
+
+def _template_index(template_dir, rescan=False):
+    """Loads index of directories and templates in template_dir, rebuilding it if stale or if
+    rescan is set.
+    """
+    stamp = _index_stamp(template_dir)
+    index = _INDEXES.get(template_dir)
+    if not index or index['stamp'] != stamp:
+        index = load_state(template_dir, 'templates')
+    if rescan or not index or index.get('stamp') != stamp:
+        meta = index.get('meta', {}) if index and index.get('stamp') == stamp else {}
+        index = {'stamp': stamp, 'dirs': {}, 'templates': [], 'meta': meta}
+        for dirpath, _, filenames in _walk(template_dir):
+            name = os.path.basename(dirpath)
+            if name not in index['dirs']:
+                index['dirs'][name] = os.path.relpath(dirpath, template_dir)
+            if 'setup.tex' in filenames:
+                index['templates'].append(name)
+        _save_index(template_dir, index)
+    _INDEXES[template_dir] = index
+    return index
+
+def _template_meta(template, template_dir):
+    """Looks up cached manifest, default configuration, and variables for a template,
+    reading them from the template files if they have changed.
+    """
+    template_dir = template_dir if template_dir else scriptorium.CONFIG['TEMPLATE_DIR']
+    template_loc = find_template(template, template_dir)
+    stamp = [_mtime(template_loc)] + [_mtime(os.path.join(template_loc, ii)) for ii in _META_FILES]
+
+    index = _template_index(template_dir)
+    meta = index['meta'].get(template)
+    if not meta or meta['stamp'] != stamp:
+        meta = {
+            'stamp': stamp,
+            'manifest': _read_manifest(template_loc),
+            'config': _read_default_config(template_loc),
+            'variables': _read_variables(template_loc)
+        }
+        index['meta'][template] = meta
+        _save_index(template_dir, index)
+    return meta
+
+def all_templates(dname=None, rescan=False):
+    """Builds list of installed templates, scanning for them again if rescan is set."""
     if not dname or not os.path.exists(dname):
         dname = scriptorium.CONFIG['TEMPLATE_DIR']
-    templates = []
-    for dirpath, _, filenames in os.walk(dname):
-        if 'setup.tex' in filenames:
-            templates.append(os.path.basename(dirpath))
-
-    return templates
+    return list(_template_index(dname, rescan)['templates'])
 
 def find_template(tname, template_dir=None):
     """Searches given template directory for the named template."""
     template_dir = template_dir if template_dir else scriptorium.CONFIG['TEMPLATE_DIR']
-    for dirpath, _, _ in os.walk(template_dir):
-        if os.path.basename(dirpath) == tname:
-            return os.path.join(template_dir, dirpath)
+    if os.path.isdir(template_dir):
+        loc = _template_index(template_dir)['dirs'].get(tname)
+        if loc and os.path.isdir(os.path.join(template_dir, loc)):
+            return os.path.join(template_dir, loc)
     raise IOError('{0} cannot be found in {1}'.format(tname, template_dir))
 
+def template_revision(template, template_dir=None):
+    """Identifies the current revision of a template.
+
+    Templates in git repositories are identified by their HEAD commit, while other templates are
+    identified by a digest of their files' names, sizes, and modification times.
+    """
+    template_loc = find_template(template, template_dir)
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=template_loc,
+                                      stderr=subprocess.STDOUT, universal_newlines=True)
+        return rev.strip()
+    except (subprocess.CalledProcessError, EnvironmentError):
+        pass
+
+    stats = []
+    for dirpath, _, filenames in _walk(template_loc):
+        for fname in sorted(filenames):
+            stat = os.stat(os.path.join(dirpath, fname))
+            stats.append('{0}:{1}:{2}'.format(os.path.relpath(os.path.join(dirpath, fname),
+                                                              template_loc),
+                                              stat.st_size, stat.st_mtime))
+    return hash_bytes('\n'.join(sorted(stats)))
+
+_TREEISH_RE = re.compile(r'[A-Za-z0-9_\-\.]+')
+_MIRROR_LOCKS = {}
+_MIRROR_LOCKS_LOCK = threading.Lock()
+
+def _git(args, cwd=None):
+    """Runs a git command, returning its output."""
+    return subprocess.check_output(['git'] + args, cwd=cwd, stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+
 def repo_checkout(repo, rev):
     """Checks out a specific revision of the repository."""
-    old_cwd = os.getcwd()
-    os.chdir(repo)
-    subprocess.check_call(['git', 'checkout', rev])
-    os.chdir(old_cwd)
+    subprocess.check_call(['git', 'checkout', rev], cwd=repo)
 
-def install_template(url, template_dir=None, rev=None):
-    """Installs a template in the template_dir, optionally selecting a revision."""
+def _mirror_lock(path):
+    """Returns the lock serializing use of the mirror at path within this process."""
+    with _MIRROR_LOCKS_LOCK:
+        return _MIRROR_LOCKS.setdefault(path, threading.Lock())
+
+def _refresh_mirror(url, mirror_dir):
+    """Creates or updates a bare mirror of the repository at url inside mirror_dir.
+
+    Returns the path of the mirror, which is named after the URL so each repository is mirrored
+    once no matter how many template directories use it.
+    """
+    name = re.sub(r'[^\w\-\.]+', '_', url.rstrip('/')).strip('_')
+    mirror = os.path.join(os.path.expanduser(mirror_dir), '{0}-{1}.git'.format(name[-40:],
+                                                                             hash_bytes(url)[:8]))
+    with _mirror_lock(mirror):
+        if os.path.exists(mirror):
+            _git(['remote', 'update', '--prune'], cwd=mirror)
+        else:
+            if not os.path.exists(os.path.dirname(mirror)):
+                os.makedirs(os.path.dirname(mirror))
+            _git(['clone', '--mirror', url, mirror])
+    return mirror
+
+def _template_url(url):
+    """Splits a template URL into its repository name, raising ValueError if it is invalid."""
     url_re = re.compile(r'((git|ssh|http(s)?)(:(//)?)|([\w\d]*@))?(?P<url>[\w\.]+).*\/(?P<dir>[\w\-]+)(\.git)(/)?')
     match = url_re.search(url)
     if not match:
         raise ValueError('{0} is not a valid git URL'.format(url))
-    template = match.group('dir')
+    return match.group('dir')
+
+def install_template(url, template_dir=None, rev=None, depth=None, mirror=None):
+    """Installs a template in the template_dir, optionally selecting a revision.
+
+    If depth is given, only that many commits of history are cloned, and rev must name a branch
+    or tag. If mirror is given, or the TEMPLATE_MIRROR configuration option is set, the repository
+    is cloned from a bare mirror kept in that directory, which is only updated from url.
+    """
+    template = _template_url(url)
     template_dir = template_dir if template_dir else scriptorium.CONFIG['TEMPLATE_DIR']
     template_dest = os.path.join(template_dir, template)
+    mirror = mirror or scriptorium.CONFIG.get('TEMPLATE_MIRROR')
 
     if os.path.exists(template_dest):
         raise IOError('{0} already exists, cannot install on top'.format(template))
 
+    rev = rev if rev and _TREEISH_RE.match(rev) else None
+    clone_cmd = ['clone']
+    if depth:
+        clone_cmd += ['--depth', str(depth)] + (['--branch', rev] if rev else [])
     try:
-        subprocess.check_output(['git', 'clone', url, template_dest], universal_newlines=True)
+        if mirror:
+            source = _refresh_mirror(url, mirror)
+            #Shallow clones of local repositories need a URL rather than a path
+            _git(clone_cmd + ['file://' + os.path.abspath(source), template_dest])
+            _git(['remote', 'set-url', 'origin', url], cwd=template_dest)
+        else:
+            _git(clone_cmd + [url, template_dest])
     except subprocess.CalledProcessError as exc:
         raise IOError('\n'.join(['Could not clone template:', exc.output]))
 
-    treeish_re = re.compile(r'[A-Za-z0-9_\-\.]+')
-    if rev and treeish_re.match(rev):
+    if rev and not depth:
         repo_checkout(template_dest, rev)
 
-def update_template(template, template_dir=None, rev=None):
-    """Updates the given template repository."""
-    template_loc = find_template(template, template_dir)
+def _update_repo(repo, rev=None, depth=None, mirror=None):
+    """Fetches and checks out the latest version of rev in a template repository, defaulting to
+    the branch currently checked out.
+    """
+    source = 'origin'
+    if mirror:
+        source = _refresh_mirror(_git(['config', '--get', 'remote.origin.url'], cwd=repo).strip(),
+                                 mirror)
+    depth_args = ['--depth', str(depth)] if depth else []
+    _git(['fetch'] + depth_args + [source], cwd=repo)
+    current_rev = _git(['symbolic-ref', '--short', 'HEAD'], cwd=repo).rstrip()
+    rev = rev if rev else current_rev
+    if _TREEISH_RE.match(rev):
+        if rev != current_rev:
+            _git(['checkout', rev], cwd=repo)
+        _git(['pull'] + depth_args + [source, rev], cwd=repo)
 
-    old_cwd = os.getcwd()
-    os.chdir(template_loc)
+def update_template(template, template_dir=None, rev=None, depth=None, mirror=None):
+    """Updates the given template repository.
+
+    If depth is given, history stays limited to that many commits. If mirror is given, or the
+    TEMPLATE_MIRROR configuration option is set, updates are fetched through a bare mirror kept
+    in that directory.
+    """
+    template_loc = find_template(template, template_dir)
     try:
-        subprocess.check_call(['git', 'fetch', 'origin'])
-        git_cmd = ['git', 'symbolic-ref', '--short', 'HEAD']
-        current_rev = subprocess.check_output(git_cmd, universal_newlines=True)
-        current_rev = current_rev.rstrip()
-        rev = rev if rev else current_rev
-        treeish_re = re.compile(r'[A-Za-z0-9_\-\.]+')
-        if treeish_re.match(rev):
-            if rev != current_rev:
-                subprocess.check_call(['git', 'checkout', rev])
-            subprocess.check_call(['git', 'pull', 'origin', rev])
+        _update_repo(template_loc, rev, depth, mirror or scriptorium.CONFIG.get('TEMPLATE_MIRROR'))
     except subprocess.CalledProcessError as exc:
         raise IOError('Cannot update {0}:\n {1}'.format(template, exc.output))
-    os.chdir(old_cwd)
 
-def list_variables(template, template_dir=None):
-    """List variables a template offers for paper creation."""
+def _run_all(func, items, jobs):
+    """Applies func to each item using up to jobs threads, yielding each item and error message,
+    if any, as they finish.
+    """
+    def run(item):
+        """Runs func, capturing its error message."""
+        try:
+            func(item)
+            return None
+        except subprocess.CalledProcessError as exc:
+            return exc.output or str(exc)
+        except Exception as exc:
+            return str(exc) or exc.__class__.__name__
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {pool.submit(run, item): item for item in items}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def update_all_templates(template_dir=None, jobs=1, depth=None, mirror=None):
+    """Updates every template repository in template_dir, using up to jobs concurrent updates.
+
+    Yields each repository name and error message, if any, as its update finishes.
+    """
     template_dir = template_dir if template_dir else scriptorium.CONFIG['TEMPLATE_DIR']
+    mirror = mirror or scriptorium.CONFIG.get('TEMPLATE_MIRROR')
+    repos = sorted(ii for ii in os.listdir(template_dir)
+                   if os.path.isdir(os.path.join(template_dir, ii, '.git')))
+    return _run_all(lambda repo: _update_repo(os.path.join(template_dir, repo), None, depth,
+                                              mirror),
+                    repos, jobs)
 
-    template_loc = find_template(template, template_dir)
+def install_templates(urls, template_dir=None, jobs=1, depth=None, mirror=None):
+    """Installs templates from a list of URLs, each optionally followed by a revision, using up
+    to jobs concurrent clones. Yields each URL and error message, if any, as its clone finishes.
+    """
+    entries = [tuple(ii.split(None, 1)) for ii in urls]
+    results = _run_all(lambda entry: install_template(entry[0], template_dir,
+                                                      entry[1].strip() if len(entry) > 1 else None,
+                                                      depth, mirror),
+                       entries, jobs)
+    for entry, err in results:
+        yield entry[0], err
 
+def _read_variables(template_loc):
+    """Reads variables offered by the template files in template_loc."""
     var_re = re.compile(r'\$(?P<var>[A-Z0-9]+)')
 
     files = [os.path.join(template_loc, 'frontmatter.mmd'),
@@ -98,16 +305,14 @@ def list_variables(template, template_dir=None):
                         variables.append(match.group('var'))
         except EnvironmentError:
             pass
-    return list(set(variables))
+    return sorted(set(variables))
 
-def get_manifest(template, template_dir=None):
-    """
-    Get manifest for a given template with keys as output names, and values as input names.
+def list_variables(template, template_dir=None):
+    """List variables a template offers for paper creation."""
+    return list(_template_meta(template, template_dir)['variables'])
 
-    This list of files defines which files should be used when creating a new paper using this document.
-    """
-    template_dir = template_dir if template_dir else scriptorium.CONFIG['TEMPLATE_DIR']
-    template_loc = find_template(template, template_dir)
+def _read_manifest(template_loc):
+    """Reads manifest of the template in template_loc."""
     manifest_path = os.path.join(template_loc, 'manifest.yml')
     manifest = {
         'paper.mmd': 'frontmatter.mmd',
@@ -115,22 +320,34 @@ def get_manifest(template, template_dir=None):
         }
 
     if os.path.exists(manifest_path):
+        import yaml
         with open(manifest_path, 'r') as mfp:
-            manifest = yaml.load(mfp)
+            manifest = yaml.safe_load(mfp)
 
     #Remove non-existent files from manifest list
     manifest = {kk:vv for kk, vv in manifest.items() if os.path.exists(os.path.join(template_loc, vv))}
     return manifest
 
-def get_default_config(template, template_dir=None):
-    """Get default configuration options if available."""
-    template_dir = template_dir if template_dir else scriptorium.CONFIG['TEMPLATE_DIR']
-    template_loc = find_template(template, template_dir)
+def get_manifest(template, template_dir=None):
+    """
+    Get manifest for a given template with keys as output names, and values as input names.
+
+    This list of files defines which files should be used when creating a new paper using this document.
+    """
+    return dict(_template_meta(template, template_dir)['manifest'])
+
+def _read_default_config(template_loc):
+    """Reads default configuration options of the template in template_loc."""
     config_path = os.path.join(template_loc, 'default_config.yml')
     config = {}
 
     if os.path.exists(config_path):
+        import yaml
         with open(config_path, 'r') as cfp:
-            raw_config = yaml.load(cfp)
+            raw_config = yaml.safe_load(cfp)
         config = {kk.upper(): vv for kk, vv in raw_config.items()}
     return config
+
+def get_default_config(template, template_dir=None):
+    """Get default configuration options if available."""
+    return dict(_template_meta(template, template_dir)['config'])
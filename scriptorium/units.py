@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""Splitting converted papers into chapter units, for building only some of them."""
+
+import io
+import os
+import os.path
+import re
+
+from scriptorium.papers import _list_files, get_template, read_frontmatter
+
+#LaTeX sectioning commands, in the order of the heading levels MultiMarkdown converts to
+_LEVELS = ['part', 'chapter', 'section', 'subsection', 'subsubsection', 'paragraph', 'subparagraph']
+_HEADING_RE = re.compile(r'^\s*\\(?P<level>' + '|'.join(_LEVELS) + r')\*?\s*(?:\[[^\]]*\]\s*)?\{')
+_TRANSCLUDE_RE = re.compile(r'\{\{(?P<name>[^}]+)\}\}')
+
+def _title(line, start):
+    """Reads the brace delimited argument opening just before start."""
+    depth = 1
+    for pos in range(start, len(line)):
+        if line[pos] == '{' and line[pos - 1] != '\\':
+            depth += 1
+        elif line[pos] == '}' and line[pos - 1] != '\\':
+            depth -= 1
+            if depth == 0:
+                return line[start:pos].strip()
+    return line[start:].strip()
+
+def _headings(lines, level=None):
+    """Lists the index, level, and title of each sectioning heading in lines."""
+    headings = []
+    for idx, line in enumerate(lines):
+        match = _HEADING_RE.match(line)
+        if match and (level is None or match.group('level') == level):
+            headings.append((idx, match.group('level'), _title(line, match.end())))
+    return headings
+
+def _read_lines(fname):
+    """Reads a LaTeX file as a list of lines."""
+    with io.open(fname, 'r', encoding='utf-8', errors='surrogateescape') as tex_fp:
+        return tex_fp.readlines()
+
+def _write_if_changed(fname, text):
+    """Writes a file unless it already holds text, so unchanged units keep their timestamps."""
+    try:
+        with io.open(fname, 'r', encoding='utf-8', errors='surrogateescape') as tex_fp:
+            if tex_fp.read() == text:
+                return
+    except EnvironmentError:
+        pass
+    with io.open(fname, 'w', encoding='utf-8', errors='surrogateescape') as tex_fp:
+        tex_fp.write(text)
+
+def _base_level(fname):
+    """Reads the Base Header Level of a MultiMarkdown file, which defaults to 1."""
+    try:
+        return int(read_frontmatter(fname, ['baseheaderlevel']).get('baseheaderlevel', 1))
+    except ValueError:
+        return 1
+
+def _source_units(fname, paper_dir, out_dir, units):
+    """Maps the name of each paper file to the units converted from it.
+
+    Files are converted on their own, so their headings are shifted from their own Base Header
+    Level to the root's, then matched in the order the root transcludes them against the units.
+    Units matched by no transcluded file belong to the root itself.
+    """
+    sources = dict((os.path.basename(ii).split('.')[0], ii) for ii in _list_files(paper_dir))
+    base = _base_level(fname)
+    with io.open(fname, 'r', encoding='utf-8', errors='replace') as mmd_fp:
+        names = [ii.strip() for ii in _TRANSCLUDE_RE.findall(mmd_fp.read())]
+
+    mapping = {}
+    pos = 0
+    for name in names:
+        source = sources.get(name.split('.')[0])
+        tex_name = os.path.join(out_dir, '{0}.tex'.format(name.split('.')[0]))
+        if os.path.dirname(name) or not source or not os.path.exists(tex_name):
+            continue
+        shift = base - _base_level(source)
+        titles = [title for _, level, title in _headings(_read_lines(tex_name))
+                  if _LEVELS.index(level) + shift == _LEVELS.index('chapter')]
+        if not titles:
+            continue
+        for start in range(pos, len(units) - len(titles) + 1):
+            if [ii[1] for ii in units[start:start + len(titles)]] == titles:
+                mapping[os.path.basename(source)] = [ii[0] for ii in
+                                                     units[start:start + len(titles)]]
+                pos = start + len(titles)
+                break
+
+    claimed = set(unit for found in mapping.values() for unit in found)
+    mapping[os.path.basename(fname)] = [ii[0] for ii in units if ii[0] not in claimed]
+    return mapping
+
+def _select(units, only, files):
+    """Picks the units whose titles match, or come from the files named by, any entry of only.
+    Files are given by name, with or without extension, and entries which are not a whole title
+    match every title containing them.
+    """
+    selected = []
+    for name in only:
+        matches = [found for fname, found in files.items()
+                   if name in (fname, fname.split('.')[0])]
+        matches = matches[0] if matches else []
+        #Exact titles win over partial ones, so Chapter 1 does not also pick Chapter 10
+        matches = matches or [unit for unit, title in units if name.lower() == title.lower()]
+        matches = matches or [unit for unit, title in units if name.lower() in title.lower()]
+        if not matches:
+            chapters = '\n'.join('  {0}'.format(ii[1]) for ii in units)
+            raise ValueError('{0} matches no chapter or file of the paper. '
+                             'Chapters are:\n{1}'.format(name, chapters))
+        selected += [ii for ii in matches if ii not in selected]
+    return selected
+
+def write_units(fname, paper_dir, out_dir, only):
+    """Splits the LaTeX converted from the paper rooted at fname into one file per chapter, and
+    writes a driver document including them.
+
+    The driver limits compilation to the units matching only, a list of chapter titles or paper
+    file names, with \\includeonly, so LaTeX takes everything about the other units from their
+    .aux files. Until every unit has been compiled once, all of them are compiled. Returns the
+    driver filename, which is built with the jobname of the paper so it shares its outputs.
+    """
+    bname = os.path.basename(fname).split('.')[0]
+    template = get_template(fname)
+    lines = _read_lines(os.path.join(out_dir, '{0}.tex'.format(bname)))
+
+    #Units are cut from the body, between the template setup and footer
+    setup = [idx for idx, line in enumerate(lines) if '{0}/setup.tex'.format(template) in line]
+    footer = [idx for idx, line in enumerate(lines) if '{0}/footer.tex'.format(template) in line]
+    if not setup or not footer or footer[-1] < setup[0]:
+        raise IOError('{0} does not load its template setup and footer, so it cannot be split '
+                      'into units.'.format(fname))
+    start, end = setup[0] + 1, footer[-1]
+
+    #Every unit starts a page, so papers without chapters are not split at their sections
+    headings = [(idx + start, lvl, title) for idx, lvl, title in
+                _headings(lines[start:end], 'chapter')]
+    if not headings:
+        raise IOError('{0} has no chapters to build separately.'.format(fname))
+
+    units = []
+    body = lines[start:headings[0][0]]
+    bounds = [ii[0] for ii in headings] + [end]
+    for num, (idx, _, title) in enumerate(headings):
+        unit = '{0}-unit{1:03d}'.format(bname, num + 1)
+        text = ''.join(lines[idx:bounds[num + 1]])
+        _write_if_changed(os.path.join(out_dir, unit + '.tex'), text)
+        units.append((unit, title))
+        body.append('\\include{{{0}}}\n'.format(unit))
+
+    selected = _select(units, only, _source_units(fname, paper_dir, out_dir, units))
+    preamble = lines[:setup[0]]
+    if all(os.path.exists(os.path.join(out_dir, unit + '.aux')) for unit, _ in units):
+        preamble.append('\\includeonly{{{0}}}\n'.format(','.join(selected)))
+
+    driver = os.path.join(out_dir, '{0}-only.tex'.format(bname))
+    _write_if_changed(driver, ''.join(preamble + [lines[setup[0]]] + body + lines[end:]))
+    return driver
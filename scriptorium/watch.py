@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Watching papers for changes and rebuilding them."""
+
+import os
+import os.path
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+import scriptorium
+from scriptorium.papers import _bib_files
+from scriptorium.state import STATE_DIR
+
+_IGNORED_DIRS = set(['.git', STATE_DIR])
+
+def _walk_dirs(dname):
+    """Lists directories under dname, skipping version control and build state."""
+    dirs = []
+    for dirpath, dirnames, _ in os.walk(dname):
+        dirnames[:] = [ii for ii in dirnames if ii not in _IGNORED_DIRS]
+        dirs.append(dirpath)
+    return dirs
+
+def _snapshot(dirs, files):
+    """Records modification time and size of every file within dirs, along with the given files."""
+    snapshot = {}
+    paths = list(files)
+    for dname in dirs:
+        for dirpath in _walk_dirs(dname):
+            paths += [os.path.join(dirpath, ii) for ii in os.listdir(dirpath)]
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if not os.path.isdir(path):
+            snapshot[path] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+class _Poller(object):
+    """Waits for changes by comparing snapshots taken between sleeps."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.dirs = []
+        self.files = []
+        self.snapshot = {}
+
+    def watch(self, dirs, files):
+        """Takes the snapshot later ones are compared against."""
+        self.dirs = dirs
+        self.files = files
+        self.snapshot = _snapshot(dirs, files)
+
+    def wait(self, timeout):
+        """Sleeps for the timeout, returning whether anything changed meanwhile."""
+        time.sleep(timeout)
+        current = _snapshot(self.dirs, self.files)
+        changed = current != self.snapshot
+        self.snapshot = current
+        return changed
+
+class _Notifier(object):
+    """Waits for changes using inotify events, without walking the watched directories."""
+    def __init__(self):
+        self.inotify = inotify_simple.INotify()
+        self.watched = {}
+        self.names = {}
+        flags = inotify_simple.flags
+        self.mask = flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | flags.MODIFY | \
+                    flags.MOVED_FROM | flags.MOVED_TO
+
+    def _add(self, dirpath, name=None):
+        """Watches dirpath for changes to the file called name, or to any file if name is None."""
+        if dirpath not in self.watched:
+            try:
+                wdesc = self.inotify.add_watch(dirpath, self.mask)
+            except OSError:
+                return
+            self.watched[dirpath] = wdesc
+            self.names[wdesc] = set()
+        wdesc = self.watched[dirpath]
+        if name is None:
+            self.names[wdesc] = None
+        elif self.names[wdesc] is not None:
+            self.names[wdesc].add(name)
+
+    def watch(self, dirs, files):
+        """Registers any directories not already watched, and drops the events of the last build."""
+        for dname in dirs:
+            for dirpath in _walk_dirs(dname):
+                self._add(dirpath)
+        for fname in files:
+            self._add(os.path.dirname(os.path.abspath(fname)), os.path.basename(fname))
+        while self.inotify.read(timeout=0):
+            pass
+
+    def wait(self, timeout):
+        """Blocks until a watched file changes or the timeout expires, returning whether one did."""
+        changed = False
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            names = self.names.get(event.wd, ())
+            changed = changed or names is None or event.name in names
+        return changed
+
+def watch(paper_dir, template_dir=None, debounce=0.5, poll_interval=1.0, on_build=None, jobs=1,
+          **kwargs):
+    """Rebuilds the paper in paper_dir whenever it, its template, or its bibliography changes.
+
+    Bursts of changes are coalesced until no change has been seen for debounce seconds. Changes
+    are found with inotify where available, and otherwise by polling every poll_interval seconds.
+    Each build reuses the conversion and rerun caches of to_pdf, so only stages with changed inputs
+    do work, and with several jobs the same conversion processes serve every build.
+    on_build is called with the PDF filename and error message after every build.
+    Keyword arguments are passed on to to_pdf. Runs until interrupted.
+    """
+    template_dir = template_dir or scriptorium.CONFIG['TEMPLATE_DIR']
+    paper_dir = os.path.abspath(paper_dir)
+    root = scriptorium.paper_root(paper_dir)
+    if not root:
+        raise IOError("{0} has no obvious root.".format(paper_dir))
+    root = os.path.join(paper_dir, root)
+
+    dirs = [paper_dir]
+    template = scriptorium.get_template(root)
+    if template:
+        dirs.append(os.path.abspath(os.path.join(scriptorium.find_template(template, template_dir),
+                                                 '..')))
+    files = _bib_files(root)
+
+    pool = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=jobs)
+
+    waiter = _Notifier() if inotify_simple else _Poller(poll_interval)
+    built = False
+    try:
+        while True:
+            if built:
+                if not waiter.wait(poll_interval):
+                    continue
+                #Wait for the burst of saves to settle before rebuilding
+                while waiter.wait(debounce):
+                    pass
+
+            try:
+                pdf, err = scriptorium.to_pdf(paper_dir, template_dir=template_dir, jobs=jobs,
+                                              pool=pool, **kwargs), None
+            except Exception as exc:
+                pdf, err = None, str(exc) or exc.__class__.__name__
+            if on_build:
+                on_build(pdf, err)
+
+            files = _bib_files(root) if os.path.exists(root) else files
+            waiter.watch(dirs, files)
+            built = True
+    finally:
+        if pool is not None:
+            pool.shutdown()
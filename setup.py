@@ -40,6 +40,10 @@ setup(
     install_requires=[
         'pyyaml',
         'argcomplete',
-        'pymmd>=0.3'
-    ]
+        'pymmd>=0.3',
+        'futures; python_version < "3"'
+    ],
+    extras_require={
+        'watch': ['inotify_simple']
+    }
     )
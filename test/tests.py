@@ -3,13 +3,83 @@
 """Unit testing for scriptorium"""
 
 import os
+import subprocess
+import sys
 import tempfile
 import shutil
 import textwrap
+import time
 import unittest
 
 import scriptorium
 
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench')
+
+def _have_mmd():
+  """Check libMultiMarkdown can be loaded, which converting papers needs."""
+  try:
+    import pymmd
+    pymmd.version()
+  except Exception:
+    return False
+  return True
+
+def _git(args, cwd):
+  """Run git with a fixed identity, so commits work without user configuration."""
+  subprocess.check_output(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] +
+                          args, cwd=cwd, stderr=subprocess.STDOUT)
+
+class StubBuildTestCase(unittest.TestCase):
+    """Base for tests building papers offline with the stub LaTeX tools of the benchmarks."""
+    def setUp(self):
+      """Create a template tree and paper, putting the stub toolchain first on the path."""
+      if not _have_mmd():
+        self.skipTest('libMultiMarkdown is not available')
+      if BENCH_DIR not in sys.path:
+        sys.path.insert(0, BENCH_DIR)
+      import generate
+      self.generate = generate
+      self.work = tempfile.mkdtemp()
+      self.old_path = os.environ['PATH']
+      self.old_config = {kk: scriptorium.CONFIG[kk]
+                         for kk in ['TEMPLATE_DIR', 'LATEX_CMD', 'ARTIFACT_DIR']}
+      stubs = generate.make_stubs(os.path.join(self.work, 'bin'), sys.executable, 0.0, 0.0)
+      os.environ['PATH'] = stubs + os.pathsep + self.old_path
+      self.template_dir = os.path.join(self.work, 'templates')
+      self.template = generate.make_template_tree(self.template_dir, 1, 1, 2)[0]
+      scriptorium.CONFIG['TEMPLATE_DIR'] = self.template_dir
+      scriptorium.CONFIG['LATEX_CMD'] = 'xelatex'
+      scriptorium.CONFIG['ARTIFACT_DIR'] = os.path.join(self.work, 'artifacts')
+      self.paper = os.path.join(self.work, 'paper')
+      generate.make_paper(self.paper, self.template, files=3, sections=2, words=20, citations=3)
+
+    def tearDown(self):
+      """Restore the environment and remove scratch files."""
+      os.environ['PATH'] = self.old_path
+      scriptorium.CONFIG.update(self.old_config)
+      shutil.rmtree(self.work, ignore_errors=True)
+
+    def path(self, *parts):
+      """Build a path inside the scratch paper."""
+      return os.path.join(self.paper, *parts)
+
+    def write(self, fname, text):
+      """Write text to a file of the scratch paper."""
+      with open(self.path(fname), 'w') as fp:
+        fp.write(text)
+
+    def build(self, **kwargs):
+      """Build the scratch paper, returning the names of the stages which ran."""
+      from scriptorium.profiling import Profiler
+      profiler = Profiler()
+      kwargs.setdefault('use_cache', False)
+      scriptorium.to_pdf(self.paper, profiler=profiler, **kwargs)
+      return [ii['name'] for ii in profiler.stages]
+
+    def mtime(self, fname):
+      """Read the modification time of a file of the scratch paper."""
+      return os.stat(self.path(fname)).st_mtime
+
 class TestScriptorium(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -82,5 +152,753 @@ class TestScriptorium(unittest.TestCase):
       self.assertEqual(scriptorium.CONFIG['TEMPLATE_DIR'], os.path.expanduser(test_template_dir))
       scriptorium.CONFIG['TEMPLATE_DIR'] = self.template_dir
 
+class TestPapers(unittest.TestCase):
+    def setUp(self):
+      """Create scratch paper directory."""
+      self.paper_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+      """Remove scratch paper directory."""
+      shutil.rmtree(self.paper_dir, ignore_errors=True)
+
+    def write(self, fname, text):
+      """Write text to a file in the scratch paper directory."""
+      path = os.path.join(self.paper_dir, fname)
+      with open(path, 'w') as fp:
+        fp.write(textwrap.dedent(text))
+      return path
+
+    def testFrontmatter(self):
+      """Test metadata is read from the frontmatter only."""
+      self.write('notes.mmd', """\
+        # Notes
+
+        latex footer: other/footer.tex
+        """)
+      paper = self.write('paper.mmd', """\
+        Base Header Level: 3
+        latex author: John Doe
+          and Jane Doe
+        latex footer: report/footer.tex
+
+        latex footer: body/footer.tex
+        """)
+
+      self.assertEqual(scriptorium.read_frontmatter(paper, ['latex footer']),
+                       {'latexfooter': 'report/footer.tex'})
+      self.assertEqual(scriptorium.read_frontmatter(paper)['latexauthor'], 'John Doe and Jane Doe')
+      self.assertEqual(scriptorium.get_template(paper), 'report')
+      self.assertEqual(scriptorium.paper_root(self.paper_dir), 'paper.mmd')
+      self.assertEqual(scriptorium.paper_root(self.paper_dir), 'paper.mmd')
+
+    def testMissingPaper(self):
+      """Test a path which does not exist is not a paper, rather than an error."""
+      missing = os.path.join(self.paper_dir, 'nothere')
+      self.assertIsNone(scriptorium.paper_root(missing))
+      self.assertFalse(scriptorium.clean(missing))
+
+    def testRender(self):
+      """Test variables are substituted by the longest matching key, and unset ones reported."""
+      from scriptorium.papers import _render, _segments
+      text, unset_vars = _render(_segments('$TITLE_SHORT: $TITLE by $AUTHOR in $YEAR'),
+                                 {'TITLE': 'Paper', 'TITLE_SHORT': 'P', 'AUTHOR': 'Doe'})
+      self.assertEqual(text, 'P: Paper by Doe in $YEAR')
+      self.assertEqual(unset_vars, set(['year']))
+
+class TestIncrementalBuilds(StubBuildTestCase):
+    def testConversionCache(self):
+      """Test only sources which changed are converted again."""
+      from scriptorium.papers import _convert_paper
+      self.build()
+      self.assertEqual(_convert_paper(self.paper, self.paper), [])
+      with open(self.path('chapter001.mmd'), 'a') as fp:
+        fp.write('\nMore text.\n')
+      written = [os.path.basename(ii) for ii in _convert_paper(self.paper, self.paper)]
+      self.assertIn('chapter001.tex', written)
+      self.assertNotIn('chapter000.tex', written)
+
+    def testRerunUntilConverged(self):
+      """Test rebuilding an unchanged paper runs LaTeX once and skips the bibliography."""
+      stages = self.build()
+      self.assertIn('latex pass 2', stages)
+      bbl = self.mtime('paper.bbl')
+      stages = self.build()
+      self.assertNotIn('latex pass 2', stages)
+      self.assertEqual(self.mtime('paper.bbl'), bbl)
+
+    def testBibliographySkipped(self):
+      """Test bibtex runs again only once the bibliography database changes."""
+      self.build()
+      bbl = self.mtime('paper.bbl')
+      self.build()
+      self.assertEqual(self.mtime('paper.bbl'), bbl)
+      with open(self.path('refs.bib'), 'a') as fp:
+        fp.write('\n@book{extra,\n  title={Extra}\n}\n')
+      self.build()
+      self.assertNotEqual(self.mtime('paper.bbl'), bbl)
+
+class TestArtifacts(StubBuildTestCase):
+    def setUp(self):
+      """Share a transcluded file and a LaTeX input from outside the scratch paper."""
+      super(TestArtifacts, self).setUp()
+      self.shared = os.path.join(self.work, 'shared')
+      os.makedirs(self.shared)
+      self.write_shared('common.mmd', 'Shared text.\n')
+      self.write_shared('macros.tex', '\\def\\shared{1}\n')
+      with open(self.path('chapter000.mmd'), 'a') as fp:
+        fp.write('\n{{../shared/common.mmd}}\n\n\\input{../shared/macros.tex}\n')
+
+    def write_shared(self, fname, text):
+      """Write text to a file shared from outside the scratch paper."""
+      with open(os.path.join(self.shared, fname), 'w') as fp:
+        fp.write(text)
+
+    def assertCached(self, cached):
+      """Assert whether building the scratch paper again is served from the artifact store."""
+      stages = self.build(use_cache=True)
+      self.assertEqual('latex pass 1' not in stages, cached)
+
+    def testHit(self):
+      """Test rebuilding an unchanged paper reuses the stored PDF despite the earlier outputs."""
+      self.assertCached(False)
+      self.assertCached(True)
+
+    def testSourceEdit(self):
+      """Test editing a paper source misses the store."""
+      self.assertCached(False)
+      with open(self.path('chapter001.mmd'), 'a') as fp:
+        fp.write('\nMore text.\n')
+      self.assertCached(False)
+
+    def testConvertedOnce(self):
+      """Test a build looking up the store converts each changed source only once."""
+      from scriptorium import papers
+      converted = []
+      convert = papers._convert_source
+      def counting(mmd, text, ext):
+        converted.append(os.path.basename(mmd))
+        return convert(mmd, text, ext)
+      papers._convert_source = counting
+      try:
+        self.assertCached(False)
+        self.assertEqual(len(converted), len(set(converted)))
+        del converted[:]
+        with open(self.path('chapter001.mmd'), 'a') as fp:
+          fp.write('\nMore text.\n')
+        self.assertCached(False)
+        self.assertIn('chapter001.mmd', converted)
+        self.assertNotIn('chapter000.mmd', converted)
+        self.assertEqual(len(converted), len(set(converted)))
+      finally:
+        papers._convert_source = convert
+
+    def testOutOfTreeEdit(self):
+      """Test editing a transclusion or LaTeX input outside the paper misses the store."""
+      self.assertCached(False)
+      self.write_shared('common.mmd', 'Changed shared text.\n')
+      self.assertCached(False)
+      self.write_shared('macros.tex', '\\def\\shared{2}\n')
+      self.assertCached(False)
+      self.assertCached(True)
+
+@unittest.skipUnless(sys.version_info >= (3, 5), 'asyncio builds need Python 3.5')
+class TestBuilder(StubBuildTestCase):
+    def testConcurrentBuilds(self):
+      """Test one event loop drives two builds at once, profiling their LaTeX runs."""
+      import asyncio
+      from scriptorium.builder import Builder
+      from scriptorium.profiling import Profiler
+      other = os.path.join(self.work, 'other')
+      self.generate.make_paper(other, self.template, files=2, sections=1, words=10, citations=2)
+      profilers = [Profiler(), Profiler()]
+      builders = [Builder(self.paper, profiler=profilers[0], use_cache=False),
+                  Builder(other, profiler=profilers[1], use_cache=False)]
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      try:
+        pdfs = loop.run_until_complete(asyncio.gather(*[ii.build() for ii in builders]))
+      finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+      self.assertEqual(pdfs, [self.path('paper.pdf'), os.path.join(other, 'paper.pdf')])
+      for profiler in profilers:
+        latex = [ii for ii in profiler.stages if ii['name'] == 'latex pass 1']
+        self.assertGreater(latex[0]['peak_rss'], 0)
+
+class TestBuildAll(StubBuildTestCase):
+    def testManyPapers(self):
+      """Test papers build over a process pool, and a pattern matching nothing fails build-all."""
+      import argparse
+      from scriptorium.__main__ import build_all_cmd
+      other = os.path.join(self.work, 'other')
+      self.generate.make_paper(other, self.template, files=2, sections=1, words=10, citations=2)
+      results = sorted(scriptorium.build_papers([self.paper, other], jobs=2, use_cache=False))
+      self.assertEqual(results, [(other, os.path.join(other, 'paper.pdf'), None),
+                                 (self.paper, self.path('paper.pdf'), None)])
+
+      args = argparse.Namespace(papers=[os.path.join(self.work, 'p*'),
+                                        os.path.join(self.work, 'missing*')],
+                                jobs=1, shell_escape=False)
+      with self.assertRaises(SystemExit) as ctx:
+        build_all_cmd(args)
+      self.assertEqual(ctx.exception.code, 1)
+
+class TestClean(StubBuildTestCase):
+    def testEditDuringBuild(self):
+      """Test sources edited and files added while a build runs are kept by clean."""
+      from scriptorium import papers
+      check_output = papers._check_output
+      def editing(*args):
+        if not os.path.exists(self.path('figure.png')):
+          with open(self.path('paper.mmd'), 'a') as fp:
+            fp.write('\nEdited while building.\n')
+          self.write('figure.png', 'png')
+        return check_output(*args)
+      papers._check_output = editing
+      try:
+        self.build()
+      finally:
+        papers._check_output = check_output
+
+      self.assertTrue(scriptorium.clean(self.paper))
+      files = os.listdir(self.paper)
+      for fname in ['paper.mmd', 'chapter000.mmd', 'refs.bib', 'figure.png', 'paper.pdf']:
+        self.assertIn(fname, files)
+      for fname in ['paper.tex', 'chapter000.tex', 'paper.aux', 'paper.log', 'paper.bbl']:
+        self.assertNotIn(fname, files)
+
+    def testRecordingKeepsError(self):
+      """Test failing to record outputs does not replace the error which failed the build."""
+      from scriptorium import papers
+      from scriptorium.latexlog import LatexError
+      def broken(*args):
+        raise RuntimeError('recording failed')
+      record_outputs = papers._record_outputs
+      papers._record_outputs = broken
+      scriptorium.CONFIG['LATEX_CMD'] = 'false'
+      try:
+        self.assertRaises(LatexError, self.build)
+      finally:
+        papers._record_outputs = record_outputs
+
+    def testExportsKept(self):
+      """Test exported formats are recorded as published outputs, which clean keeps like the PDF."""
+      from scriptorium.export import export
+      from scriptorium.state import load_state
+      outputs = export(self.paper, ['pdf', 'html', 'tex'], use_cache=False)
+      self.assertEqual(sorted(load_state(self.paper, 'outputs')['published']),
+                       ['paper-source.zip', 'paper.html', 'paper.pdf'])
+      scriptorium.clean(self.paper)
+      for fmt in ['pdf', 'html', 'tex']:
+        self.assertTrue(os.path.exists(outputs[fmt]))
+      self.assertFalse(os.path.exists(self.path('paper.aux')))
+
+    def testTemplatesSkipped(self):
+      """Test recursive cleaning leaves template directories alone."""
+      self.build()
+      templates = os.path.join(self.paper, 'templates')
+      shutil.copytree(self.template_dir, templates)
+      tdir = os.path.join(templates, os.path.relpath(
+        scriptorium.find_template(self.template, self.template_dir), self.template_dir))
+      before = sorted(os.listdir(tdir))
+      cleaned = [ii[0] for ii in scriptorium.clean_papers(self.work)]
+      self.assertIn(self.paper, cleaned)
+      self.assertFalse([ii for ii in cleaned if ii.startswith(templates)])
+      self.assertEqual(sorted(os.listdir(tdir)), before)
+
+    def testExportWithoutPdf(self):
+      """Test LaTeX converted to export a source bundle alone is recorded, so clean removes it."""
+      from scriptorium.export import export
+      outputs = export(self.paper, ['tex'])
+      self.assertTrue(os.path.exists(self.path('chapter000.tex')))
+      scriptorium.clean(self.paper)
+      self.assertFalse(os.path.exists(self.path('chapter000.tex')))
+      self.assertTrue(os.path.exists(outputs['tex']))
+
+class TestExport(StubBuildTestCase):
+    def testFlattenedBundle(self):
+      """Test the source bundle of a flattened build holds the flattened root LaTeX."""
+      import zipfile
+      from scriptorium.export import export
+      outputs = export(self.paper, ['pdf', 'tex'], use_cache=False, flatten=True)
+      with zipfile.ZipFile(outputs['tex']) as bundle:
+        tex = bundle.read('paper.tex').decode('utf-8')
+      with open(self.path('paper.tex')) as fp:
+        self.assertEqual(fp.read(), tex)
+      self.assertNotIn('\\input{{{0}/setup.tex}}'.format(self.template), tex)
+
+@unittest.skipUnless(sys.version_info >= (3, 7), 'the build daemon needs Python 3.7')
+class TestServer(StubBuildTestCase):
+    def testRequests(self):
+      """Test the daemon answers build and info requests, reporting build stages."""
+      import asyncio
+      import json
+      from scriptorium.server import Server
+      socket_path = os.path.join(self.work, 'serve.sock')
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      server = Server(1, self.template_dir)
+      try:
+        ready = loop.create_future()
+        loop.create_task(server.serve(socket_path, lambda: ready.set_result(None)))
+        loop.run_until_complete(ready)
+        self.assertEqual(os.stat(socket_path).st_mode & 0o077, 0)
+        reader, writer = loop.run_until_complete(asyncio.open_unix_connection(socket_path))
+        requests = [{'id': 1, 'cmd': 'build', 'paper': self.paper,
+                     'options': {'use_cache': False}},
+                    {'id': 2, 'cmd': 'info', 'paper': self.paper},
+                    {'id': 3, 'cmd': 'nope'}]
+        writer.write(''.join(json.dumps(ii) + '\n' for ii in requests).encode('utf-8'))
+        replies = {}
+        while len([ii for ii in replies.values() if ii[-1]['event'] in ('result', 'error')]) < 3:
+          reply = json.loads(loop.run_until_complete(reader.readline()).decode('utf-8'))
+          replies.setdefault(reply['id'], []).append(reply)
+        writer.close()
+        tasks = asyncio.all_tasks(loop)
+        for pending in tasks:
+          pending.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+      finally:
+        server.close()
+        asyncio.set_event_loop(None)
+        loop.close()
+
+      self.assertEqual(replies[1][-1]['pdf'], self.path('paper.pdf'))
+      self.assertIn({'id': 1, 'event': 'stage', 'stage': 'latex pass 1', 'status': 'start'},
+                    replies[1])
+      self.assertEqual(replies[2], [{'id': 2, 'event': 'result', 'root': 'paper.mmd',
+                                     'template': self.template}])
+      self.assertEqual(replies[3], [{'id': 3, 'event': 'error', 'error': 'Unknown command nope'}])
+
+class TestBuildDir(StubBuildTestCase):
+    def testSourceTreeUntouched(self):
+      """Test building into a build directory writes nothing to the paper directory."""
+      build_dir = os.path.join(self.work, 'build')
+      before = sorted(os.listdir(self.paper))
+      self.build(build_dir=build_dir, use_cache=True, precompile=True)
+      self.assertEqual(sorted(os.listdir(self.paper)), before)
+      self.assertTrue(os.path.exists(os.path.join(build_dir, 'paper.pdf')))
+      self.assertTrue(os.path.exists(os.path.join(build_dir, 'chapter000.tex')))
+
+class TestPartialBuilds(StubBuildTestCase):
+    def driver(self, only):
+      """Write the units of the scratch paper, returning the text of the driver for only."""
+      from scriptorium.units import write_units
+      with open(write_units(self.path('paper.mmd'), self.paper, self.paper, only)) as fp:
+        return fp.read()
+
+    def testIncludeOnly(self):
+      """Test chapters are selected by title or file once every unit has been compiled."""
+      self.assertIn('units', self.build(only=['Chapter 1']))
+      with open(self.path('paper.pdf')) as fp:
+        self.assertIn('\\include{paper-unit002}', fp.read())
+      self.assertNotIn('\\includeonly', self.driver(['Chapter 1']))
+
+      for unit in range(1, 4):
+        self.write('paper-unit{0:03d}.aux'.format(unit), '\\relax\n')
+      self.assertIn('\\includeonly{paper-unit002}\n', self.driver(['Chapter 1']))
+      self.assertIn('\\includeonly{paper-unit003,paper-unit001}\n',
+                    self.driver(['chapter002.mmd', 'chapter 0']))
+      self.assertRaises(ValueError, self.driver, ['Appendix'])
+
+    def testFilesByPosition(self):
+      """Test files select the chapters they hold, even when another file repeats their titles."""
+      from scriptorium.papers import _convert_paper
+      for chapter in ['chapter001.mmd', 'chapter002.mmd']:
+        self.write(chapter, '# Results\n\nText.\n\n# Discussion\n\nText.\n')
+      _convert_paper(self.paper, self.paper)
+      for unit in range(1, 6):
+        self.write('paper-unit{0:03d}.aux'.format(unit), '\relax\n')
+      self.assertIn('\\includeonly{paper-unit004,paper-unit005}\n', self.driver(['chapter002.mmd']))
+      self.assertIn('\\includeonly{paper-unit002,paper-unit003}\n', self.driver(['chapter001']))
+
+    def testSectionsNotSplit(self):
+      """Test papers without chapters are not split into a unit per section."""
+      with open(self.path('paper.mmd')) as fp:
+        text = fp.read()
+      self.write('paper.mmd', text.replace('Base Header Level: 2', 'Base Header Level: 3'))
+      self.assertRaises(IOError, self.build, only=['Chapter 1'])
+
+class TestDraftBuilds(StubBuildTestCase):
+    def read(self, fname):
+      """Read a file of the scratch paper."""
+      with open(self.path(fname)) as fp:
+        return fp.read()
+
+    def testReuseAux(self):
+      """Test a draft build runs one LaTeX pass, leaving the bibliography of the full build."""
+      self.build()
+      bbl = self.mtime('paper.bbl')
+      stages = self.build(draft=True)
+      self.assertIn('latex pass 1', stages)
+      self.assertNotIn('latex pass 2', stages)
+      self.assertNotIn('bibliography', stages)
+      self.assertEqual(self.mtime('paper.bbl'), bbl)
+
+    def testFailureRestoresAux(self):
+      """Test a failed draft pass puts back the auxiliary files of the full build."""
+      self.build()
+      aux = self.read('paper.aux')
+      failing = os.path.join(self.work, 'bin', 'failtex')
+      with open(failing, 'w') as fp:
+        fp.write('#!{0}\n'.format(sys.executable))
+        fp.write('import sys\n')
+        fp.write("jobname = [ii[9:] for ii in sys.argv if ii.startswith('-jobname=')][-1]\n")
+        fp.write("open(jobname + '.aux', 'w').write('truncated')\n")
+        fp.write('sys.exit(1)\n')
+      os.chmod(failing, 0o755)
+      scriptorium.CONFIG['LATEX_CMD'] = 'failtex'
+      self.assertRaises(Exception, self.build, draft=True)
+      self.assertEqual(self.read('paper.aux'), aux)
+
+class TestPrecompile(StubBuildTestCase):
+    def testFormatReused(self):
+      """Test the preamble is dumped once into the paper's state, and loaded by later builds."""
+      from scriptorium.templates import find_template
+      self.assertIn('precompile', self.build(precompile=True))
+      fmt_dir = self.path('.scriptorium', 'formats')
+      formats = [ii for ii in os.listdir(fmt_dir) if ii.endswith('.fmt')]
+      self.assertEqual(len(formats), 1)
+      with open(os.path.join(fmt_dir, formats[0])) as fp:
+        self.assertIn('\\documentclass{article}', fp.read())
+      with open(self.path('paper.pdf')) as fp:
+        pdf = fp.read()
+      self.assertIn('\\documentclass{article}', pdf)
+      self.assertIn('\\chapter{Chapter 0}', pdf)
+
+      fmt = os.stat(os.path.join(fmt_dir, formats[0])).st_mtime
+      self.build(precompile=True)
+      self.assertEqual(os.stat(os.path.join(fmt_dir, formats[0])).st_mtime, fmt)
+      template_loc = find_template(self.template, self.template_dir)
+      self.assertFalse(os.path.exists(os.path.join(template_loc, '.scriptorium')))
+
+class TestProfiling(StubBuildTestCase):
+    def testTrace(self):
+      """Test a profiled build records each stage with its resource usage and writes a trace."""
+      import json
+      from scriptorium.profiling import Profiler
+      profiler = Profiler()
+      scriptorium.to_pdf(self.paper, profiler=profiler, use_cache=False)
+      stages = dict((ii['name'], ii) for ii in profiler.stages)
+      for name in ['convert', 'latex pass 1', 'bibliography']:
+        self.assertIn(name, stages)
+      self.assertGreater(stages['latex pass 1']['peak_rss'], 0)
+      self.assertGreater(stages['convert']['written'], 0)
+
+      trace = os.path.join(self.work, 'trace.json')
+      profiler.save(trace)
+      with open(trace) as fp:
+        events = json.load(fp)['traceEvents']
+      self.assertEqual(sorted(ii['name'] for ii in events), sorted(stages))
+      self.assertTrue(all(ii['ph'] == 'X' and ii['dur'] >= 0 for ii in events))
+      self.assertIn('latex pass 1', profiler.summary())
+
+class TestParallelConversion(StubBuildTestCase):
+    def testSameOutput(self):
+      """Test converting over a process pool writes the same LaTeX as converting in process."""
+      from scriptorium.papers import _convert_paper
+      serial = os.path.join(self.work, 'serial')
+      parallel = os.path.join(self.work, 'parallel')
+      os.makedirs(serial)
+      os.makedirs(parallel)
+      _convert_paper(self.paper, serial, jobs=1)
+      written = _convert_paper(self.paper, parallel, jobs=2)
+      self.assertEqual(len(written), 4)
+      for tex in sorted(os.listdir(serial)):
+        if tex.endswith('.tex'):
+          with open(os.path.join(serial, tex)) as sfp, open(os.path.join(parallel, tex)) as pfp:
+            self.assertEqual(sfp.read(), pfp.read())
+
+class TestWatch(StubBuildTestCase):
+    def watch(self, edits, pause, debounce):
+      """Watch the scratch paper, appending each edit pause seconds apart after the first build,
+      and return the error of each build until the first rebuild."""
+      import threading
+      from scriptorium.watch import watch
+      builds = []
+
+      class Stop(Exception):
+        pass
+
+      def on_build(pdf, err):
+        builds.append(err)
+        if len(builds) > 1:
+          raise Stop()
+
+      def run():
+        try:
+          watch(self.paper, debounce=debounce, poll_interval=0.05, on_build=on_build)
+        except Stop:
+          pass
+
+      thread = threading.Thread(target=run)
+      thread.daemon = True
+      thread.start()
+      while not builds and thread.is_alive():
+        thread.join(0.05)
+      for fname, text in edits:
+        time.sleep(pause)
+        with open(self.path(fname), 'a') as fp:
+          fp.write(text)
+      thread.join(30)
+      self.assertFalse(thread.is_alive())
+      return builds
+
+    def converted(self, fname):
+      """Read the LaTeX converted from a file of the scratch paper."""
+      with open(self.path(fname)) as fp:
+        return fp.read()
+
+    def testRebuildOnChange(self):
+      """Test editing a source rebuilds the paper with the edit."""
+      builds = self.watch([('chapter001.mmd', '\nWatched edit.\n')], 0.2, 0.1)
+      self.assertEqual(builds, [None, None])
+      self.assertIn('Watched edit.', self.converted('chapter001.tex'))
+
+    def testDebounce(self):
+      """Test a burst of edits is rebuilt once, after the last of them."""
+      edits = [('chapter001.mmd', '\nEdit {0}.\n'.format(ii)) for ii in range(4)]
+      builds = self.watch(edits, 0.1, 0.5)
+      self.assertEqual(builds, [None, None])
+      self.assertIn('Edit 3.', self.converted('chapter001.tex'))
+
+class TestTemplateMirror(unittest.TestCase):
+    def setUp(self):
+      """Create an upstream template repository to install from."""
+      self.work = tempfile.mkdtemp()
+      self.upstream = os.path.join(self.work, 'upstream', 'simple.git')
+      self.template_dir = os.path.join(self.work, 'templates')
+      self.mirror = os.path.join(self.work, 'mirror')
+      os.makedirs(os.path.join(self.upstream, 'report'))
+      os.makedirs(self.template_dir)
+      self.commit('\\documentclass{article}\n')
+
+    def tearDown(self):
+      """Remove scratch repositories."""
+      shutil.rmtree(self.work, ignore_errors=True)
+
+    def commit(self, text):
+      """Commit a new version of the template setup upstream."""
+      with open(os.path.join(self.upstream, 'report', 'setup.tex'), 'w') as fp:
+        fp.write(text)
+      if not os.path.exists(os.path.join(self.upstream, '.git')):
+        _git(['init', '-q'], self.upstream)
+      _git(['add', '.'], self.upstream)
+      _git(['commit', '-q', '-m', 'Update setup'], self.upstream)
+
+    def testUpdateThroughMirror(self):
+      """Test templates are installed and updated through the mirror, keeping the upstream URL."""
+      url = 'file://' + self.upstream
+      scriptorium.install_template(url, self.template_dir, mirror=self.mirror)
+      self.assertEqual(len(os.listdir(self.mirror)), 1)
+      self.commit('\\documentclass{report}\n')
+      scriptorium.update_template('report', self.template_dir, mirror=self.mirror)
+      with open(os.path.join(self.template_dir, 'simple', 'report', 'setup.tex')) as fp:
+        self.assertEqual(fp.read(), '\\documentclass{report}\n')
+      origin = subprocess.check_output(['git', 'config', '--get', 'remote.origin.url'],
+                                       cwd=os.path.join(self.template_dir, 'simple'),
+                                       universal_newlines=True)
+      self.assertEqual(origin.strip(), url)
+
+    def testUrlList(self):
+      """Test repository lists skip blank lines and comments, however they are indented."""
+      from scriptorium.__main__ import _read_urls
+      fname = os.path.join(self.work, 'templates.txt')
+      with open(fname, 'w') as fp:
+        fp.write('# Templates\nfile:///a.git v1\n\n  # file:///b.git\n')
+      self.assertEqual(_read_urls(fname), ['file:///a.git v1'])
+
+class TestCreateBatch(unittest.TestCase):
+    def setUp(self):
+      """Create a template tree from the benchmark generator."""
+      if BENCH_DIR not in sys.path:
+        sys.path.insert(0, BENCH_DIR)
+      import generate
+      self.work = tempfile.mkdtemp()
+      self.template_dir = os.path.join(self.work, 'templates')
+      self.template = generate.make_template_tree(self.template_dir, 1, 1, 2)[0]
+      self.old_template_dir = scriptorium.CONFIG['TEMPLATE_DIR']
+      scriptorium.CONFIG['TEMPLATE_DIR'] = self.template_dir
+
+    def tearDown(self):
+      """Restore the template directory and remove scratch files."""
+      scriptorium.CONFIG['TEMPLATE_DIR'] = self.old_template_dir
+      shutil.rmtree(self.work, ignore_errors=True)
+
+    def testGenerator(self):
+      """Test papers given by a generator are all created."""
+      outputs = [os.path.join(self.work, 'paper{0}'.format(ii)) for ii in range(2)]
+      papers = ({'output': ii, 'title': 'Title', 'author': 'Author'} for ii in outputs)
+      results = list(scriptorium.create_batch(papers, self.template, use_git=False))
+      self.assertEqual(sorted(ii[0] for ii in results), outputs)
+      self.assertEqual([ii[2] for ii in results], [None, None])
+      self.assertTrue(all(os.path.exists(ii) for ii in outputs))
+
+class TestTemplateIndex(unittest.TestCase):
+    def setUp(self):
+      """Create a template directory holding one git repository of templates."""
+      self.template_dir = tempfile.mkdtemp()
+      self.repo = os.path.join(self.template_dir, 'repo0')
+      self.add_template('old')
+      _git(['init', '-q'], self.repo)
+      _git(['add', '.'], self.repo)
+      _git(['commit', '-q', '-m', 'Add template'], self.repo)
+
+    def tearDown(self):
+      """Remove the template directory."""
+      shutil.rmtree(self.template_dir, ignore_errors=True)
+
+    def add_template(self, name):
+      """Add a template to the repository without committing it."""
+      tdir = os.path.join(self.repo, 'group0', name)
+      os.makedirs(tdir)
+      with open(os.path.join(tdir, 'setup.tex'), 'w') as fp:
+        fp.write('\\documentclass{article}\n')
+      return tdir
+
+    def testIndexKeptAfterSave(self):
+      """Test saving the index does not make it stale."""
+      from scriptorium.state import load_state
+      from scriptorium.templates import _index_stamp
+      scriptorium.find_template('old', self.template_dir)
+      self.assertEqual(load_state(self.template_dir, 'templates')['stamp'],
+                       _index_stamp(self.template_dir))
+
+    def testNewTemplateFound(self):
+      """Test templates added to a repository after indexing are still found."""
+      for _ in range(2):
+        scriptorium.find_template('old', self.template_dir)
+      tdir = self.add_template('mynew')
+      self.assertEqual(scriptorium.find_template('mynew', self.template_dir), tdir)
+      self.assertEqual(sorted(scriptorium.all_templates(self.template_dir)), ['mynew', 'old'])
+      self.assertRaises(IOError, scriptorium.find_template, 'missing', self.template_dir)
+
+    def testIndexReused(self):
+      """Test listing templates and missed lookups reuse the index while it is current."""
+      from scriptorium.state import STATE_DIR
+      index = os.path.join(self.template_dir, STATE_DIR, 'templates.json')
+      scriptorium.all_templates(self.template_dir)
+      saved = os.stat(index).st_mtime
+      time.sleep(0.05)
+      self.assertEqual(scriptorium.all_templates(self.template_dir), ['old'])
+      self.assertRaises(IOError, scriptorium.find_template, 'missing', self.template_dir)
+      self.assertEqual(os.stat(index).st_mtime, saved)
+
+      os.makedirs(os.path.join(self.repo, 'group0', 'deeper'))
+      scriptorium.all_templates(self.template_dir)
+      self.add_template(os.path.join('deeper', 'mynew'))
+      self.assertEqual(scriptorium.all_templates(self.template_dir), ['old'])
+      self.assertEqual(sorted(scriptorium.all_templates(self.template_dir, rescan=True)),
+                       ['mynew', 'old'])
+
+class TestFlatten(unittest.TestCase):
+    def setUp(self):
+      """Create a scratch directory for LaTeX files."""
+      self.work = tempfile.mkdtemp()
+
+    def tearDown(self):
+      """Remove the scratch directory."""
+      shutil.rmtree(self.work, ignore_errors=True)
+
+    def write(self, fname, text):
+      """Write a LaTeX file of the scratch directory."""
+      with open(os.path.join(self.work, fname), 'w') as fp:
+        fp.write(textwrap.dedent(text))
+
+    def flatten(self, keep_comments=False):
+      """Flatten main.tex, returning its new text."""
+      from scriptorium.flatten import flatten_file
+      fname = os.path.join(self.work, 'main.tex')
+      flatten_file(fname, {'TEXINPUTS': './:'}, keep_comments)
+      with open(fname) as fp:
+        return fp.read()
+
+    def testExpansion(self):
+      """Test inputs and includes are expanded, except in verbatim and after \\endinput."""
+      self.write('main.tex', """\
+        \\begin{document}
+        \\input{part}
+        \\include{chapter}
+        \\begin{verbatim}
+        \\input{part}
+        \\end{verbatim}
+        % A comment
+        Text % trailing
+        \\input{missing}
+        \\end{document}
+        """)
+      self.write('part.tex', """\
+        Part text.
+        \\endinput
+        Hidden text.
+        """)
+      self.write('chapter.tex', 'Chapter text.\n')
+      self.assertEqual(self.flatten(), textwrap.dedent("""\
+        \\begin{document}
+        Part text.
+
+
+        \\clearpage{}Chapter text.
+        \\clearpage{}
+        \\begin{verbatim}
+        \\input{part}
+        \\end{verbatim}
+        Text %
+        \\input{missing}
+        \\end{document}
+        """))
+
+    def testKeepComments(self):
+      """Test comments are kept when asked, and files are reflattened after they change."""
+      self.write('main.tex', '\\input{part} % Part\n')
+      self.write('part.tex', 'One.\n')
+      self.assertEqual(self.flatten(keep_comments=True), 'One.\n % Part\n')
+      self.write('main.tex', '\\input{part}\n')
+      self.write('part.tex', 'Two, longer.\n')
+      self.assertEqual(self.flatten(), 'Two, longer.\n\n')
+
+class TestLatexLog(unittest.TestCase):
+    def testFatalError(self):
+      """Test LaTeX output is parsed into events, stopping at the first error."""
+      from scriptorium.latexlog import LatexLog
+      log = LatexLog()
+      lines = ["LaTeX Warning: Citation `doe00' on page 1 undefined on input line 4.",
+               'Overfull \\hbox (3.0pt too wide) in paragraph at lines 10--12',
+               './paper.tex:12: Undefined control sequence.',
+               'l.12 \\foo']
+      self.assertEqual([log.feed(ii) for ii in lines], [False, False, False, True])
+      self.assertEqual([(ii.kind, ii.line) for ii in log.events],
+                       [('undefined citation', 4), ('overfull box', 10), ('error', 12)])
+      self.assertEqual(str(log.error()).split('\n')[0],
+                       './paper.tex:12: Undefined control sequence.')
+
+class TestDeps(unittest.TestCase):
+    def testDepfile(self):
+      """Test depfile paths are escaped and made relative where possible."""
+      from scriptorium.deps import format_depfile
+      text = format_depfile('/papers/a/a.pdf', ['/papers/a/my fig.pdf', '/tpl/$x#.tex'], '/papers')
+      self.assertEqual(text, 'a/a.pdf: \\\n a/my\\ fig.pdf \\\n /tpl/$$x\\#.tex\n')
+
+class TestStartup(unittest.TestCase):
+    def testLazyImport(self):
+      """Test importing scriptorium neither reads configuration nor loads heavy dependencies."""
+      home = tempfile.mkdtemp()
+      env = dict(os.environ, HOME=home)
+      env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                           env.get('PYTHONPATH', '')])
+      script = textwrap.dedent("""\
+        import sys
+        import scriptorium
+        print(' '.join(ii for ii in ['pymmd', 'yaml', 'argcomplete', 'scriptorium.__main__']
+                       if ii in sys.modules))
+        """)
+      try:
+        loaded = subprocess.check_output([sys.executable, '-c', script], env=env,
+                                         universal_newlines=True)
+        self.assertEqual(loaded.strip(), '')
+        self.assertEqual(os.listdir(home), [])
+      finally:
+        shutil.rmtree(home, ignore_errors=True)
+
 if __name__ == '__main__':
     unittest.main()